@@ -4,8 +4,16 @@
 
 import argparse
 import logging
-from typing import List, Optional
-
+from typing import List, Optional, Union
+
+from curvelib import (
+    Best_efforts,
+    Curve,
+    Envelope,
+    get_best_value,
+    load_best_efforts,
+    load_cached_curves,
+)
 from fitlib import Activity, Metric, Segment, get_logger, load_activities, load_segments
 
 
@@ -51,22 +59,91 @@ def render_activity_summary(activity: Activity) -> None:
     print("*" * 80)
     print(f"Date: {activity.start_time}")
     print(f"Duration: {str(activity.duration)}")
+
+    if activity.moving_time is not None:
+        print(f"Moving time: {str(activity.moving_time)}")
     print(f"Distance: {activity.distance/1000:2.2f} km")
+
+    if activity.elevation_gain is not None and activity.elevation_loss is not None:
+        print(
+            f"Elevation: +{activity.elevation_gain:.0f} m / "
+            f"-{activity.elevation_loss:.0f} m"
+        )
+
+    if activity.avg_heart_rate is not None:
+        print(f"Avg HR: {activity.avg_heart_rate:.0f} bpm")
+
+    if activity.calories is not None:
+        print(f"Calories: {activity.calories:.0f} kcal")
     print("*" * 80)
 
 
+def render_best_efforts(activity: Activity, best_efforts: Best_efforts) -> None:
+    """Show best efforts of the activity, compared to all-time and yearly bests"""
+    curves = load_cached_curves(activity.name)
+
+    if not curves:
+        return
+
+    durations = {"5s": 5, "1min": 60, "5min": 300, "20min": 1200, "1h": 3600}
+    print()
+    print("Best efforts" + "".join([f"{label:>8}" for label in durations]))
+
+    curve: Union[Curve, Envelope]
+
+    for label, (metric_name, unit) in {
+        "  HR": ["heart_rate", "bpm"],
+        "  Cadence": ["cadence", "Hz"],
+        "  Speed": ["speed", "km/h"],
+    }.items():
+        if metric_name not in curves:
+            continue
+
+        for period, period_label in [
+            (None, f"{label} ({unit})"),
+            ("all", "    All-time"),
+            (str(activity.start_time.year), "    This year"),
+        ]:
+            if period is None:
+                curve = curves[metric_name]
+            elif metric_name in best_efforts.envelopes.get(period, {}):
+                curve = best_efforts.envelopes[period][metric_name]
+            else:
+                continue
+
+            values = [get_best_value(curve, d) for d in durations.values()]
+            print(
+                f"{period_label:<12}"
+                + "".join([f"{v:>8.1f}" if v else f"{'-':>8}" for v in values])
+            )
+
+
 def render_segment_in_context(segment: Segment, segments: List[Segment]) -> None:
     """Show segment details in context"""
 
     # Show segment
     print()
     print(f"Segment    : {segment.segment_name}\n")
+
+    if segment.nested_in:
+        parents = {s.segment_uid: s.segment_name for s in segments}
+        print(f"  Part of  : {', '.join([parents[uid] for uid in segment.nested_in])}")
     print(f"  Duration : {str(segment.duration)}")
 
+    if segment.moving_time is not None and segment.moving_time != segment.duration:
+        print(f"  Moving   : {str(segment.moving_time)}")
+
+    if segment.elevation_gain is not None:
+        print(f"  D+       : {segment.elevation_gain:>5.0f} m")
+
+    if segment.grade is not None:
+        print(f"  Grade    : {segment.grade:>5.1f} %")
+
     for label, (metric_name, unit) in {
         "  HR": ["heart_rate", "bpm"],
         "  Cadence": ["cadence", "Hz"],
         "  Speed": ["speed", "km/h"],
+        "  Power": ["power", "W"],
         "  Temp.": ["temperature", "°C"],
     }.items():
         metric: Metric = getattr(segment, metric_name)
@@ -120,7 +197,10 @@ def render_segment_in_context(segment: Segment, segments: List[Segment]) -> None
 
 
 def render_activity(
-    activity: Optional[str], activities: List[Activity], segments: List[Segment]
+    activity: Optional[str],
+    activities: List[Activity],
+    segments: List[Segment],
+    best_efforts: Optional[Best_efforts] = None,
 ) -> None:
     """docstring for render_activity"""
 
@@ -141,8 +221,13 @@ def render_activity(
 
     render_activity_summary(matching_activity)
 
+    if best_efforts:
+        render_best_efforts(matching_activity, best_efforts)
+
+    # Parents first, then the segments nested in them
     matching_segments = sorted(
-        [s for s in segments if s.activity_name == activity], key=lambda x: x.start_time
+        [s for s in segments if s.activity_name == activity],
+        key=lambda x: (x.start_time, -x.duration),
     )
 
     for matching_segment in matching_segments:
@@ -153,9 +238,10 @@ def main(args: argparse.Namespace) -> None:
     # segment_definitions = load_segment_definitions()
     activities = load_activities()
     segments = load_segments()
+    best_efforts = load_best_efforts()
 
     for activity in args.activity_names:
-        render_activity(activity, activities, segments)
+        render_activity(activity, activities, segments, best_efforts)
         print()
 
 
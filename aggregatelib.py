@@ -0,0 +1,269 @@
+"""
+Materialized aggregates of activities and segments, maintained incrementally.
+
+- Activities: totals (count, distance, duration, moving time, elevation gain) for
+  all time, and per year (`2020`), month (`2020-05`), ISO week (`2020-W21`) and day
+  (`2020-05-21`). Totals are sums, so replacing an activity subtracts the old copy
+  and adds the new one.
+- Segments: per segment uid, the sorted durations of the attempts (for the best and
+  median times), and the sums of the metric averages.
+
+Aggregates are stored in `aggregates.json`, and exported for the web UI. They are
+rebuilt from scratch only if they do not match the loaded activities and segments
+(e.g. first run, or segments of removed definitions dropped), as told by their
+counts and the sums of the hashes of their keys.
+"""
+
+import json
+from bisect import insort
+from hashlib import blake2b
+from dataclasses import asdict, dataclass, field
+from datetime import date, datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from dacite import from_dict
+
+from fitlib import DEFAULT_UI_BASEDIR, Activity, Metric, Segment, atomic_write
+from metriclib import SEGMENT_METRICS
+
+DEFAULT_AGGREGATES_FILENAME = "aggregates.json"
+# Sums of key hashes are kept modulo KEY_SUM_MODULO, cf. `get_key_hash()`
+KEY_SUM_MODULO = 2 ** 64
+
+
+@dataclass
+class Activity_totals:
+    count: int = 0
+    distance: float = 0.0
+    duration: float = 0.0
+    elevation_gain: float = 0.0
+    moving_time: float = 0.0
+
+
+@dataclass
+class Segment_stats:
+    # Durations of the attempts, in seconds, sorted
+    durations: List[float] = field(default_factory=list)
+    # Metric name -> sum and number of the attempt averages
+    metric_counts: Dict[str, int] = field(default_factory=dict)
+    metric_sums: Dict[str, float] = field(default_factory=dict)
+
+
+@dataclass
+class Aggregates:
+    # Period ("all", year, month, week or day) -> activity totals
+    periods: Dict[str, Activity_totals] = field(default_factory=dict)
+    # Segment uid -> attempt statistics
+    segments: Dict[str, Segment_stats] = field(default_factory=dict)
+    # Sum of the key hashes of the activities and segments aggregated
+    key_sum: int = 0
+
+
+def get_periods(start_time: datetime) -> List[str]:
+    iso_year, iso_week, _ = start_time.isocalendar()
+
+    return [
+        "all",
+        f"{start_time.year}",
+        f"{start_time.year}-{start_time.month:02d}",
+        f"{iso_year}-W{iso_week:02d}",
+        start_time.date().isoformat(),
+    ]
+
+
+def get_key_hash(*key: str) -> int:
+    """Stable 64-bit hash of a key (`hash()` is salted per process)"""
+    digest = blake2b("\0".join(key).encode(), digest_size=8).digest()
+
+    return int.from_bytes(digest, "big")
+
+
+def get_activity_hash(activity: Activity) -> int:
+    return get_key_hash("activity", activity.name, activity.start_time.isoformat())
+
+
+def get_segment_hash(segment: Segment) -> int:
+    return get_key_hash(
+        "segment",
+        segment.activity_name,
+        segment.segment_uid,
+        segment.start_time.isoformat(),
+    )
+
+
+def _add_to_key_sum(aggregates: Aggregates, key_hash: int) -> None:
+    aggregates.key_sum = (aggregates.key_sum + key_hash) % KEY_SUM_MODULO
+
+
+def _update_activity(aggregates: Aggregates, activity: Activity, sign: int) -> None:
+    _add_to_key_sum(aggregates, sign * get_activity_hash(activity))
+
+    for period in get_periods(activity.start_time):
+        totals = aggregates.periods.setdefault(period, Activity_totals())
+        totals.count += sign
+        totals.distance += sign * (activity.distance or 0.0)
+        totals.duration += sign * activity.duration.total_seconds()
+        totals.elevation_gain += sign * (activity.elevation_gain or 0.0)
+        totals.moving_time += sign * (
+            activity.moving_time.total_seconds() if activity.moving_time else 0.0
+        )
+
+        if totals.count == 0:
+            del aggregates.periods[period]
+
+
+def add_activity(aggregates: Aggregates, activity: Activity) -> None:
+    _update_activity(aggregates, activity, 1)
+
+
+def remove_activity(aggregates: Aggregates, activity: Activity) -> None:
+    _update_activity(aggregates, activity, -1)
+
+
+def add_segment(aggregates: Aggregates, segment: Segment) -> None:
+    _add_to_key_sum(aggregates, get_segment_hash(segment))
+    stats = aggregates.segments.setdefault(segment.segment_uid, Segment_stats())
+    insort(stats.durations, segment.duration.total_seconds())
+
+    for metric_name in SEGMENT_METRICS:
+        metric = getattr(segment, metric_name)
+
+        if not isinstance(metric, Metric):
+            continue
+
+        stats.metric_counts[metric_name] = stats.metric_counts.get(metric_name, 0) + 1
+        stats.metric_sums[metric_name] = (
+            stats.metric_sums.get(metric_name, 0.0) + metric.avg
+        )
+
+
+def build_aggregates(
+    activities: Iterable[Activity], segments: Iterable[Segment]
+) -> Aggregates:
+    to_return = Aggregates()
+
+    for activity in activities:
+        add_activity(to_return, activity)
+
+    for segment in segments:
+        add_segment(to_return, segment)
+
+    return to_return
+
+
+def is_consistent(
+    aggregates: Aggregates, activities: List[Activity], segments: List[Segment]
+) -> bool:
+    """Check that the aggregates were built from these activities/segments
+
+    Counts match as well when an activity was replaced by another one: the sum of
+    the hashes of their keys (activity name, segment uid, start time) is compared
+    too. Sums do not depend on the order, and are kept up to date as activities and
+    segments are added or removed.
+    """
+    totals = aggregates.periods.get("all")
+    nb_activities = totals.count if totals else 0
+    nb_segments = sum(len(s.durations) for s in aggregates.segments.values())
+    key_sum = sum([get_activity_hash(a) for a in activities]) + sum(
+        [get_segment_hash(s) for s in segments]
+    )
+
+    return (
+        nb_activities == len(activities)
+        and nb_segments == len(segments)
+        and key_sum % KEY_SUM_MODULO == aggregates.key_sum
+    )
+
+
+def get_range_totals(
+    aggregates: Aggregates, start: date, stop: date
+) -> Activity_totals:
+    """Totals of the activities from `start` to `stop` (included), from day totals"""
+    to_return = Activity_totals()
+    first, last = start.isoformat(), stop.isoformat()
+
+    for period, totals in aggregates.periods.items():
+        # Days are the only periods formatted as YYYY-MM-DD
+        if len(period) != 10 or not first <= period <= last:
+            continue
+
+        to_return.count += totals.count
+        to_return.distance += totals.distance
+        to_return.duration += totals.duration
+        to_return.elevation_gain += totals.elevation_gain
+        to_return.moving_time += totals.moving_time
+
+    return to_return
+
+
+def get_best_duration(stats: Segment_stats) -> float:
+    return stats.durations[0]
+
+
+def get_median_duration(stats: Segment_stats) -> float:
+    middle = len(stats.durations) // 2
+
+    if len(stats.durations) % 2:
+        return stats.durations[middle]
+
+    return (stats.durations[middle - 1] + stats.durations[middle]) / 2
+
+
+def get_metric_average(stats: Segment_stats, metric_name: str) -> Optional[float]:
+    if not stats.metric_counts.get(metric_name):
+        return None
+
+    return stats.metric_sums[metric_name] / stats.metric_counts[metric_name]
+
+
+def load_aggregates(aggregates_filename: Optional[str] = None) -> Aggregates:
+    if aggregates_filename is None:
+        aggregates_filename = DEFAULT_AGGREGATES_FILENAME
+    aggregates_file = Path(aggregates_filename)
+
+    if not aggregates_file.exists():
+        return Aggregates()
+
+    with aggregates_file.open() as f_handler:
+        return from_dict(data_class=Aggregates, data=json.load(f_handler))
+
+
+def write_aggregates(
+    aggregates: Aggregates, aggregates_filename: Optional[str] = None
+) -> None:
+    if aggregates_filename is None:
+        aggregates_filename = DEFAULT_AGGREGATES_FILENAME
+
+    with atomic_write(aggregates_filename) as f_handler:
+        json.dump(asdict(aggregates), f_handler)
+
+
+def write_aggregates_js(
+    aggregates: Aggregates, ui_basedir: Optional[str] = None
+) -> None:
+    """Export the aggregates for the web UI, with best/median times and averages"""
+
+    if not ui_basedir:
+        ui_basedir = DEFAULT_UI_BASEDIR
+    segments = {
+        uid: {
+            "count": len(stats.durations),
+            "best": get_best_duration(stats),
+            "median": get_median_duration(stats),
+            **{
+                metric_name: get_metric_average(stats, metric_name)
+
+                for metric_name in stats.metric_counts
+            },
+        }
+
+        for uid, stats in aggregates.segments.items()
+    }
+
+    with atomic_write(f"{ui_basedir}/userdata/aggregates.js") as f_handler:
+        f_handler.write("aggregates = ")
+        json.dump(
+            {"periods": asdict(aggregates)["periods"], "segments": segments}, f_handler
+        )
+        f_handler.write(";\n")
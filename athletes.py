@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+Update the workspaces of several athletes in parallel (cf. `workspacelib.py`):
+
+- `athletes/<athlete>/`: activity files (`activities/`) and outputs of
+  `fit2segments.py` (`segments.json`, `activities.json`, `ui/userdata`...)
+- `~/.cache/fit2segments/athletes/<athlete>`: cached tracks of each athlete
+- `athletes/leaderboards.json`: best time of each athlete on each segment
+
+All athletes share the segment definitions, loaded and indexed once. Each worker
+process updates one workspace at a time, as `fit2segments.py` would from it. With
+`--init`, the workspaces of the given athletes are created first.
+"""
+
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Optional, Tuple
+
+import fit2segments
+from fitlib import (
+    DEFAULT_CACHE_PATH,
+    DEFAULT_SEGMENT_DEFINITIONS_FILENAME,
+    Segment_definition,
+    get_logger,
+    load_segment_definitions,
+)
+from nestinglib import index_nested_definitions
+from workspacelib import (
+    DEFAULT_WORKSPACES_PATH,
+    Workspace,
+    build_leaderboards,
+    get_workspace,
+    init_workspace,
+    list_workspaces,
+    write_leaderboards,
+)
+
+# Indexed segment definitions of the worker processes, cf. `init_worker()`
+_SEGMENT_DEFINITIONS: List[Segment_definition] = []
+
+
+def parse_args() -> argparse.Namespace:
+    """ Call me with args = parse_args() """
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    # Positional arguments
+    parser.add_argument(
+        "athletes", nargs="*", help="Athletes to update (default: all workspaces)"
+    )
+
+    # Options
+    parser.add_argument(
+        "--workspaces",
+        default=DEFAULT_WORKSPACES_PATH,
+        help="Directory of the athlete workspaces",
+    )
+    parser.add_argument(
+        "--cache",
+        default=DEFAULT_CACHE_PATH,
+        help="Cache directory, holding a subdirectory per athlete",
+    )
+    parser.add_argument(
+        "--segment-definitions",
+        default=DEFAULT_SEGMENT_DEFINITIONS_FILENAME,
+        metavar="FILE",
+        help="Segment definition file, shared by all athletes",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--writers",
+        type=int,
+        default=2,
+        help="Number of threads writing output files, per worker process",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        default=None,
+        metavar="MB",
+        help="Dump results and release buffers when memory usage exceeds MB",
+    )
+
+    # Boolean
+    parser.add_argument(
+        "--init", help="Create the workspaces of the athletes", action="store_true"
+    )
+    parser.add_argument(
+        "--packed-cache",
+        help="Cache tracks in a few pack files, instead of one file per track",
+        action="store_true",
+    )
+    parser.add_argument("--verbose", "-v", help="Verbose mode", action="store_true")
+
+    args: argparse.Namespace = parser.parse_args()
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    return args
+
+
+def init_worker(segment_definitions: List[Segment_definition], verbose: bool) -> None:
+    """Set up a worker process, once for all the workspaces it updates"""
+    global _SEGMENT_DEFINITIONS
+
+    _SEGMENT_DEFINITIONS = segment_definitions
+    fit2segments.logger = get_logger(
+        "fit2seg", level=logging.DEBUG if verbose else logging.WARNING
+    )
+    # No-op if inherited from the parent process
+    fit2segments.get_gate_index(segment_definitions, fit2segments.MATCH_THRESHOLD)
+
+
+def update_workspace(
+    workspace: Workspace, args: argparse.Namespace
+) -> Tuple[str, Optional[str]]:
+    """Update the outputs of a workspace, return the athlete and the error, if any
+
+    Errors are returned rather than raised, so that one athlete does not stop the
+    others.
+    """
+    workspace_args = argparse.Namespace(
+        fitfiles=[workspace.activities_path],
+        cache=workspace.cache_path,
+        diagnose=[],
+        match_workers=1,
+        max_memory=args.max_memory,
+        no_result_cache=False,
+        output_dir=workspace.path,
+        packed_cache=args.packed_cache,
+        stream=False,
+        writers=args.writers,
+        verbose=args.verbose,
+    )
+
+    try:
+        fit2segments.run(_SEGMENT_DEFINITIONS, workspace_args)
+    except Exception as e:
+        return (workspace.athlete, f"{type(e).__name__}: {e}")
+
+    return (workspace.athlete, None)
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.init:
+        for athlete in args.athletes:
+            init_workspace(get_workspace(athlete, args.workspaces, args.cache))
+
+    all_workspaces = list_workspaces(args.workspaces, args.cache)
+    workspaces = [
+        w for w in all_workspaces if not args.athletes or w.athlete in args.athletes
+    ]
+    logger.warning("%s workspaces to update", len(workspaces))
+
+    segment_definitions = load_segment_definitions(args.segment_definitions)
+    index_nested_definitions(segment_definitions)
+    # Built once, before forking the worker processes
+    fit2segments.get_gate_index(segment_definitions, fit2segments.MATCH_THRESHOLD)
+
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        initializer=init_worker,
+        initargs=(segment_definitions, args.verbose),
+    ) as executor:
+        futures = [executor.submit(update_workspace, w, args) for w in workspaces]
+
+        for future in as_completed(futures):
+            athlete, error = future.result()
+
+            if error:
+                logger.critical("%s: %s", athlete, error)
+
+                continue
+
+            logger.info("Updated %s", athlete)
+
+    # From all workspaces, updated or not
+    write_leaderboards(build_leaderboards(all_workspaces), args.workspaces)
+
+
+if __name__ == "__main__":
+    logger = get_logger(__name__)
+    args = parse_args()
+    main(args)
+    logging.debug("Done")
@@ -0,0 +1,454 @@
+"""
+Mean-maximal ("best efforts") curves of heart rate, cadence and speed.
+
+A curve holds, for a set of window durations, the best average of a metric over any
+window of that duration. Values are first resampled at 1 Hz, then each duration is
+evaluated in O(n) with prefix sums. Durations grow geometrically, so that a curve
+costs O(n log n) per activity.
+
+Activity curves are cached next to the track cache. Envelopes hold, for each
+duration, the best value over all activities of a period (all-time or per year),
+and are updated incrementally as activities are added.
+"""
+
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from itertools import accumulate
+from pathlib import Path
+from typing import Collection, Dict, List, Optional, Union
+
+from dacite import from_dict
+
+from fitlib import (
+    DEFAULT_CACHE_PATH,
+    DEFAULT_UI_BASEDIR,
+    Segment,
+    Track,
+    Track_point,
+    atomic_write,
+    load_cached_track,
+)
+from packlib import Pack_store
+
+DEFAULT_BEST_EFFORTS_FILENAME = "best_efforts.json"
+# Files whose curves are left to `warm_cache.py`, in the cache directory
+CURVES_QUEUE_FILENAME = "curves.queue"
+
+# Metric name: (track point field, unit conversion factor)
+# cf. <https://github.com/pcolby/bipolar/issues/74> for the speed conversion
+CURVE_METRICS = {
+    "heart_rate": ("heart_rate", 1.0),
+    "cadence": ("cadence", 1.0),
+    "speed": ("enhanced_speed", 3.6),
+}
+
+# Window durations, in seconds, roughly growing geometrically
+STANDARD_DURATIONS = (
+    [1, 2, 3, 5, 10, 15, 20, 30, 45]
+    + [60 * m for m in [1, 2, 3, 5, 10, 15, 20, 30, 45]]
+    + [3600 * h for h in [1, 2, 3, 4, 5, 6, 8, 10, 12, 18, 24, 36, 48, 72]]
+)
+
+
+@dataclass
+class Curve:
+    durations: List[int]
+    values: List[float]
+
+
+@dataclass
+class Envelope:
+    durations: List[int]
+    values: List[float]
+    activity_names: List[str]
+
+
+@dataclass
+class Best_efforts:
+    # Activities already taken into account in the envelopes
+    activity_names: List[str] = field(default_factory=list)
+    # Period ("all" or year) -> metric -> envelope
+    envelopes: Dict[str, Dict[str, Envelope]] = field(default_factory=dict)
+
+
+def get_durations(length: int) -> List[int]:
+    """Standard window durations shorter than `length`, then `length` itself"""
+
+    return [d for d in STANDARD_DURATIONS if d < length] + [length]
+
+
+def resample(track_points: List[Track_point], field_name: str) -> List[float]:
+    """Resample a field at 1 Hz
+
+    Like segment metrics, each value is repeated for the number of seconds elapsed
+    since the previous point (if time goes forward). Missing values are replaced by
+    the previous one, or skipped if there is none yet.
+    """
+    to_return: List[float] = []
+    last_value: Optional[float] = None
+
+    for previous, track_point in zip(track_points, track_points[1:]):
+        value = getattr(track_point, field_name, None)
+
+        if value is None:
+            value = last_value
+
+        if value is None:
+            continue
+
+        last_value = value
+        elapsed = int((track_point.timestamp - previous.timestamp).total_seconds())
+        to_return.extend(max(elapsed, 0) * [value])
+
+    return to_return
+
+
+def mean_max(values: List[float], durations: List[int]) -> Curve:
+    """Best average of `values` over any window of each of `durations` samples"""
+    prefix_sums = [0.0] + list(accumulate(values))
+    kept_durations = []
+    best_values = []
+
+    for duration in durations:
+        if duration > len(values) or duration <= 0:
+            continue
+
+        best_sum = max(
+            upper - lower for lower, upper in zip(prefix_sums, prefix_sums[duration:])
+        )
+        kept_durations.append(duration)
+        best_values.append(best_sum / duration)
+
+    return Curve(durations=kept_durations, values=best_values)
+
+
+def compute_curves(track_points: List[Track_point]) -> Dict[str, Curve]:
+    """Compute the curves of all metrics available in `track_points`"""
+    to_return = {}
+
+    for metric_name, (field_name, factor) in CURVE_METRICS.items():
+        values = resample(track_points, field_name)
+
+        if not values:
+            continue
+
+        if factor != 1.0:
+            values = [v * factor for v in values]
+
+        to_return[metric_name] = mean_max(values, get_durations(len(values)))
+
+    return to_return
+
+
+def get_curves_filename(
+    activity_name: str, cache_path_name: Optional[str] = None
+) -> Path:
+    if not cache_path_name:
+        cache_path_name = DEFAULT_CACHE_PATH
+
+    return Path(cache_path_name) / f"{activity_name}.curves.json"
+
+
+def load_cached_curves(
+    activity_name: str,
+    cache_path_name: Optional[str] = None,
+    fitfilename: Optional[str] = None,
+) -> Optional[Dict[str, Curve]]:
+    """Return the cached curves of an activity, if any
+
+    If `fitfilename` is given, curves older than it (e.g. re-exported since) are
+    ignored, as cached tracks are.
+    """
+    cached_file = get_curves_filename(activity_name, cache_path_name)
+
+    if not cached_file.exists():
+        return None
+
+    if (
+        fitfilename is not None
+        and Path(fitfilename).exists()
+        and cached_file.stat().st_mtime < Path(fitfilename).stat().st_mtime
+    ):
+        return None
+
+    with cached_file.open() as f_handler:
+        return {
+            metric_name: from_dict(data_class=Curve, data=data)
+
+            for metric_name, data in json.load(f_handler).items()
+        }
+
+
+def load_curves(
+    track: Track,
+    cache_path_name: Optional[str] = None,
+    fitfilename: Optional[str] = None,
+) -> Dict[str, Curve]:
+    """Return the curves of a track, computing and caching them if needed
+
+    If `fitfilename` is given, curves cached before its last change are computed
+    again.
+    """
+    to_return = load_cached_curves(track.name, cache_path_name, fitfilename)
+
+    if to_return is None:
+        to_return = compute_curves(track.track_points)
+
+        curves_file = get_curves_filename(track.name, cache_path_name)
+
+        with atomic_write(curves_file) as f_handler:
+            json.dump({k: asdict(v) for k, v in to_return.items()}, f_handler)
+
+    return to_return
+
+
+def get_curves_queue_filename(cache_path_name: Optional[str] = None) -> Path:
+    if not cache_path_name:
+        cache_path_name = DEFAULT_CACHE_PATH
+
+    return Path(cache_path_name) / CURVES_QUEUE_FILENAME
+
+
+def queue_curves(fitfilename: str, cache_path_name: Optional[str] = None) -> None:
+    """Queue a file whose curves are missing, for `warm_cache.py`
+
+    Computing curves requires decoding all the records of a file: files that are
+    not loaded anyway (e.g. home trainer rides, summarized from their sessions) are
+    queued instead, and their curves are added to the envelopes by the next run.
+    """
+    queue_file = get_curves_queue_filename(cache_path_name)
+    queue_file.parent.mkdir(parents=True, exist_ok=True)
+
+    with queue_file.open("a") as f_handler:
+        f_handler.write(f"{Path(fitfilename).resolve()}\n")
+
+
+def pop_curves_queue(cache_path_name: Optional[str] = None) -> List[str]:
+    """Return the files queued by `queue_curves()`, emptying the queue
+
+    The queue is renamed before being read, so that files queued meanwhile are
+    kept for the next time.
+    """
+    queue_file = get_curves_queue_filename(cache_path_name)
+    taken_file = queue_file.with_name(f"{queue_file.name}.{os.getpid()}")
+
+    try:
+        queue_file.replace(taken_file)
+    except FileNotFoundError:
+        return []
+
+    to_return = list(dict.fromkeys(taken_file.read_text().split("\n")))
+    taken_file.unlink()
+
+    return [filename for filename in to_return if filename]
+
+
+def update_envelope(envelope: Envelope, curve: Curve, activity_name: str) -> None:
+    """Merge the standard durations of an activity curve into an envelope"""
+    best = {
+        d: (v, n)
+
+        for d, v, n in zip(
+            envelope.durations, envelope.values, envelope.activity_names
+        )
+    }
+
+    for duration, value in zip(curve.durations, curve.values):
+        if duration not in STANDARD_DURATIONS:
+            # Skip the full length of the activity
+            continue
+
+        if duration not in best or value > best[duration][0]:
+            best[duration] = (value, activity_name)
+
+    envelope.durations = sorted(best)
+    envelope.values = [best[d][0] for d in envelope.durations]
+    envelope.activity_names = [best[d][1] for d in envelope.durations]
+
+
+def add_to_envelopes(
+    best_efforts: Best_efforts,
+    periods: Collection[str],
+    activity_name: str,
+    curves: Dict[str, Curve],
+) -> None:
+    for period in periods:
+        period_envelopes = best_efforts.envelopes.setdefault(period, {})
+
+        for metric_name, curve in curves.items():
+            envelope = period_envelopes.setdefault(
+                metric_name, Envelope(durations=[], values=[], activity_names=[])
+            )
+            update_envelope(envelope, curve, activity_name)
+
+
+def update_best_efforts(
+    best_efforts: Best_efforts,
+    activity_name: str,
+    start_time: datetime,
+    curves: Dict[str, Curve],
+    start_times: Optional[Dict[str, datetime]] = None,
+    cache_path_name: Optional[str] = None,
+) -> None:
+    """Add the curves of an activity to the all-time and yearly envelopes
+
+    If the activity is already listed in `activity_names` (e.g. re-imported), its
+    previous curves are removed first, cf. `remove_best_efforts()`.
+    """
+
+    if activity_name in best_efforts.activity_names:
+        remove_best_efforts(
+            best_efforts, {activity_name}, start_times or {}, cache_path_name
+        )
+
+    add_to_envelopes(best_efforts, ["all", str(start_time.year)], activity_name, curves)
+    best_efforts.activity_names.append(activity_name)
+
+
+def remove_best_efforts(
+    best_efforts: Best_efforts,
+    activity_names: Collection[str],
+    start_times: Dict[str, datetime],
+    cache_path_name: Optional[str] = None,
+) -> None:
+    """Remove activities (e.g. re-imported, or removed) from the envelopes
+
+    Envelopes only hold the best value of each duration: the periods where a removed
+    activity holds one are rebuilt from the cached curves of the other activities,
+    the years of which are given by `start_times`. Activities of these periods with
+    no start time or cached curves are unlisted, to be added again by a next run.
+    """
+    best_efforts.activity_names = [
+        name for name in best_efforts.activity_names if name not in activity_names
+    ]
+    stale_periods = {
+        period
+
+        for period, period_envelopes in best_efforts.envelopes.items()
+
+        if any(
+            name in activity_names
+
+            for envelope in period_envelopes.values()
+
+            for name in envelope.activity_names
+        )
+    }
+
+    if not stale_periods:
+        return
+
+    for period in stale_periods:
+        del best_efforts.envelopes[period]
+    kept_names = []
+
+    for name in best_efforts.activity_names:
+        start_time = start_times.get(name)
+
+        if start_time is None:
+            continue
+
+        periods = stale_periods & {"all", str(start_time.year)}
+
+        if periods:
+            curves = load_cached_curves(name, cache_path_name)
+
+            if curves is None:
+                continue
+
+            add_to_envelopes(best_efforts, periods, name, curves)
+        kept_names.append(name)
+    best_efforts.activity_names = kept_names
+
+
+def is_curves_outdated(
+    activity_name: str, fitfilename: str, cache_path_name: Optional[str] = None
+) -> bool:
+    """Whether the activity file was modified (e.g. re-exported) since its curves"""
+    cached_file = get_curves_filename(activity_name, cache_path_name)
+
+    try:
+        return cached_file.stat().st_mtime < Path(fitfilename).stat().st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def compute_segment_curves(
+    segment: Segment,
+    cache_path_name: Optional[str] = None,
+    packs: Optional[Pack_store] = None,
+) -> Optional[Dict[str, Curve]]:
+    """Compute the curves of a segment attempt, from the cached track
+
+    Tracks are looked up in `packs` if given, as cached by `fit2segments.py
+    --packed-cache`.
+    """
+    track = (
+        packs.get(segment.activity_name)
+        if packs
+        else load_cached_track(segment.activity_name, cache_path_name)
+    )
+
+    if track is None:
+        return None
+
+    stop_time = segment.start_time + segment.duration
+
+    return compute_curves(
+        [
+            tp
+
+            for tp in track.track_points
+
+            if segment.start_time <= tp.timestamp <= stop_time
+        ]
+    )
+
+
+def get_best_value(
+    curve: Union[Curve, Envelope], duration: int
+) -> Optional[float]:
+    """Value of a curve (or envelope) for a duration, if available"""
+
+    if duration not in curve.durations:
+        return None
+
+    return curve.values[curve.durations.index(duration)]
+
+
+def load_best_efforts(best_efforts_filename: Optional[str] = None) -> Best_efforts:
+    if best_efforts_filename is None:
+        best_efforts_filename = DEFAULT_BEST_EFFORTS_FILENAME
+    best_efforts_file = Path(best_efforts_filename)
+
+    if not best_efforts_file.exists():
+        return Best_efforts()
+
+    with best_efforts_file.open() as f_handler:
+        return from_dict(data_class=Best_efforts, data=json.load(f_handler))
+
+
+def write_best_efforts(
+    best_efforts: Best_efforts, best_efforts_filename: Optional[str] = None
+) -> None:
+    if best_efforts_filename is None:
+        best_efforts_filename = DEFAULT_BEST_EFFORTS_FILENAME
+
+    with atomic_write(best_efforts_filename) as f_handler:
+        json.dump(asdict(best_efforts), f_handler)
+
+
+def write_best_efforts_js(
+    best_efforts: Best_efforts, ui_basedir: Optional[str] = None
+) -> None:
+    """Export the envelopes for the web UI"""
+
+    if not ui_basedir:
+        ui_basedir = DEFAULT_UI_BASEDIR
+
+    with atomic_write(f"{ui_basedir}/userdata/best_efforts.js") as f_handler:
+        f_handler.write("best_efforts = ")
+        json.dump(asdict(best_efforts)["envelopes"], f_handler)
+        f_handler.write(";\n")
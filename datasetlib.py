@@ -0,0 +1,319 @@
+"""
+Columnar dataset of all cached tracks, for ad-hoc analysis across activities.
+
+The track points of all activities are concatenated, in one raw float64 file per
+track point field (`<dataset>/<field>.f64`, same encoding as the columns of the
+track files of `tracklib.py`: NaN for missing values, timestamps in seconds since
+the epoch), so that loading the whole archive is one `mmap` per field, e.g. with
+NumPy:
+`numpy.memmap("dataset/heart_rate.f64", dtype="float64", mode="r")`.
+
+- `index.json`: byte order, and the offset table of the activities (name, first
+  point and number of points, modification time of the source file)
+- `attempts.json`: offset table of the segment attempts (segment, activity, first
+  and last points), rebuilt from `segments.json` on each export
+
+New activities are appended to the columns; the index is written last, so that
+points appended by an interrupted export are truncated by the next one. If an
+included activity changed, the dataset is rebuilt. Activities whose file was removed
+are only dropped by a rebuild.
+"""
+
+import json
+import mmap
+import shutil
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from dacite import from_dict
+
+from fitlib import Segment, Track, _decode_columns, _encode_columns, atomic_write
+from tracklib import EPOCH, TRACK_FIELDS, get_columns
+
+DEFAULT_DATASET_PATH = "dataset"
+DATASET_INDEX_FILENAME = "index.json"
+ATTEMPTS_FILENAME = "attempts.json"
+COLUMN_SUFFIX = ".f64"
+
+
+@dataclass
+class Dataset_activity:
+    # Offset of the first point in the columns, and number of points
+    first: int
+    length: int
+    mtime: float
+    name: str
+
+
+@dataclass
+class Attempt:
+    # Index of the activity in the index, first and last (excluded) points
+    activity: int
+    first: int
+    last: int
+    segment_name: str
+    segment_uid: str
+
+
+@dataclass
+class Dataset_index:
+    activities: List[Dataset_activity] = field(default_factory=list)
+    byteorder: str = sys.byteorder
+    fields: List[str] = field(default_factory=lambda: list(TRACK_FIELDS))
+
+    @property
+    def length(self) -> int:
+        if not self.activities:
+            return 0
+        last_activity = self.activities[-1]
+
+        return last_activity.first + last_activity.length
+
+
+def get_column_filename(dataset_path: Path, field_name: str) -> Path:
+    return dataset_path / f"{field_name}{COLUMN_SUFFIX}"
+
+
+def load_dataset_index(dataset_path_name: Optional[str] = None) -> Dataset_index:
+    if not dataset_path_name:
+        dataset_path_name = DEFAULT_DATASET_PATH
+    index_file = Path(dataset_path_name) / DATASET_INDEX_FILENAME
+
+    if not index_file.exists():
+        return Dataset_index()
+
+    with index_file.open() as f_handler:
+        return from_dict(data_class=Dataset_index, data=json.load(f_handler))
+
+
+class Dataset_writer:
+    """Columns of the exported activities, appended on `flush()`"""
+
+    def __init__(self, dataset_path_name: Optional[str] = None) -> None:
+        if not dataset_path_name:
+            dataset_path_name = DEFAULT_DATASET_PATH
+        self.dataset_path = Path(dataset_path_name)
+        self.index = load_dataset_index(dataset_path_name)
+        self.names = {a.name for a in self.index.activities}
+        # Columns of the activities added, not written yet
+        self.pending: Dict[str, array] = {f: array("d") for f in TRACK_FIELDS}
+        self.dirty = False
+
+    def is_outdated(self, mtimes: Dict[str, float]) -> bool:
+        """Whether included activities changed, or columns are missing
+
+        `mtimes` maps the name of activities to the modification time of their
+        source file: only the included activities among them are checked, so that
+        datasets can be updated from a subset of the files.
+        """
+
+        if (self.index.byteorder, self.index.fields) != (sys.byteorder, TRACK_FIELDS):
+            return True
+
+        for field_name in TRACK_FIELDS:
+            column_file = get_column_filename(self.dataset_path, field_name)
+
+            if self.index.length and (
+                not column_file.exists()
+                or column_file.stat().st_size < 8 * self.index.length
+            ):
+                return True
+
+        return any(
+            a.name in mtimes and mtimes[a.name] != a.mtime
+
+            for a in self.index.activities
+        )
+
+    def clear(self) -> None:
+        """Remove all activities, to rebuild the dataset from scratch"""
+
+        if self.dataset_path.exists():
+            shutil.rmtree(self.dataset_path)
+        self.index = Dataset_index()
+        self.names = set()
+        self.pending = {f: array("d") for f in TRACK_FIELDS}
+        self.dirty = True
+
+    def add(self, track: Track, mtime: float) -> None:
+        columns = get_columns(track)
+
+        for field_name in TRACK_FIELDS:
+            self.pending[field_name].extend(columns[field_name])
+        self.index.activities.append(
+            Dataset_activity(
+                first=self.index.length,
+                length=len(track.track_points),
+                mtime=mtime,
+                name=track.name,
+            )
+        )
+        self.names.add(track.name)
+        self.dirty = True
+
+    def flush(self) -> None:
+        """Append the pending columns, then write the index that commits them"""
+
+        if not self.dirty:
+            return
+
+        self.dataset_path.mkdir(parents=True, exist_ok=True)
+        committed = self.index.length - len(self.pending["timestamp"])
+
+        for field_name in TRACK_FIELDS:
+            column_file = get_column_filename(self.dataset_path, field_name)
+
+            with column_file.open("ab") as f_handler:
+                # Drop the points of an interrupted export, if any
+                f_handler.truncate(8 * committed)
+                self.pending[field_name].tofile(f_handler)
+
+        with atomic_write(self.dataset_path / DATASET_INDEX_FILENAME) as f_handler:
+            json.dump(asdict(self.index), f_handler)
+        self.pending = {f: array("d") for f in TRACK_FIELDS}
+        self.dirty = False
+
+
+class Dataset:
+    """Columns of all activities, as float64 views on memory-mapped files
+
+    `columns[field]` is indexable like a list, without copying. The points of an
+    activity or of an attempt are `first` to `last` (excluded), cf. `get_columns()`.
+    Views returned by `get_columns()` must be released before `close()`.
+    """
+
+    def __init__(
+        self,
+        index: Dataset_index,
+        attempts: List[Attempt],
+        columns: Dict[str, Sequence[float]],
+        mmaps: List[mmap.mmap],
+    ) -> None:
+        self.index = index
+        self.attempts = attempts
+        self.columns = columns
+        self._mmaps = mmaps
+
+    def __len__(self) -> int:
+        return self.index.length
+
+    def get_activity(self, name: str) -> Dataset_activity:
+        return next(a for a in self.index.activities if a.name == name)
+
+    def get_columns(self, first: int, last: int) -> Dict[str, Sequence[float]]:
+        return {
+            field_name: column[first:last]
+
+            for field_name, column in self.columns.items()
+        }
+
+    def close(self) -> None:
+        for column in self.columns.values():
+            if isinstance(column, memoryview):
+                column.release()
+        self.columns = {}
+
+        for mapped in self._mmaps:
+            mapped.close()
+        self._mmaps = []
+
+
+def open_dataset(dataset_path_name: Optional[str] = None) -> Dataset:
+    """Map the columns of the dataset, without reading them"""
+
+    if not dataset_path_name:
+        dataset_path_name = DEFAULT_DATASET_PATH
+    dataset_path = Path(dataset_path_name)
+    index = load_dataset_index(dataset_path_name)
+    length = index.length
+    columns: Dict[str, Sequence[float]] = {}
+    mmaps: List[mmap.mmap] = []
+
+    for field_name in index.fields:
+        if not length:
+            columns[field_name] = array("d")
+
+            continue
+
+        with get_column_filename(dataset_path, field_name).open("rb") as f_handler:
+            mapped = mmap.mmap(f_handler.fileno(), 0, access=mmap.ACCESS_READ)
+        mmaps.append(mapped)
+        # Ignore the points of an interrupted export, if any
+        view = memoryview(mapped)
+        column = view[: 8 * length].cast("d")
+        view.release()
+
+        if index.byteorder != sys.byteorder:
+            # Foreign file: swap a private copy
+            swapped = array("d", column)
+            swapped.byteswap()
+            column.release()
+            columns[field_name] = swapped
+        else:
+            columns[field_name] = column
+
+    attempts: List[Attempt] = []
+    attempts_file = dataset_path / ATTEMPTS_FILENAME
+
+    if attempts_file.exists():
+        with attempts_file.open() as f_handler:
+            attempts = _decode_columns(json.load(f_handler), Attempt)
+
+    return Dataset(index, attempts, columns, mmaps)
+
+
+def get_attempt_points(
+    timestamps: Sequence[float], activity: Dataset_activity, segment: Segment
+) -> Tuple[int, int]:
+    """First and last (excluded) points of a segment attempt, in the columns"""
+    first = activity.first
+    last = activity.first + activity.length
+    start = (segment.start_time - EPOCH).total_seconds()
+    stop = start + segment.duration.total_seconds()
+
+    return (
+        bisect_left(timestamps, start, first, last),
+        bisect_right(timestamps, stop, first, last),
+    )
+
+
+def build_attempts(dataset: Dataset, segments: Iterable[Segment]) -> List[Attempt]:
+    """Attempts of the segments of the activities in the dataset"""
+    activity_indexes = {a.name: idx for idx, a in enumerate(dataset.index.activities)}
+    to_return = []
+
+    for segment in segments:
+        if segment.activity_name not in activity_indexes:
+            continue
+
+        activity_index = activity_indexes[segment.activity_name]
+        first, last = get_attempt_points(
+            dataset.columns["timestamp"],
+            dataset.index.activities[activity_index],
+            segment,
+        )
+        to_return.append(
+            Attempt(
+                activity=activity_index,
+                first=first,
+                last=last,
+                segment_name=segment.segment_name,
+                segment_uid=segment.segment_uid,
+            )
+        )
+
+    return to_return
+
+
+def write_attempts(
+    attempts: List[Attempt], dataset_path_name: Optional[str] = None
+) -> None:
+    if not dataset_path_name:
+        dataset_path_name = DEFAULT_DATASET_PATH
+
+    with atomic_write(Path(dataset_path_name) / ATTEMPTS_FILENAME) as f_handler:
+        json.dump(_encode_columns(attempts, Attempt), f_handler, separators=(",", ":"))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Export all activities as a columnar dataset, for ad-hoc analysis (cf. `datasetlib.py`):
+
+- `dataset/<field>.f64`: float64 column of each track point field, over all
+  activities (NaN for missing values, timestamps in seconds since the epoch)
+- `dataset/index.json`: offset table of the activities in the columns
+- `dataset/attempts.json`: offset table of the segment attempts of `segments.json`
+
+Only activities not yet in the dataset are loaded (from the cache, if possible), and
+appended to the columns. The dataset is rebuilt if an included activity changed.
+Activities whose file was removed stay in the dataset until it is rebuilt with
+`--rebuild`.
+"""
+
+import argparse
+import logging
+from pathlib import Path
+from typing import Dict
+
+from dacite.exceptions import MissingValueError
+
+from datasetlib import (
+    DEFAULT_DATASET_PATH,
+    Dataset_writer,
+    build_attempts,
+    open_dataset,
+    write_attempts,
+)
+from fitlib import (
+    DEFAULT_CACHE_PATH,
+    DEFAULT_SEGMENTS_FILENAME,
+    discover_activity_files,
+    filename2activityname,
+    get_logger,
+    load_file,
+    load_segments,
+)
+from packlib import Pack_store
+
+
+def parse_args() -> argparse.Namespace:
+    """ Call me with args = parse_args() """
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    # Positional arguments
+    parser.add_argument(
+        "fitfiles", nargs="+", help="FIT or GPX files, or directories to search"
+    )
+
+    # Options
+    parser.add_argument(
+        "--cache", default=DEFAULT_CACHE_PATH, help="Cache directory to read tracks"
+    )
+    parser.add_argument(
+        "--dataset", default=DEFAULT_DATASET_PATH, help="Directory of the dataset"
+    )
+    parser.add_argument(
+        "--segments",
+        default=DEFAULT_SEGMENTS_FILENAME,
+        metavar="FILE",
+        help="Segments file, whose attempts are indexed",
+    )
+
+    # Boolean
+    parser.add_argument(
+        "--packed-cache",
+        help="Read tracks from the pack files of the cache",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--rebuild",
+        help="Rebuild the dataset from scratch, e.g. to drop removed activities",
+        action="store_true",
+    )
+    parser.add_argument("--verbose", "-v", help="Verbose mode", action="store_true")
+
+    args: argparse.Namespace = parser.parse_args()
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    return args
+
+
+def main(args: argparse.Namespace) -> None:
+    filenames = list(discover_activity_files(args.fitfiles))
+    mtimes: Dict[str, float] = {
+        filename2activityname(f): Path(f).stat().st_mtime for f in filenames
+    }
+    dataset_writer = Dataset_writer(args.dataset)
+    packs = Pack_store(args.cache) if args.packed_cache else None
+
+    if args.rebuild or dataset_writer.is_outdated(mtimes):
+        logger.warning("Rebuilding the dataset")
+        dataset_writer.clear()
+
+    dump_every: int = 50
+    added = 0
+
+    for filename in filenames:
+        activity_name = filename2activityname(filename)
+
+        if activity_name in dataset_writer.names:
+            continue
+
+        try:
+            track = (
+                packs.load_file(filename) if packs else load_file(filename, args.cache)
+            )
+        except MissingValueError as e:
+            logger.critical("%s: %s", filename, str(e))
+
+            continue
+
+        dataset_writer.add(track, mtimes[activity_name])
+        added += 1
+        logger.info("Added %s", activity_name)
+
+        # Flush from time to time, to bound the pending columns
+        if added % dump_every == 0:
+            dataset_writer.flush()
+
+    dataset_writer.flush()
+
+    if packs:
+        packs.flush()
+
+    # Attempts are cheap to locate, and segments may have changed: always rebuilt
+    dataset = open_dataset(args.dataset)
+    attempts = build_attempts(dataset, load_segments(args.segments))
+    write_attempts(attempts, args.dataset)
+    logger.warning(
+        "%s activities added, %s activities (%s points) and %s attempts in the dataset",
+        added,
+        len(dataset.index.activities),
+        len(dataset),
+        len(attempts),
+    )
+    dataset.close()
+
+
+if __name__ == "__main__":
+    logger = get_logger(__name__)
+    args = parse_args()
+    main(args)
+    logging.debug("Done")
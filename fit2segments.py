@@ -1,50 +1,139 @@
 #!/usr/bin/env python
 """
-Parse a list of FIT files and generate the following output files:
+Parse a list of FIT (or GPX) files and generate the following output files:
 
 - `segments.json`: JSON file containing all segments and timings
 - `activities.json`: JSON file containing all activities
+- `ui/userdata/data.js`: JS file containing all activities
+- `ui/userdata/*.json`: JSON file containing the trace of each activity
+- `best_efforts.json`, `ui/userdata/best_efforts.js`: all-time and yearly best
+  efforts (mean-maximal curves) of heart rate, cadence and speed
+- `aggregates.json`, `ui/userdata/aggregates.js`: totals per year, month, week and
+  day, and statistics per segment, updated incrementally
+
+For the segments selected with `--diagnose` (or flagged with `debug`), the following
+diagnostic files are also written in `./csv`:
+
 - `segmentname_timings.csv`: CSV files containing date, kms, and duration (minutes)
-- `segmentname_debug.csv`: CSV file containing detected virtual start and stop points
-  (labeled by date), as well as segment reference (labeled w/segment name)
+- `segmentname_debug_start.csv`: CSV file containing detected virtual start and stop
+  points (labeled by date), as well as segment reference (labeled w/segment name)
+- `distances.activity.segmentname.csv`: CSV files containing the distances of track
+  points to the start and stop points of a segment, when close enough
 """
 
 
 import argparse
+import gc
 import logging
 import operator
-import re
+import os
+from array import array
+from bisect import bisect_left
+from concurrent.futures import Executor, ProcessPoolExecutor
+from copy import deepcopy
+from dataclasses import replace
 from datetime import datetime, timedelta
-from math import sqrt
-from statistics import mean, stdev
-from typing import List, Optional, TextIO, Tuple, Union
+from math import isnan, radians, sqrt
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
 
 from dacite import from_dict
 from dacite.exceptions import MissingValueError
 
+from aggregatelib import (
+    DEFAULT_AGGREGATES_FILENAME,
+    Aggregates,
+    add_activity,
+    add_segment,
+    build_aggregates,
+    is_consistent,
+    load_aggregates,
+    remove_activity,
+    write_aggregates,
+    write_aggregates_js,
+)
+from curvelib import (
+    DEFAULT_BEST_EFFORTS_FILENAME,
+    Best_efforts,
+    is_curves_outdated,
+    load_best_efforts,
+    load_cached_curves,
+    load_curves,
+    queue_curves,
+    remove_best_efforts,
+    update_best_efforts,
+    write_best_efforts,
+    write_best_efforts_js,
+)
 from fitlib import (
+    DEFAULT_ACTIVITIES_FILENAME,
+    DEFAULT_CACHE_PATH,
+    DEFAULT_CSV_DIR,
+    DEFAULT_SEGMENT_DEFINITIONS_FILENAME,
+    DEFAULT_SEGMENTS_FILENAME,
+    DEFAULT_UI_BASEDIR,
+    EARTH_RADIUS,
+    SEMICIRCLES_TO_DEGREES,
     Activity,
+    Diagnostics,
     Matched_track_point,
-    Metric,
+    Output_writer,
     Segment,
     Segment_definition,
     Segment_definition_point,
     Track,
     Track_point,
+    discover_activity_files,
     filename2activityname,
+    get_elevation_changes,
     get_logger,
-    get_segment_debug_handler,
-    get_segment_tag,
-    get_segment_timing_handler,
+    get_memory_usage,
+    get_moving_time,
+    get_moving_times,
+    get_ui_coordinates,
+    get_ui_trace_filename,
+    iter_track_points,
     load_activities,
     load_file,
     load_segment_definitions,
     load_segments,
-    semicircles_to_degrees,
     write_activities,
     write_data_js,
     write_segments,
+    write_ui_coordinates,
 )
+from metriclib import compute_metrics
+from nestinglib import index_nested_definitions, index_nested_segments
+from packlib import Pack_store
+from profilelib import Profile_store
+from resultlib import Match_result, Result_store
+from summarylib import Fit_summary, read_fit_summary
+from tracklib import Track_handle, get_track_handle
+
+# Version of the matching and of the segment metrics, to bump when they change:
+# match results cached with another version are not reused
+MATCHER_VERSION = 1
+# Max distance, in semicircles, between a track point and a start/stop point
+MATCH_THRESHOLD = 5000
+# Max time between consecutive candidates of a group, cf. `select_virtual_points`
+MAX_GROUP_GAP = timedelta(seconds=10)
+# Coarse scan of tracks: a coarse cell is COARSE_FACTOR x COARSE_FACTOR gate cells,
+# and blocks of points span about a coarse cell at MAX_PLAUSIBLE_SPEED (m/s)
+COARSE_FACTOR = 16
+MAX_PLAUSIBLE_SPEED = 30.0
+# Gate indexes kept by get_gate_index(), for as many sets of segment definitions
+MAX_GATE_INDEXES = 16
+# Tracks of at least LONG_TRACK_POINTS points (about 14 h at 1 Hz) are scanned in
+# parallel, by chunks of MATCH_CHUNK_DURATION, cf. `find_candidates_in_chunks()`
+LONG_TRACK_POINTS = 50000
+MATCH_CHUNK_DURATION = timedelta(hours=2)
+# Segment definitions of a match worker process, by uid, cf. `init_match_worker()`
+_SEGMENT_DEFINITIONS: Dict[str, Segment_definition] = {}
+# Growth of the memory usage, in bytes, between dumps beyond the --max-memory ceiling
+MEMORY_DUMP_GROWTH = 64 * 2 ** 20
+# Segments released at the ceiling are written in this cache subdirectory
+SPILL_DIRNAME = "spill"
+_GATE_INDEXES: Dict[Tuple[Tuple[str, ...], int], Any] = {}
 
 
 def parse_args() -> argparse.Namespace:
@@ -64,9 +153,73 @@ def parse_args() -> argparse.Namespace:
     # )
 
     # Positional arguments
-    parser.add_argument("fitfiles", nargs="+", help="FIT files")
+    parser.add_argument(
+        "fitfiles",
+        nargs="+",
+        help="FIT or GPX files, or directories to search for FIT and GPX files",
+    )
+
+    # Options
+    parser.add_argument(
+        "--cache", default=DEFAULT_CACHE_PATH, help="Cache directory of the tracks"
+    )
+    parser.add_argument(
+        "--segment-definitions",
+        default=DEFAULT_SEGMENT_DEFINITIONS_FILENAME,
+        metavar="FILE",
+        help="Segment definition file",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default=".",
+        help="Directory of the outputs: store files, web UI data and diagnostics",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        default=None,
+        metavar="MB",
+        help="Dump results and release buffers when memory usage exceeds MB",
+    )
+    parser.add_argument(
+        "--writers",
+        type=int,
+        default=2,
+        help="Number of threads writing output files in background (0: no thread)",
+    )
+    parser.add_argument(
+        "--match-workers",
+        type=int,
+        default=None,
+        help="Number of processes matching long tracks by chunks (default: number "
+        "of CPUs, 1: no process)",
+    )
+    parser.add_argument(
+        "--diagnose",
+        "-d",
+        action="append",
+        default=[],
+        metavar="SEGMENT",
+        help="Write diagnostic CSV files for this segment (name or uid, or `all`)",
+    )
 
     # Boolean
+    parser.add_argument(
+        "--packed-cache",
+        help="Cache tracks in a few pack files, instead of one file per track",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no-result-cache",
+        help="Match files again, instead of looking up their cached match results",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stream",
+        help="Match FIT files with GPS and a session summary while decoding them, "
+        "without loading or caching their track",
+        action="store_true",
+    )
     parser.add_argument("--verbose", "-v", help="Verbose mode", action="store_true")
 
     args: argparse.Namespace = parser.parse_args()
@@ -98,8 +251,7 @@ def create_virtual_point(candidates: List[Matched_track_point]) -> Matched_track
 def select_virtual_points(
     candidates: List[Matched_track_point], category: Optional[str] = None
 ) -> List[Matched_track_point]:
-    # Group candidates by time, allowing at most `max_delta_time` between them
-    max_delta_time = timedelta(seconds=10)
+    # Group candidates by time, allowing at most `MAX_GROUP_GAP` between them
     prev_time: Optional[datetime] = None
     candidate_groups = []
     consecutive_points = []
@@ -111,7 +263,7 @@ def select_virtual_points(
         if prev_time:
             dist = vpoint.track_point.timestamp - prev_time
 
-            if dist < max_delta_time:
+            if dist < MAX_GROUP_GAP:
                 consecutive_points.append(vpoint)
             else:
                 if consecutive_points:
@@ -151,17 +303,6 @@ def get_challenges(
     return to_return
 
 
-def get_track_tag(track_name: str) -> str:
-    return re.sub(r"[^0-9]+", "", track_name)
-
-
-def get_csv_filename(track_name: str, segment_name: str) -> str:
-    segment_tag = get_segment_tag(segment_name)
-    track_tag = get_track_tag(track_name)
-
-    return f"./csv/distances.{track_tag}.{segment_tag}.csv"
-
-
 def distance(
     track_point: Track_point, segment_point: Segment_definition_point
 ) -> float:
@@ -174,53 +315,399 @@ def distance(
     return to_return
 
 
-def find_candidates(
-    track: List[Track_point], segpoint: Segment_definition_point, threshold: int
-) -> List[Matched_track_point]:
+def build_gate_grid(
+    segment_definitions: List[Segment_definition], cell_size: int
+) -> Dict[Tuple[int, int], List[Tuple[int, int, Segment_definition_point]]]:
+    """Bucket the start/stop points of all segment definitions in a square grid
+
+    Each cell maps to `(definition index, 0 for start / 1 for stop, point)` tuples.
+    With `cell_size` equal to the match threshold, all gates within the threshold
+    of a track point lie in the 3x3 cells around it.
+    """
+    grid: Dict[Tuple[int, int], List[Tuple[int, int, Segment_definition_point]]] = {}
+
+    for sd_idx, segment_definition in enumerate(segment_definitions):
+        for category, segpoint in enumerate(
+            [segment_definition.start, segment_definition.stop]
+        ):
+            cell = (
+                int(segpoint.latitude // cell_size),
+                int(segpoint.longitude // cell_size),
+            )
+            grid.setdefault(cell, []).append((sd_idx, category, segpoint))
 
-    return [
-        from_dict(
-            data_class=Matched_track_point,
-            data={"track_point": track_point, "dist_to_segment": dist, "idx": idx},
+    return grid
+
+
+def get_decimation(threshold: int) -> int:
+    """Number of track points per block of the coarse scan
+
+    A block covers about `COARSE_FACTOR` cells of the gate grid at
+    `MAX_PLAUSIBLE_SPEED` and 1 Hz recording, i.e. at most a few coarse cells. A
+    faster or sparser track only makes blocks larger, not results different.
+    """
+    threshold_meters = threshold * SEMICIRCLES_TO_DEGREES * radians(1) * EARTH_RADIUS
+
+    return max(1, int(COARSE_FACTOR * threshold_meters / MAX_PLAUSIBLE_SPEED))
+
+
+def build_coarse_cells(
+    grid: Dict[Tuple[int, int], List[Tuple[int, int, Segment_definition_point]]]
+) -> Set[Tuple[int, int]]:
+    """Coarse cells containing a fine cell next to (or at) a gate
+
+    Any track point within the threshold of a gate lies in such a coarse cell.
+    """
+
+    return {
+        ((cell_lat + d_lat) // COARSE_FACTOR, (cell_long + d_long) // COARSE_FACTOR)
+
+        for cell_lat, cell_long in grid
+
+        for d_lat in (-1, 0, 1)
+
+        for d_long in (-1, 0, 1)
+    }
+
+
+def get_gate_index(
+    segment_definitions: List[Segment_definition], threshold: int
+) -> Tuple[
+    Dict[Tuple[int, int], List[Tuple[int, int, Segment_definition_point]]],
+    Set[Tuple[int, int]],
+]:
+    """Gate grid and coarse cells of segment definitions, built once per set
+
+    Definitions do not change once loaded, so these are kept for the next tracks
+    (and, if built before forking worker processes, shared with them).
+    """
+    key = (tuple([sd.uid for sd in segment_definitions]), threshold)
+
+    if key not in _GATE_INDEXES:
+        if len(_GATE_INDEXES) >= MAX_GATE_INDEXES:
+            _GATE_INDEXES.clear()
+        grid = build_gate_grid(segment_definitions, threshold)
+        _GATE_INDEXES[key] = (grid, build_coarse_cells(grid))
+
+    return _GATE_INDEXES[key]
+
+
+def scan_gates(
+    latitudes: Sequence[float],
+    longitudes: Sequence[float],
+    segment_definitions: List[Segment_definition],
+    threshold: int,
+    offset: int = 0,
+) -> List[Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]]:
+    """Find the points within the threshold of the start/stop of each definition
+
+    Returns, per segment definition, the `(index + offset, distance)` of the start
+    and stop candidates. Only coordinates are needed, so that worker processes can
+    scan chunks of a track, cf. `find_candidates_in_chunks()`.
+
+    The points are first scanned by blocks of `get_decimation()` points: the
+    bounding box of a block is checked against the coarse cells around gates, and
+    only the blocks that may come within the threshold of a gate are scanned point
+    by point. Skipped blocks have no point in the 3x3 fine cells around a gate, so
+    the candidates are exactly those of a full scan.
+    """
+    grid, coarse_cells = get_gate_index(segment_definitions, threshold)
+    to_return: List[Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]] = [
+        ([], []) for _ in segment_definitions
+    ]
+    neighbours = [(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1)]
+    block_size = get_decimation(threshold)
+    coarse_size = threshold * COARSE_FACTOR
+
+    for first in range(0, len(latitudes), block_size):
+        last = min(first + block_size, len(latitudes))
+        block_latitudes = latitudes[first:last]
+        block_longitudes = longitudes[first:last]
+        assert all(block_latitudes) and all(block_longitudes)
+        lat_range = range(
+            int(min(block_latitudes) // coarse_size),
+            int(max(block_latitudes) // coarse_size) + 1,
         )
+        long_range = range(
+            int(min(block_longitudes) // coarse_size),
+            int(max(block_longitudes) // coarse_size) + 1,
+        )
+
+        # Large boxes (e.g. GPS jumps) are not worth checking
+        if len(lat_range) * len(long_range) <= 9 and not any(
+            (coarse_lat, coarse_long) in coarse_cells
+
+            for coarse_lat in lat_range
+
+            for coarse_long in long_range
+        ):
+            continue
+
+        for idx in range(first, last):
+            latitude, longitude = latitudes[idx], longitudes[idx]
+            cell_lat = int(latitude // threshold)
+            cell_long = int(longitude // threshold)
+
+            for d_lat, d_long in neighbours:
+                for sd_idx, category, segpoint in grid.get(
+                    (cell_lat + d_lat, cell_long + d_long), []
+                ):
+                    # Same computation as `distance()`
+                    dist = int(
+                        sqrt(
+                            (latitude - segpoint.latitude) ** 2
+                            + (longitude - segpoint.longitude) ** 2
+                        )
+                    )
+
+                    if dist < threshold:
+                        to_return[sd_idx][category].append((idx + offset, dist))
+
+    return to_return
+
 
-        for idx, track_point in enumerate(track)
+def get_candidates(
+    track: List[Track_point],
+    hits: List[Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]],
+) -> List[Tuple[List[Matched_track_point], List[Matched_track_point]]]:
+    """Build the candidates found by `scan_gates()`, from the points of the track"""
 
-        if (dist := int(distance(track_point, segpoint))) < threshold
+    return [
+        (
+            [
+                Matched_track_point(
+                    category=None, dist_to_segment=dist, idx=idx, track_point=track[idx]
+                )
+
+                for idx, dist in start_hits
+            ],
+            [
+                Matched_track_point(
+                    category=None, dist_to_segment=dist, idx=idx, track_point=track[idx]
+                )
+
+                for idx, dist in stop_hits
+            ],
+        )
+
+        for start_hits, stop_hits in hits
     ]
 
 
-def compute_metric(
-    field_name: str, segment_points: List[Track_point]
-) -> Optional[Metric]:
+def get_coordinates(track: List[Track_point]) -> Tuple[array, array]:
+    """Latitudes and longitudes of points with a GPS fix, as float64 arrays
+
+    Arrays are pickled as raw bytes, when sent to worker processes.
+    """
+
+    return (
+        array("d", [tp.position_lat or 0 for tp in track]),
+        array("d", [tp.position_long or 0 for tp in track]),
+    )
+
+
+def find_candidates(
+    track: List[Track_point],
+    segment_definitions: List[Segment_definition],
+    threshold: int,
+) -> List[Tuple[List[Matched_track_point], List[Matched_track_point]]]:
+    """Find start and stop candidates of all segment definitions in one pass
+
+    Returns a `(start_candidates, stop_candidates)` pair per segment definition, in
+    the same order as `segment_definitions`, cf. `scan_gates()`.
+    """
+
+    return get_candidates(
+        track, scan_gates(*get_coordinates(track), segment_definitions, threshold)
+    )
+
+
+def get_chunks(track: List[Track_point], duration: timedelta) -> List[Tuple[int, int]]:
+    """Split a track into `(first, last)` index ranges (last excluded) of `duration`"""
+    to_return = []
+    timestamps = [tp.timestamp for tp in track]
+    first = 0
+
+    while first < len(track):
+        last = bisect_left(timestamps, timestamps[first] + duration, first + 1)
+        to_return.append((first, last))
+        first = last
+
+    return to_return
+
+
+def init_match_worker(segment_definitions: List[Segment_definition]) -> None:
+    """Set up a match worker process, once for all the chunks it scans"""
+    global _SEGMENT_DEFINITIONS
+
+    _SEGMENT_DEFINITIONS = {sd.uid: sd for sd in segment_definitions}
+
+
+def get_match_executor(
+    segment_definitions: List[Segment_definition], workers: Optional[int] = None
+) -> ProcessPoolExecutor:
+    """Worker processes for `find_candidates_in_chunks()`, started on first use"""
+
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_match_worker,
+        initargs=(segment_definitions,),
+    )
+
+
+def has_gps_fix(latitude: float, longitude: float) -> bool:
+    """Same test as `match()`, on track file columns (NaN for missing values)"""
+
+    return not (isnan(latitude) or isnan(longitude)) and bool(latitude and longitude)
+
 
-    for sp in segment_points:
-        if not hasattr(sp, field_name) or getattr(sp, field_name) is None:
-            return None
+def scan_chunk(
+    track_handle: Track_handle,
+    segment_uids: List[str],
+    threshold: int,
+    first: int,
+    last: int,
+) -> List[Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]]:
+    """`scan_gates()` of points `first` to `last` (excluded), in a match worker
 
-    ts = [mtp.timestamp for mtp in segment_points]
-    durations = [z[1] - z[0] for z in zip(ts, ts[1:])]
-    values = [
-        value
+    The points are read from the memory-mapped track file. Returned indexes are
+    those of the track file, points without GPS fix included.
+    """
+    segment_definitions = [_SEGMENT_DEFINITIONS[uid] for uid in segment_uids]
 
-        for duration, metric in zip(
-            durations, [getattr(mtp, field_name) for mtp in segment_points][1:]
+    with track_handle.open() as track_arrays:
+        columns = track_arrays.columns
+
+        # Slices of the mapped columns, released before the track is closed
+        with columns["position_lat"][first:last] as latitudes:
+            with columns["position_long"][first:last] as longitudes:
+                indexes = [
+                    first + idx
+
+                    for idx, (latitude, longitude) in enumerate(
+                        zip(latitudes, longitudes)
+                    )
+
+                    if has_gps_fix(latitude, longitude)
+                ]
+
+                if len(indexes) == last - first:
+                    return scan_gates(
+                        latitudes, longitudes, segment_definitions, threshold, first
+                    )
+
+                # Points without GPS fix: only copy the coordinates of the others
+                hits = scan_gates(
+                    array("d", [latitudes[idx - first] for idx in indexes]),
+                    array("d", [longitudes[idx - first] for idx in indexes]),
+                    segment_definitions,
+                    threshold,
+                )
+
+    return [
+        (
+            [(indexes[idx], dist) for idx, dist in start_hits],
+            [(indexes[idx], dist) for idx, dist in stop_hits],
         )
 
-        for value in duration.seconds * [metric]
+        for start_hits, stop_hits in hits
     ]
 
-    if field_name == "enhanced_speed":
-        # cf. <https://github.com/pcolby/bipolar/issues/74>
-        values = [v * 3.6 for v in values]
 
-    to_return: Metric = from_dict(
-        data_class=Metric,
+def find_candidates_in_chunks(
+    track: List[Track_point],
+    track_indexes: List[int],
+    track_handle: Track_handle,
+    segment_definitions: List[Segment_definition],
+    threshold: int,
+    executor: Executor,
+) -> List[Tuple[List[Matched_track_point], List[Matched_track_point]]]:
+    """Same as `find_candidates()`, scanning time chunks of the track in parallel
+
+    Candidates only depend on one track point each, so chunks need no overlap, and
+    their candidates, concatenated in time order, are exactly those of the serial
+    scan: grouping them and pairing starts and stops (`get_challenges()`) is then
+    done on the whole track, with no attempt to deduplicate at the seams.
+
+    `track` are the points with a GPS fix, at `track_indexes` in the track file of
+    `track_handle`. `executor` must come from `get_match_executor()`: workers
+    already have the segment definitions, so they only receive the handle, the
+    offsets of their chunk and the uids of the definitions, read the coordinates
+    from the memory-mapped track file, and return indexes and distances.
+    """
+    segment_uids = [sd.uid for sd in segment_definitions]
+    futures = [
+        executor.submit(
+            scan_chunk,
+            track_handle,
+            segment_uids,
+            threshold,
+            track_indexes[first],
+            track_indexes[last - 1] + 1,
+        )
+
+        for first, last in get_chunks(track, MATCH_CHUNK_DURATION)
+    ]
+    hits: List[Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]] = [
+        ([], []) for _ in segment_definitions
+    ]
+
+    for future in futures:
+        for (start_hits, stop_hits), (chunk_start_hits, chunk_stop_hits) in zip(
+            hits, future.result()
+        ):
+            # Back to indexes of the points with a GPS fix
+            for to_hits, from_hits in [
+                (start_hits, chunk_start_hits),
+                (stop_hits, chunk_stop_hits),
+            ]:
+                to_hits.extend(
+                    [(bisect_left(track_indexes, idx), dist) for idx, dist in from_hits]
+                )
+
+    return get_candidates(track, hits)
+
+
+def compute_attempt_metrics(
+    track_handle: Track_handle, first: int, last: int
+) -> Dict[str, Any]:
+    """`compute_metrics()` of points `first` to `last` (excluded), in a worker
+
+    The points are read from the memory-mapped track file, those without GPS fix
+    being ignored, as in `match()`.
+    """
+
+    with track_handle.open() as track_arrays:
+        segment_points = [
+            tp
+
+            for tp in track_arrays.to_track(first, last).track_points
+
+            if tp.position_long and tp.position_lat
+        ]
+
+    return compute_metrics(segment_points)
+
+
+def build_segment(
+    track_name: str,
+    segment_definition: Segment_definition,
+    virtual_start: Matched_track_point,
+    metrics: Dict[str, Any],
+    duration: timedelta,
+    moving_time: float,
+) -> Segment:
+    """Build an attempt, from the `compute_metrics()` of its points"""
+    to_return: Segment = from_dict(
+        data_class=Segment,
         data={
-            "avg": mean(values),
-            "upper": max(values),
-            "lower": min(values),
-            "stdev": stdev(values),
+            "activity_name": track_name,
+            "segment_name": segment_definition.name,
+            "segment_uid": segment_definition.uid,
+            "duration": duration,
+            "moving_time": timedelta(seconds=moving_time),
+            "start_time": virtual_start.track_point.timestamp,
+            **metrics,
         },
     )
 
@@ -231,68 +718,87 @@ def match(
     track: Track,
     segment_definitions: List[Segment_definition],
     args: argparse.Namespace,
+    diagnostics: Optional[Diagnostics] = None,
+    profiles: Optional[Profile_store] = None,
+    executor: Optional[Executor] = None,
+    track_handle: Optional[Track_handle] = None,
 ) -> List[Segment]:
+    """Find the attempts of the segment definitions in a track
+
+    If `executor` and the `track_handle` of the track are given, long tracks are
+    scanned by chunks in worker processes, which also compute the metrics of the
+    attempts, reading the points from the memory-mapped track file.
+    """
     # TODO Autodetect segment_definitions
     # TODO Import segment_definitions
     # TODO Compute exact distances with geopy
-    threshold = 5000
+    threshold = MATCH_THRESHOLD
 
     segments_challenged = []
 
-    for segment_definition in segment_definitions:
-        logger.debug("Searching for segment_definition %s", segment_definition.name)
+    # Ignore points without GPS fix yet, if any
+    track_indexes = [
+        idx
 
-        track_points_with_gps_fix = [
-            tp for tp in track.track_points if tp.position_long and tp.position_lat
-        ]
+        for idx, tp in enumerate(track.track_points)
 
-        if args.verbose:
-            deltas = []
+        if tp.position_long and tp.position_lat
+    ]
+    track_points_with_gps_fix = [track.track_points[idx] for idx in track_indexes]
 
-            for idx, track_point in enumerate(track_points_with_gps_fix):
-                to_add = (
-                    idx,
-                    track_point.timestamp,
-                    int(distance(track_point, segment_definition.start)),
-                    int(distance(track_point, segment_definition.stop)),
-                )
-                deltas.append(to_add)
-
-            if deltas:
-                with open(
-                    get_csv_filename(track.name, segment_definition.name), "w"
-                ) as f_handler:
-                    f_handler.write(
-                        "\n".join([",".join([str(x) for x in d]) for d in deltas])
-                    )
+    logger.debug(
+        "Looking for start and stop points of %s segment definitions",
+        len(segment_definitions),
+    )
 
-        if segment_definition.debug:
-            segment_debug_handler: TextIO = get_segment_debug_handler(
-                segment_definition
-            )
+    if (
+        executor is not None
+        and track_handle is not None
+        and len(track_points_with_gps_fix) >= LONG_TRACK_POINTS
+    ):
+        all_candidates = find_candidates_in_chunks(
+            track_points_with_gps_fix,
+            track_indexes,
+            track_handle,
+            segment_definitions,
+            threshold,
+            executor,
+        )
+    else:
+        executor = None
+        all_candidates = find_candidates(
+            track_points_with_gps_fix, segment_definitions, threshold
+        )
 
-        if args.verbose:
-            segment_timing_handler: TextIO = get_segment_timing_handler(
-                segment_definition
-            )
+    # Cumulated moving time at each point, to get the moving time of each attempt
+    moving_times = get_moving_times(track_points_with_gps_fix)
+    attempts: List[
+        Tuple[
+            Segment_definition,
+            Matched_track_point,
+            Matched_track_point,
+            Optional[Diagnostics],
+        ]
+    ] = []
 
-        logger.debug("Looking for start points")
+    for segment_definition, (start_candidates, stop_candidates) in zip(
+        segment_definitions, all_candidates
+    ):
+        logger.debug("Searching for segment_definition %s", segment_definition.name)
 
-        # Ignore points without GPS fix yet, if any
-        start_candidates = find_candidates(
-            track_points_with_gps_fix, segment_definition.start, threshold,
-        )
+        if diagnostics and diagnostics.enabled(segment_definition):
+            segment_diagnostics = diagnostics
+            diagnostics.add_distances(
+                track.name, segment_definition, start_candidates, stop_candidates
+            )
+        else:
+            segment_diagnostics = None
 
         if not start_candidates:
             logger.debug("None found, segment not started")
 
             continue
 
-        logger.debug("Looking for stop points")
-        stop_candidates = find_candidates(
-            track_points_with_gps_fix, segment_definition.stop, threshold
-        )
-
         if not stop_candidates:
             logger.debug("None found, segment not stopped")
 
@@ -311,229 +817,1079 @@ def match(
             assert virtual_stop.track_point.position_lat
             assert virtual_stop.track_point.distance
 
-            if segment_definition.debug:
-                segment_debug_handler.write(
-                    "%s,%s,%s\n%s,%s,%s\n"
-                    % (
-                        semicircles_to_degrees(
-                            round(virtual_start.track_point.position_long)
-                        ),
-                        semicircles_to_degrees(
-                            round(virtual_start.track_point.position_lat)
-                        ),
-                        track.name,
-                        semicircles_to_degrees(
-                            round(virtual_stop.track_point.position_long)
-                        ),
-                        semicircles_to_degrees(
-                            round(virtual_stop.track_point.position_lat)
-                        ),
-                        track.name,
-                    )
-                )
+            attempts.append(
+                (segment_definition, virtual_start, virtual_stop, segment_diagnostics)
+            )
 
-            virtual_distance = (
-                virtual_stop.track_point.distance - virtual_start.track_point.distance
-            ) / 1000
-            virtual_timing = (
-                virtual_stop.track_point.timestamp - virtual_start.track_point.timestamp
+    # Metrics of the points from the virtual start to past the stop: in worker
+    # processes, for tracks scanned by chunks
+    if executor is not None:
+        assert track_handle is not None
+        metrics_futures = [
+            executor.submit(
+                compute_attempt_metrics,
+                track_handle,
+                track_indexes[virtual_start.idx],
+                track_indexes[min(virtual_stop.idx + 1, len(track_indexes) - 1)] + 1,
             )
-            segment_points = track_points_with_gps_fix[
-                virtual_start.idx : virtual_stop.idx + 2
-            ]
-            segments_challenged.append(
-                from_dict(
-                    data_class=Segment,
-                    data={
-                        "activity_name": track.name,
-                        "segment_name": segment_definition.name,
-                        "segment_uid": segment_definition.uid,
-                        "duration": virtual_timing,
-                        "start_time": virtual_start.track_point.timestamp,
-                        "heart_rate": compute_metric("heart_rate", segment_points),
-                        "cadence": compute_metric("cadence", segment_points),
-                        "speed": compute_metric("enhanced_speed", segment_points),
-                        "temperature": compute_metric("temperature", segment_points),
-                    },
-                )
+
+            for _, virtual_start, virtual_stop, _ in attempts
+        ]
+
+    for attempt_idx, (
+        segment_definition,
+        virtual_start,
+        virtual_stop,
+        segment_diagnostics,
+    ) in enumerate(attempts):
+        assert virtual_start.track_point.distance
+        assert virtual_stop.track_point.distance
+        virtual_distance = (
+            virtual_stop.track_point.distance - virtual_start.track_point.distance
+        ) / 1000
+        virtual_timing = (
+            virtual_stop.track_point.timestamp - virtual_start.track_point.timestamp
+        )
+        segment = build_segment(
+            track.name,
+            segment_definition,
+            virtual_start,
+            metrics_futures[attempt_idx].result()
+            if executor is not None
+            else compute_metrics(
+                track_points_with_gps_fix[virtual_start.idx : virtual_stop.idx + 2]
+            ),
+            virtual_timing,
+            moving_times[virtual_stop.idx] - moving_times[virtual_start.idx],
+        )
+        segments_challenged.append(segment)
+
+        if profiles:
+            profiles.add(
+                segment,
+                track_points_with_gps_fix[virtual_start.idx : virtual_stop.idx + 1],
+            )
+
+        if segment_diagnostics:
+            segment_diagnostics.add_virtual_points(
+                track.name, segment_definition, virtual_start, virtual_stop
             )
+            segment_diagnostics.add_timing(
+                track.name, segment_definition, virtual_distance, virtual_timing
+            )
+
+        logger.warning(
+            "%s : %s found %1.2f km / %s",
+            track.name,
+            segment_definition.name,
+            virtual_distance,
+            virtual_timing,
+        )
+        logger.debug(
+            "Start: %s\nStop %s", virtual_start.track_point, virtual_stop.track_point,
+        )
+
+    return segments_challenged
+
+
+class Gate_run:
+    """Current group of candidates of a start or stop point, in an online matcher
+
+    Candidates are grouped as in `select_virtual_points`: a group ends when no
+    candidate follows within `MAX_GROUP_GAP`, and the first candidate of a group
+    only opens it. The virtual point of a group is its closest candidate.
+    """
+
+    def __init__(self, category: str) -> None:
+        self.category = category
+        self.best: Optional[Matched_track_point] = None
+        self.last_time: Optional[datetime] = None
+
+    def add(self, candidate: Matched_track_point) -> Optional[Matched_track_point]:
+        """Add a candidate, and return the virtual point of the group it ends, if any"""
+        to_return = None
+        timestamp = candidate.track_point.timestamp
+
+        if self.last_time is not None and timestamp - self.last_time < MAX_GROUP_GAP:
+            if (
+                self.best is None
+                or candidate.dist_to_segment < self.best.dist_to_segment
+            ):
+                self.best = candidate
+        else:
+            to_return = self.close()
+        self.last_time = timestamp
+
+        return to_return
+
+    def expire(self, timestamp: datetime) -> Optional[Matched_track_point]:
+        """Close the group if it cannot grow anymore at `timestamp`"""
+
+        if self.last_time is not None and timestamp - self.last_time >= MAX_GROUP_GAP:
+            return self.close()
+
+        return None
+
+    def close(self) -> Optional[Matched_track_point]:
+        to_return = self.best
+
+        if to_return:
+            to_return.category = self.category
+        self.best = None
+        self.last_time = None
+
+        return to_return
+
+    def get_lower_bound(self, timestamp: datetime) -> Optional[datetime]:
+        """Earliest timestamp of the virtual point of the current group, if any"""
+
+        if self.best is not None:
+            return self.best.track_point.timestamp
+
+        if self.last_time is not None:
+            return timestamp
+
+        return None
+
+
+class Segment_state:
+    """State of a segment definition in an online matcher
+
+    The segment is approaching its start while the start group is open, in the
+    segment once a virtual start is the last virtual point, and finished when a
+    virtual stop directly follows it. Virtual points are put in time order (as in
+    `get_challenges`) as soon as no open group can produce an earlier one.
+    """
 
-            if args.verbose:
-                segment_timing_handler.write(
-                    "%s,%2.2f,%3.2f\n"
-                    % (
-                        track.name,
-                        virtual_distance,
-                        virtual_timing.total_seconds() / 60,
+    def __init__(self, segment_definition: Segment_definition) -> None:
+        self.segment_definition = segment_definition
+        self.runs = [Gate_run("start"), Gate_run("stop")]
+        # Virtual points not put in order yet, and the last one put in order
+        self.pending: List[Matched_track_point] = []
+        self.previous: Optional[Matched_track_point] = None
+
+    def is_active(self) -> bool:
+        return bool(self.pending) or any(run.last_time for run in self.runs)
+
+    def get_first_idx(self) -> Optional[int]:
+        """Index of the earliest track point that may still start an attempt"""
+        indexes = [vpoint.idx for vpoint in self.pending]
+
+        if self.previous and self.previous.category == "start":
+            indexes.append(self.previous.idx)
+
+        if self.runs[0].best:
+            indexes.append(self.runs[0].best.idx)
+
+        return min(indexes) if indexes else None
+
+    def release(
+        self, timestamp: Optional[datetime]
+    ) -> List[Tuple[Matched_track_point, Matched_track_point]]:
+        """Put in order the virtual points earlier than any to come, return attempts
+
+        With no `timestamp` (end of the track), all virtual points are released.
+        """
+        bounds = [
+            bound
+
+            for run in self.runs
+
+            if timestamp and (bound := run.get_lower_bound(timestamp))
+        ]
+        bound = min(bounds) if bounds else None
+        self.pending.sort(
+            key=lambda x: (x.track_point.timestamp, x.category != "start")
+        )
+        to_return = []
+
+        while self.pending and (
+            bound is None or self.pending[0].track_point.timestamp < bound
+        ):
+            vpoint = self.pending.pop(0)
+
+            if (
+                vpoint.category == "stop"
+                and self.previous
+                and self.previous.category == "start"
+            ):
+                to_return.append((self.previous, vpoint))
+            self.previous = vpoint
+
+        return to_return
+
+
+class Online_matcher:
+    """Match segment definitions while track points are fed one at a time
+
+    Gives the same attempts as `find_candidates` and `get_challenges`, provided
+    that track points are fed in time order. An attempt is returned as soon as
+    its stop group ends. Only the segment definitions with an open group or
+    pending virtual points are visited for each track point.
+    """
+
+    def __init__(
+        self,
+        segment_definitions: List[Segment_definition],
+        threshold: int = MATCH_THRESHOLD,
+    ) -> None:
+        self.threshold = threshold
+        self.grid = build_gate_grid(segment_definitions, threshold)
+        self.states = [Segment_state(sd) for sd in segment_definitions]
+        self.active: Set[int] = set()
+        self.idx = -1
+
+    def feed(
+        self, track_point: Track_point
+    ) -> List[Tuple[Segment_definition, Matched_track_point, Matched_track_point]]:
+        """Feed the next track point with a GPS fix, and return finished attempts"""
+        assert track_point.position_lat
+        assert track_point.position_long
+        self.idx += 1
+        cell_lat = int(track_point.position_lat // self.threshold)
+        cell_long = int(track_point.position_long // self.threshold)
+
+        for d_lat in (-1, 0, 1):
+            for d_long in (-1, 0, 1):
+                for sd_idx, category, segpoint in self.grid.get(
+                    (cell_lat + d_lat, cell_long + d_long), []
+                ):
+                    dist = int(distance(track_point, segpoint))
+
+                    if dist >= self.threshold:
+                        continue
+
+                    state = self.states[sd_idx]
+                    vpoint = state.runs[category].add(
+                        Matched_track_point(
+                            category=None,
+                            dist_to_segment=dist,
+                            idx=self.idx,
+                            track_point=track_point,
+                        )
                     )
-                )
+
+                    if vpoint:
+                        state.pending.append(vpoint)
+                    self.active.add(sd_idx)
+
+        return self._release(track_point.timestamp)
+
+    def close(
+        self,
+    ) -> List[Tuple[Segment_definition, Matched_track_point, Matched_track_point]]:
+        """Close all groups at the end of the track, and return finished attempts"""
+
+        return self._release(None)
+
+    def get_first_idx(self) -> Optional[int]:
+        """Index of the earliest track point still needed to build an attempt"""
+        indexes = [
+            idx for state in self.states if (idx := state.get_first_idx()) is not None
+        ]
+
+        return min(indexes) if indexes else None
+
+    def _release(
+        self, timestamp: Optional[datetime]
+    ) -> List[Tuple[Segment_definition, Matched_track_point, Matched_track_point]]:
+        to_return = []
+
+        for sd_idx in sorted(self.active):
+            state = self.states[sd_idx]
+
+            for run in state.runs:
+                vpoint = run.close() if timestamp is None else run.expire(timestamp)
+
+                if vpoint:
+                    state.pending.append(vpoint)
+
+            to_return.extend(
+                [
+                    (state.segment_definition, virtual_start, virtual_stop)
+
+                    for virtual_start, virtual_stop in state.release(timestamp)
+                ]
+            )
+
+            if not state.is_active():
+                self.active.discard(sd_idx)
+
+        return to_return
+
+
+def match_stream(
+    track_name: str,
+    track_points: Iterable[Track_point],
+    segment_definitions: List[Segment_definition],
+    profiles: Optional[Profile_store] = None,
+) -> Iterator[Segment]:
+    """Match track points as they come, e.g. while a file is being decoded
+
+    Yields the same segments as `match`, each as soon as its stop is passed. Only
+    the track points from the earliest possible start of an attempt are kept.
+    """
+    matcher = Online_matcher(segment_definitions)
+    # Track points with a GPS fix from index `first`, and their cumulated moving time
+    kept_points: List[Track_point] = []
+    moving_times: List[float] = []
+    first = 0
+
+    def build(
+        attempts: List[
+            Tuple[Segment_definition, Matched_track_point, Matched_track_point]
+        ]
+    ) -> Iterator[Segment]:
+        for segment_definition, virtual_start, virtual_stop in attempts:
+            start_idx = virtual_start.idx - first
+            stop_idx = virtual_stop.idx - first
+            segment = build_segment(
+                track_name,
+                segment_definition,
+                virtual_start,
+                compute_metrics(kept_points[start_idx : stop_idx + 2]),
+                kept_points[stop_idx].timestamp - kept_points[start_idx].timestamp,
+                moving_times[stop_idx] - moving_times[start_idx],
+            )
+
+            if profiles:
+                profiles.add(segment, kept_points[start_idx : stop_idx + 1])
             logger.warning(
-                "%s : %s found %1.2f km / %s",
-                track.name,
+                "%s : %s found / %s",
+                track_name,
                 segment_definition.name,
-                virtual_distance,
-                virtual_timing,
-            )
-            logger.debug(
-                "Start: %s\nStop %s",
-                virtual_start.track_point,
-                virtual_stop.track_point,
+                segment.duration,
             )
 
-        if segment_definition.debug:
-            segment_debug_handler.close()
+            yield segment
 
-    return segments_challenged
+    for track_point in track_points:
+        # Ignore points without GPS fix, as `match` does
+        if not (track_point.position_long and track_point.position_lat):
+            continue
 
+        moving_times.append(
+            moving_times[-1] + get_moving_time(kept_points[-1], track_point)
+            if kept_points
+            else 0.0
+        )
+        kept_points.append(track_point)
+        # Attempts stop before this point, which is kept: as in `match`, the point
+        # past the stop is part of the attempt
+        yield from build(matcher.feed(track_point))
 
-def update_storage(
+        # Every 1000 points, drop the points before any possible start, but keep the
+        # last one, for the moving time of the next one
+        if matcher.idx % 1000 == 999:
+            first_idx = matcher.get_first_idx()
+            first_idx = matcher.idx if first_idx is None else first_idx
+            del kept_points[: first_idx - first]
+            del moving_times[: first_idx - first]
+            first = first_idx
+
+    yield from build(matcher.close())
+
+
+def iter_traced_points(
+    filename: str, coordinates: List[List[float]]
+) -> Iterator[Track_point]:
+    """Yield the track points of a file, appending their UI coordinates on the way"""
+
+    for track_point in iter_track_points(filename):
+        point_coordinates = get_ui_coordinates(track_point)
+
+        if point_coordinates is not None:
+            coordinates.append(point_coordinates)
+
+        yield track_point
+
+
+def select_segment_definitions(
+    filename: str,
+    activities: Dict[str, Activity],
     segment_definitions: List[Segment_definition],
-    activities: List[Activity],
-    segments: List[Segment],
-    args: argparse.Namespace,
-) -> Tuple[List[Activity], List[Segment]]:
+) -> Optional[List[Segment_definition]]:
+    """Return the segment definitions that have to be searched in a file
 
-    logger.warning("%s segment definitions loaded", len(segment_definitions))
-    logger.warning("%s activities loaded", len(activities))
-    logger.warning("%s segments loaded", len(segments))
+    That is all of them if the activity is new, or only new/updated ones if it has
+    been processed previously. Returns None if the file can be skipped.
+    """
 
-    # Remove undefined segments
-    segments = [
-        seg
+    # First, we need to check whether the activity has already already been
+    # processed, and if it's the case, if new segment definitions have been added
+    # since this previous processing.
+    matching_activity = activities.get(filename2activityname(filename))
+
+    # If the activity is new, search for all segments
 
-        for seg in segments
+    if matching_activity is None:
+        return segment_definitions
 
-        if seg.segment_uid in [sd.uid for sd in segment_definitions]
+    # If it's a known activity, first check whether the GPS was enabled: if it's not
+    # the case, there's no need to search for segment definitions. If the GPS was
+    # enabled, then we can safely ignore segment definitions the `uid` of which,
+    # which is a hash, were already matched.
+
+    if not matching_activity.gps_available:
+        logger.debug("%s has no GPS records", filename)
+
+        return None
+
+    # get the list of segment definitions the hash of which is not found in this
+    # known activity
+
+    matched_against_segments = set(matching_activity.matched_against_segments)
+    segments_definitions_to_search = [
+        seg for seg in segment_definitions if seg.uid not in matched_against_segments
     ]
 
-    dump_every: int = 50
+    # Don't search for segment definitions if there's no new ones
+
+    if not segments_definitions_to_search:
+        logger.debug(
+            "%s already searched for %s segments", filename, len(segment_definitions),
+        )
+
+        return None
+
+    return segments_definitions_to_search
+
+
+def get_track_activity(
+    track: Track,
+    summary: Optional[Fit_summary],
+    segment_definitions: List[Segment_definition],
+) -> Activity:
+    """Build the activity of a track, with pauses and elevation computed once here
 
-    for idx, filename in enumerate(args.fitfiles):
+    Calories only come from the summary of FIT files, if any.
+    """
+    elevation_gain, elevation_loss = get_elevation_changes(track.track_points)
+    heart_rates = [tp.heart_rate for tp in track.track_points if tp.heart_rate]
 
-        # First, we need to check whether the activity has already already been
-        # processed, and if it's the case, if new segment definitions have been added
-        # since this previous processing.
-        expected_name: str = filename2activityname(filename)
-        matching_activities = [a for a in activities if a.name == expected_name]
-        assert len(matching_activities) == 0 or len(matching_activities) == 1
-        matching_activity: Union[Activity, None] = None
+    if summary is not None and summary.avg_heart_rate is not None:
+        avg_heart_rate: Optional[float] = summary.avg_heart_rate
+    else:
+        avg_heart_rate = sum(heart_rates) / len(heart_rates) if heart_rates else None
 
-        # `segments_definitions_to_search` will contain only the segment definitions
-        # that have to be searched for this activity, ie. all of them is the activity is
-        # new, or only new/updates ones if it has been processed previously
+    return from_dict(
+        data_class=Activity,
+        data={
+            "avg_heart_rate": avg_heart_rate,
+            "calories": summary.calories if summary else None,
+            "distance": track.track_points[-1].distance,
+            "duration": track.track_points[-1].timestamp
+            - track.track_points[0].timestamp,
+            "elevation_gain": elevation_gain,
+            "elevation_loss": elevation_loss,
+            "gps_available": track.gps_available,
+            "matched_against_segments": [s.uid for s in segment_definitions],
+            "moving_time": timedelta(seconds=get_moving_times(track.track_points)[-1]),
+            "name": track.name,
+            "start_time": track.track_points[0].timestamp,
+            "year": track.track_points[0].timestamp.year,
+        },
+    )
 
-        segments_definitions_to_search: Union[List[Segment_definition], None] = None
 
-        # If it's a known activity, first check whether the GPS was enabled: if it's not
-        # the case, there's no need to search for segment definitions. If the GPS was
-        # enabled, then we can safely ignore segment definitions the `uid` of which,
-        # which is a hash, were already matched.
+def get_summary_activity(
+    activity_name: str,
+    summary: Fit_summary,
+    segment_definitions: List[Segment_definition],
+) -> Activity:
+    """Build the activity of a FIT file from its summary, without its track
 
-        if matching_activities:
-            matching_activity = matching_activities[0]
+    Only called when the summary tells whether the GPS is available.
+    """
 
-            # Don't search for segment definitions if no GPS is available
+    return from_dict(
+        data_class=Activity,
+        data={
+            "avg_heart_rate": summary.avg_heart_rate,
+            "calories": summary.calories,
+            "distance": summary.distance,
+            "duration": summary.duration,
+            "elevation_gain": summary.elevation_gain,
+            "elevation_loss": summary.elevation_loss,
+            "gps_available": summary.gps_available,
+            "matched_against_segments": [s.uid for s in segment_definitions],
+            "moving_time": summary.moving_time,
+            "name": activity_name,
+            "start_time": summary.start_time,
+            "year": summary.start_time.year,
+        },
+    )
 
-            if not matching_activity.gps_available:
-                logger.debug("%s has no GPS records", filename)
 
-                continue
+def process_files(
+    filenames: Iterable[str],
+    activities: Dict[str, Activity],
+    segment_definitions: List[Segment_definition],
+    args: argparse.Namespace,
+    diagnostics: Optional[Diagnostics] = None,
+    best_efforts: Optional[Best_efforts] = None,
+    profiles: Optional[Profile_store] = None,
+    packs: Optional[Pack_store] = None,
+    writer: Optional[Output_writer] = None,
+    results: Optional[Result_store] = None,
+    executor: Optional[Executor] = None,
+) -> Iterator[Tuple[Activity, List[Segment]]]:
+    """Load, cache and match files one at a time, yielding new activities/segments
+
+    Only one track is held in memory at a time: it is released before its results
+    are yielded (queued writes of `writer` may still hold a few). If `best_efforts`
+    is given, the curves of activities not yet in the envelopes (or modified since)
+    are loaded from the cache (or computed, if their track is loaded to be matched)
+    and added to them: the others are queued for `warm_cache.py`, cf.
+    `queue_curves()`. If `packs` is given, tracks are cached in packs instead of one
+    file per track. If `results` is given, segment definitions already matched
+    against the same file content are looked up instead (except those diagnosed),
+    and the file is only loaded if needed. If `executor` is given, long tracks are
+    matched by chunks in parallel.
+    """
+    best_efforts_activities = set(best_efforts.activity_names if best_efforts else [])
+    ui_basedir = get_output_filename(args, DEFAULT_UI_BASEDIR)
+
+    for filename in filenames:
+        segments_definitions_to_search = select_segment_definitions(
+            filename, activities, segment_definitions
+        )
+        activity_name = filename2activityname(filename)
+
+        if (
+            best_efforts is not None
+            and activity_name in best_efforts_activities
+            and is_curves_outdated(activity_name, filename, args.cache)
+        ):
+            # Re-exported since: its curves are added again below, or by a next run
+            logger.info("%s modified, removed from best efforts", filename)
+            remove_best_efforts(
+                best_efforts,
+                {activity_name},
+                {name: a.start_time for name, a in activities.items()},
+                args.cache,
+            )
+            best_efforts_activities = set(best_efforts.activity_names)
+        missing_best_efforts = (
+            best_efforts is not None and activity_name not in best_efforts_activities
+        )
 
-            # get the list of segment definitions the hash of which is not found in this
-            # known activity
+        if segments_definitions_to_search is None and not missing_best_efforts:
+            continue
 
-            segments_definitions_to_search = [
-                seg
+        searched_definitions = segments_definitions_to_search or []
+        result = None
+
+        if results is not None and segments_definitions_to_search:
+            result = results.get(filename)
+        found_segments: Dict[str, List[Segment]] = {
+            sd.uid: [] for sd in searched_definitions
+        }
+
+        if result is not None:
+            # No GPS, no segment, whatever the definitions
+            cached_definitions = [
+                sd
 
-                for seg in segment_definitions
+                for sd in searched_definitions
 
-                if seg.uid not in matching_activity.matched_against_segments
+                if (sd.uid in result.segments or not result.activity.gps_available)
+                and not (diagnostics and diagnostics.enabled(sd))
             ]
 
-            # Don't search for segment definitions if there's no new ones
+            for sd in cached_definitions:
+                found_segments[sd.uid] = [
+                    replace(segment, segment_name=sd.name)
+
+                    for segment in result.segments.get(sd.uid, [])
+                ]
+            segments_definitions_to_search = [
+                sd for sd in searched_definitions if sd not in cached_definitions
+            ]
 
-            if not segments_definitions_to_search:
-                logger.debug(
-                    "%s already searched for %s segments",
-                    filename,
-                    len(segment_definitions),
+            if not segments_definitions_to_search and not missing_best_efforts:
+                logger.info("%s found in the match results", filename)
+                activity = replace(
+                    result.activity,
+                    matched_against_segments=[s.uid for s in segment_definitions],
                 )
 
+                yield (activity, [s for v in found_segments.values() for s in v])
+
                 continue
 
+        # Here, either the activity is new, or it's known and only a few segments
+        # have to be searched for (or its curves computed). FIT files tell whether
+        # they have GPS records, and their totals, without decoding the records:
+        # these are only loaded to search for segments, so that home trainer rides
+        # are summarized from their sessions. The curves of activities not loaded
+        # are left to `warm_cache.py`, rather than decoding the whole file for them.
+        summary = (
+            read_fit_summary(filename)
+            if segments_definitions_to_search is not None
+            else None
+        )
+        curves = (
+            load_cached_curves(activity_name, args.cache, filename)
+            if missing_best_efforts
+            else None
+        )
+
+        if segments_definitions_to_search is None:
+            # Known activity, only its curves are missing
+            needs_track = False
+        elif result is not None:
+            # No GPS: no definition left to search, cf. above
+            needs_track = bool(segments_definitions_to_search)
         else:
-            # If the activity is new, search for all segments
-            segments_definitions_to_search = segment_definitions
+            # Unknown GPS availability (no start position in the file): load the
+            # track
+            needs_track = (
+                summary is None
+                or summary.gps_available is None
+                or (summary.gps_available and bool(segments_definitions_to_search))
+            )
+        # With --stream, FIT files summarized from their sessions are matched while
+        # decoded, holding only the track points of possible attempts: their track
+        # is not cached, and diagnosed segments still need it
+        stream = (
+            args.stream
+            and needs_track
+            and summary is not None
+            and bool(summary.gps_available)
+            and not (
+                diagnostics
+                and any(
+                    diagnostics.enabled(sd)
+                    for sd in segments_definitions_to_search or []
+                )
+            )
+        )
 
-        # Here, either the activity is new, or it's known and only a few segments have
-        # to be searched for. We need to load the file, hoping the hit the cache since
-        # parsing FIT files takes time.
+        if missing_best_efforts and curves is None and not (needs_track and not stream):
+            queue_curves(filename, args.cache)
+            logger.info("%s queued for warm_cache.py, for its curves", filename)
+            missing_best_efforts = False
+
+        if needs_track and not stream:
+            # Hoping to hit the cache, since parsing FIT files takes time
+            try:
+                track = (
+                    packs.load_file(filename, writer, ui_basedir)
+                    if packs
+                    else load_file(filename, args.cache, writer, ui_basedir)
+                )
+                logger.warning("Loading %s", filename)
+            except MissingValueError as e:
+                logger.critical("%s: %s", filename, str(e))
 
-        try:
-            track = load_file(filename)
-            logger.warning("Loading %s", filename)
-        except MissingValueError as e:
-            __import__("ipdb").set_trace()
-            logger.critical("%s: %s", filename, str(e))
+                continue
 
-            continue
+            if not track.track_points:
+                logger.warning("%s has no track points", filename)
 
-        # If the track has track_point coordinates, we can search for segments. If it
-        # has none (hometrainer or manually added activity), then we don't need to and
-        # can just add the activity as is.
+                continue
 
-        if track.gps_available:
-            segments_challenged = match(track, segments_definitions_to_search, args)
-            segments.extend(segments_challenged)
+            start_time = track.track_points[0].timestamp
+        elif summary is not None:
+            start_time = summary.start_time
+        elif result is not None:
+            start_time = result.activity.start_time
         else:
-            logger.info("%s is HT", filename)
-
-        # Build the activity dataclass
-        activity = from_dict(
-            data_class=Activity,
-            data={
-                "distance": track.track_points[-1].distance,
-                "duration": track.track_points[-1].timestamp
-                - track.track_points[0].timestamp,
-                "gps_available": track.gps_available,
-                "matched_against_segments": [s.uid for s in segment_definitions],
-                "name": track.name,
-                "start_time": track.track_points[0].timestamp,
-                "year": track.track_points[0].timestamp.year,
-            },
+            start_time = activities[activity_name].start_time
+
+        if best_efforts is not None and missing_best_efforts:
+            update_best_efforts(
+                best_efforts,
+                activity_name,
+                start_time,
+                load_curves(track, args.cache, filename) if curves is None else curves,
+            )
+            best_efforts_activities.add(activity_name)
+
+        if segments_definitions_to_search is None:
+            continue
+
+        if stream:
+            assert summary is not None and segments_definitions_to_search
+            logger.warning("Streaming %s", filename)
+            coordinates: List[List[float]] = []
+
+            for segment in match_stream(
+                activity_name,
+                iter_traced_points(filename, coordinates),
+                segments_definitions_to_search,
+                profiles,
+            ):
+                found_segments[segment.segment_uid].append(segment)
+            write_ui_coordinates(
+                coordinates, get_ui_trace_filename(filename, ui_basedir)
+            )
+            activity = get_summary_activity(activity_name, summary, segment_definitions)
+        elif result is not None and not needs_track:
+            activity = replace(
+                result.activity,
+                matched_against_segments=[s.uid for s in segment_definitions],
+            )
+        elif not needs_track:
+            assert summary is not None
+            logger.info("%s summarized from its sessions", filename)
+            activity = get_summary_activity(activity_name, summary, segment_definitions)
+        else:
+            # If the track has track_point coordinates, we can search for segments.
+            # If it has none (hometrainer or manually added activity), then we don't
+            # need to and can just add the activity as is.
+
+            if track.gps_available and segments_definitions_to_search:
+                # Long tracks are shared with the match workers as track files
+                track_handle = (
+                    get_track_handle(filename, args.cache, track)
+                    if executor is not None
+                    and len(track.track_points) >= LONG_TRACK_POINTS
+                    else None
+                )
+
+                for segment in match(
+                    track,
+                    segments_definitions_to_search,
+                    args,
+                    diagnostics,
+                    profiles,
+                    executor,
+                    track_handle,
+                ):
+                    found_segments[segment.segment_uid].append(segment)
+            elif not track.gps_available:
+                logger.info("%s is HT", filename)
+
+            activity = get_track_activity(track, summary, segment_definitions)
+            del track
+
+        if results is not None:
+            results.add(
+                filename,
+                Match_result(
+                    activity=activity,
+                    segments={
+                        sd.uid: found_segments[sd.uid]
+
+                        for sd in segments_definitions_to_search
+                    },
+                ),
+            )
+
+        # In the order of the definitions, as matched together
+        yield (activity, [s for v in found_segments.values() for s in v])
+
+
+def get_spill_filename(cache_path_name: Optional[str], number: int) -> Path:
+    if not cache_path_name:
+        cache_path_name = DEFAULT_CACHE_PATH
+
+    spill_filename = f"segments.{os.getpid()}.{number}.json"
+
+    return Path(cache_path_name) / SPILL_DIRNAME / spill_filename
+
+
+def iter_spilled_segments(
+    spill_files: List[Path], segments: List[Segment]
+) -> Iterator[Segment]:
+    """Yield the segments released to spill files, then those still in memory"""
+
+    for spill_file in spill_files:
+        yield from load_segments(str(spill_file))
+
+    yield from segments
+
+
+def update_storage(
+    segment_definitions: List[Segment_definition],
+    activities: List[Activity],
+    segments: List[Segment],
+    args: argparse.Namespace,
+    diagnostics: Optional[Diagnostics] = None,
+    best_efforts: Optional[Best_efforts] = None,
+    profiles: Optional[Profile_store] = None,
+    aggregates: Optional[Aggregates] = None,
+    packs: Optional[Pack_store] = None,
+    writer: Optional[Output_writer] = None,
+    results: Optional[Result_store] = None,
+    executor: Optional[Executor] = None,
+) -> Tuple[List[Activity], List[Segment]]:
+
+    if writer is None:
+        writer = Output_writer(workers=0)
+
+    logger.warning("%s segment definitions loaded", len(segment_definitions))
+    logger.warning("%s activities loaded", len(activities))
+    logger.warning("%s segments loaded", len(segments))
+
+    # Remove undefined segments
+    segment_uids = {sd.uid for sd in segment_definitions}
+    segments = [seg for seg in segments if seg.segment_uid in segment_uids]
+
+    # Activities are indexed by name: if an activity was previously known, but new
+    # segments had to be matched, the new copy replaces the previous one
+    activities_by_name = {a.name: a for a in activities}
+    assert len(activities_by_name) == len(activities)
+
+    if aggregates is not None and not is_consistent(aggregates, activities, segments):
+        logger.warning("Rebuilding aggregates")
+        rebuilt = build_aggregates(activities, segments)
+        aggregates.periods = rebuilt.periods
+        aggregates.segments = rebuilt.segments
+
+    filenames = list(discover_activity_files(args.fitfiles))
+
+    if best_efforts is not None:
+        # Neither known nor to be processed: removed since added
+        removed_names = set(best_efforts.activity_names) - (
+            activities_by_name.keys() | {filename2activityname(f) for f in filenames}
         )
 
-        # If the activity was previously known, but new segments had to be matched, the
-        # previous copy must be removed to avoid duplicates
+        if removed_names:
+            logger.warning(
+                "Removing %s activities from best efforts", len(removed_names)
+            )
+            remove_best_efforts(
+                best_efforts,
+                removed_names,
+                {name: a.start_time for name, a in activities_by_name.items()},
+                args.cache,
+            )
 
-        if matching_activity:
-            activities.remove(matching_activity)
+    dump_every: int = 50
+    max_memory: Optional[int] = args.max_memory * 2 ** 20 if args.max_memory else None
+
+    if max_memory is not None and get_memory_usage() is None:
+        logger.warning("Current memory usage unavailable, --max-memory ignored")
+        max_memory = None
+
+    # Memory usage at the last ceiling dump: CPython seldom gives memory back to the
+    # OS, so that the next one waits for a growth of MEMORY_DUMP_GROWTH
+    last_ceiling_usage = 0
+    # Segments released to the cache at ceiling dumps, cf. `iter_spilled_segments()`
+    spill_files: List[Path] = []
+
+    for idx, (activity, segments_challenged) in enumerate(
+        process_files(
+            filenames,
+            activities_by_name,
+            segment_definitions,
+            args,
+            diagnostics,
+            best_efforts,
+            profiles,
+            packs,
+            writer,
+            results,
+            executor,
+        )
+    ):
+        if aggregates is not None:
+            if activity.name in activities_by_name:
+                remove_activity(aggregates, activities_by_name[activity.name])
+            add_activity(aggregates, activity)
+
+            for segment in segments_challenged:
+                add_segment(aggregates, segment)
 
-        # Add the new (or updated) activity
-        activities.append(activity)
+        activities_by_name[activity.name] = activity
+        segments.extend(segments_challenged)
 
         # Dump from time to time, just in case it crashes, to avoid recomputing
-        # everything
+        # everything, or when the memory ceiling is reached, to release segments
+        usage = get_memory_usage() if max_memory is not None else None
+        over_ceiling = (
+            max_memory is not None
+            and usage is not None
+            and usage > max(max_memory, last_ceiling_usage + MEMORY_DUMP_GROWTH)
+        )
 
-        if idx % dump_every == 0 and idx != 0:
+        if (idx % dump_every == 0 and idx != 0) or over_ceiling:
             logger.debug("Dumping activites and segments, %s processed", idx)
-            write_activities(activities)
-            write_segments(segments)
+            # Written in background: pass copies of what is still being updated
+            activities_filename = get_output_filename(args, DEFAULT_ACTIVITIES_FILENAME)
+            segments_filename = get_output_filename(args, DEFAULT_SEGMENTS_FILENAME)
+            writer.submit(
+                write_activities,
+                list(activities_by_name.values()),
+                activities_filename,
+                key=activities_filename,
+            )
+            writer.submit(
+                write_segments,
+                iter_spilled_segments(list(spill_files), list(segments)),
+                segments_filename,
+                key=segments_filename,
+            )
 
-    return (activities, segments)
+            if best_efforts:
+                best_efforts_filename = get_output_filename(
+                    args, DEFAULT_BEST_EFFORTS_FILENAME
+                )
+                writer.submit(
+                    write_best_efforts,
+                    deepcopy(best_efforts),
+                    best_efforts_filename,
+                    key=best_efforts_filename,
+                )
 
+            if aggregates:
+                aggregates_filename = get_output_filename(
+                    args, DEFAULT_AGGREGATES_FILENAME
+                )
+                writer.submit(
+                    write_aggregates,
+                    deepcopy(aggregates),
+                    aggregates_filename,
+                    key=aggregates_filename,
+                )
 
-def main() -> None:
-    args = parse_args()
+            if diagnostics:
+                diagnostics.flush()
+
+            if profiles:
+                profiles.flush()
+
+            if packs:
+                packs.flush()
+
+            if results:
+                results.flush()
+
+        if over_ceiling:
+            # Release the segments found so far, read back once all files are done
+            spill_file = get_spill_filename(args.cache, len(spill_files))
+            writer.submit(write_segments, segments, str(spill_file))
+            spill_files.append(spill_file)
+            segments = []
+            writer.flush()
+            gc.collect()
+            last_ceiling_usage = get_memory_usage() or 0
+
+            if max_memory is not None and last_ceiling_usage > max_memory:
+                logger.warning(
+                    "Memory usage %s MB still above the %s MB ceiling",
+                    last_ceiling_usage // 2 ** 20,
+                    args.max_memory,
+                )
+
+    # Segments are modified in place, once the dumps are written
+    writer.flush()
+
+    if spill_files:
+        segments = list(iter_spilled_segments(spill_files, segments))
+
+        for spill_file in spill_files:
+            spill_file.unlink()
+    index_nested_segments(segments, segment_definitions)
 
-    segment_definitions = load_segment_definitions()
-    new_activities, new_segments = update_storage(
-        segment_definitions, load_activities(), load_segments(), args
+    return (list(activities_by_name.values()), segments)
+
+
+def get_output_filename(args: argparse.Namespace, filename: str) -> str:
+    """Path of an output file, in the output directory (`--output-dir`)"""
+
+    return str(Path(args.output_dir) / filename)
+
+
+def run(
+    segment_definitions: List[Segment_definition], args: argparse.Namespace
+) -> None:
+    """Update the outputs in `args.output_dir`, with indexed segment definitions
+
+    Tracks are cached in `args.cache`. Nothing depends on the current directory, so
+    that athlete workspaces are updated side by side.
+    """
+    ui_basedir = get_output_filename(args, DEFAULT_UI_BASEDIR)
+    activities_filename = get_output_filename(args, DEFAULT_ACTIVITIES_FILENAME)
+    segments_filename = get_output_filename(args, DEFAULT_SEGMENTS_FILENAME)
+    best_efforts_filename = get_output_filename(args, DEFAULT_BEST_EFFORTS_FILENAME)
+    aggregates_filename = get_output_filename(args, DEFAULT_AGGREGATES_FILENAME)
+    diagnostics = Diagnostics(
+        args.diagnose, basedir=get_output_filename(args, DEFAULT_CSV_DIR)
     )
+    best_efforts = load_best_efforts(best_efforts_filename)
+    profiles = Profile_store(args.cache)
+    aggregates = load_aggregates(aggregates_filename)
+    packs = Pack_store(args.cache) if args.packed_cache else None
+    results = (
+        None if args.no_result_cache else Result_store(MATCHER_VERSION, args.cache)
+    )
+    writer = Output_writer(args.writers)
+    # Worker processes are only started when a long track is matched
+    executor = (
+        None
+        if args.match_workers == 1
+        else get_match_executor(segment_definitions, args.match_workers)
+    )
+
+    try:
+        new_activities, new_segments = update_storage(
+            segment_definitions,
+            load_activities(activities_filename),
+            load_segments(segments_filename),
+            args,
+            diagnostics,
+            best_efforts,
+            profiles,
+            aggregates,
+            packs,
+            writer,
+            results,
+            executor,
+        )
+        diagnostics.flush()
+        profiles.flush()
+
+        if packs:
+            packs.flush()
+
+        if results:
+            results.flush()
+
+        writer.submit(
+            write_activities,
+            new_activities,
+            activities_filename,
+            key=activities_filename,
+        )
+        writer.submit(
+            write_segments, new_segments, segments_filename, key=segments_filename
+        )
+        writer.submit(
+            write_data_js,
+            segment_definitions,
+            new_activities,
+            new_segments,
+            ui_basedir,
+            key=f"{ui_basedir}/userdata/data.js",
+        )
+        writer.submit(
+            write_best_efforts,
+            best_efforts,
+            best_efforts_filename,
+            key=best_efforts_filename,
+        )
+        writer.submit(write_best_efforts_js, best_efforts, ui_basedir)
+        writer.submit(
+            write_aggregates, aggregates, aggregates_filename, key=aggregates_filename
+        )
+        writer.submit(write_aggregates_js, aggregates, ui_basedir)
+    finally:
+        if executor:
+            executor.shutdown()
+        # Barrier: all outputs are complete (or an error is raised) before exiting
+        writer.close()
+
+
+def main() -> None:
+    args = parse_args()
 
-    write_activities(new_activities)
-    write_segments(new_segments)
-    write_data_js(segment_definitions, new_activities, new_segments)
+    segment_definitions = load_segment_definitions(args.segment_definitions)
+    index_nested_definitions(segment_definitions)
+    run(segment_definitions, args)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,33 @@
 import bz2
 import json
 import logging
+import os
 import pickle
 import re
-from dataclasses import asdict, dataclass, field
-from datetime import datetime, timedelta
+import resource
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field, fields, is_dataclass
+from datetime import datetime, timedelta, timezone
 from hashlib import sha256
+from math import asin, cos, radians, sin, sqrt
 from pathlib import Path
-from typing import List, Optional, TextIO, Union
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    get_args,
+    get_origin,
+)
 
 from dacite import Config, from_dict
 from fitparse import FitFile
@@ -17,6 +37,26 @@ DEFAULT_SEGMENT_DEFINITIONS_FILENAME = "segment_definitions.json"
 DEFAULT_SEGMENTS_FILENAME = "segments.json"
 DEFAULT_ACTIVITIES_FILENAME = "activities.json"
 DEFAULT_UI_BASEDIR = "ui"
+DEFAULT_CSV_DIR = "csv"
+ACTIVITY_FILE_SUFFIXES = [".fit", ".gpx"]
+
+# GPX extension fields (local names, whatever the namespace) -> track point fields
+GPX_EXTENSIONS = {
+    "atemp": "temperature",
+    "cad": "cadence",
+    "cadence": "cadence",
+    "heartrate": "heart_rate",
+    "hr": "heart_rate",
+    "power": "power",
+    "temp": "temperature",
+}
+EARTH_RADIUS = 6371008.8
+
+# Intervals slower than PAUSE_MIN_SPEED (m/s), or longer than PAUSE_MAX_GAP (s), are
+# pauses. Altitude changes smaller than ELEVATION_HYSTERESIS (m) are ignored.
+PAUSE_MIN_SPEED = 0.8
+PAUSE_MAX_GAP = 10
+ELEVATION_HYSTERESIS = 3.0
 
 # https://docs.microsoft.com/en-us/previous-versions/windows/embedded/cc510650(v=msdn.10)
 
@@ -26,10 +66,15 @@ DEGREES_TO_SEMICIRCLES: float = pow(2, 31) / 180
 
 @dataclass
 class Activity:
+    avg_heart_rate: Optional[float]
+    calories: Optional[float]
     distance: Optional[float]
     duration: timedelta
+    elevation_gain: Optional[float]
+    elevation_loss: Optional[float]
     gps_available: bool
     matched_against_segments: List[str]
+    moving_time: Optional[timedelta]
     name: str
     start_time: datetime
     year: int
@@ -48,7 +93,12 @@ class Segment:
     activity_name: str
     cadence: Optional[Metric]
     duration: timedelta
+    elevation_gain: Optional[float]
+    grade: Optional[float]
     heart_rate: Optional[Metric]
+    moving_time: Optional[timedelta]
+    nested_in: Optional[List[str]]
+    power: Optional[Metric]
     segment_name: str
     segment_uid: str
     speed: Optional[Metric]
@@ -73,6 +123,7 @@ class Segment_definition:
     start: Segment_definition_point
     stop: Segment_definition_point
     uid: str = field(init=False)
+    nested_in: List[str] = field(init=False, default_factory=list)
 
     def __post_init__(self) -> None:
         self.uid = sha256(f"{self.start}-{self.stop}".encode()).hexdigest()
@@ -81,20 +132,22 @@ class Segment_definition:
 @dataclass
 class Track_point:
     # TODO could unknown_61 or 66 be accuracy?
-    altitude: float
+    altitude: Optional[float]
     cadence: Optional[float]
     distance: Optional[float]
-    enhanced_altitude: float
+    enhanced_altitude: Optional[float]
     enhanced_speed: Optional[float]
     fractional_cadence: Optional[float]
     heart_rate: Optional[float]
     position_lat: Optional[float]
     position_long: Optional[float]
     speed: Optional[float]
-    temperature: float
+    temperature: Optional[float]
     timestamp: datetime
     unknown_61: Optional[float]
     unknown_66: Optional[float]
+    # Last, with a default: tracks cached before it was added read it as None
+    power: Optional[float] = None
 
 
 @dataclass
@@ -124,70 +177,449 @@ class Track:
         )
 
 
+def get_moving_time(previous: Track_point, track_point: Track_point) -> float:
+    """Return the moving time, in seconds, between two consecutive track points
+
+    An interval between two points is a pause if it is longer than `PAUSE_MAX_GAP`
+    (e.g. auto-pause), or if the distance (or, lacking it, the speed) shows a speed
+    below `PAUSE_MIN_SPEED`.
+    """
+    elapsed = (track_point.timestamp - previous.timestamp).total_seconds()
+    moving = 0 < elapsed <= PAUSE_MAX_GAP
+
+    if moving and track_point.distance is not None and previous.distance is not None:
+        moving = track_point.distance - previous.distance >= PAUSE_MIN_SPEED * elapsed
+    elif moving and track_point.enhanced_speed is not None:
+        moving = track_point.enhanced_speed >= PAUSE_MIN_SPEED
+
+    return elapsed if moving else 0.0
+
+
+def get_moving_times(track_points: List[Track_point]) -> List[float]:
+    """Return the cumulated moving time, in seconds, at each track point
+
+    The moving time between points `i` and `j` is `moving_times[j] - moving_times[i]`.
+    """
+    to_return = [0.0]
+
+    for previous, track_point in zip(track_points, track_points[1:]):
+        to_return.append(to_return[-1] + get_moving_time(previous, track_point))
+
+    return to_return
+
+
+class Elevation_counter:
+    """Elevation gain and loss, in meters, of altitudes added one at a time
+
+    Altitudes are smoothed with a hysteresis: a change is only counted once the
+    altitude has moved by more than `ELEVATION_HYSTERESIS` from the last reference.
+    """
+
+    def __init__(self) -> None:
+        self.gain = 0.0
+        self.loss = 0.0
+        self.reference: Optional[float] = None
+
+    def add(self, altitude: Optional[float]) -> None:
+        if altitude is None:
+            return
+
+        if self.reference is None:
+            self.reference = altitude
+        elif altitude - self.reference > ELEVATION_HYSTERESIS:
+            self.gain += altitude - self.reference
+            self.reference = altitude
+        elif self.reference - altitude > ELEVATION_HYSTERESIS:
+            self.loss += self.reference - altitude
+            self.reference = altitude
+
+
+def get_elevation_changes(track_points: List[Track_point]) -> Tuple[float, float]:
+    """Return the elevation gain and loss, in meters, cf. `Elevation_counter`"""
+    counter = Elevation_counter()
+
+    for track_point in track_points:
+        counter.add(track_point.enhanced_altitude)
+
+    return (counter.gain, counter.loss)
+
+
 def filename2activityname(fitfilename: str) -> str:
     return Path(fitfilename).stem
 
 
-def load_file(fitfilename: str, cache_path_name: Optional[str] = None) -> Track:
+def haversine(lat1: float, long1: float, lat2: float, long2: float) -> float:
+    """Distance in meters between two points given in degrees"""
+    phi1, phi2 = radians(lat1), radians(lat2)
+    a = (
+        sin((phi2 - phi1) / 2) ** 2
+        + cos(phi1) * cos(phi2) * sin(radians(long2 - long1) / 2) ** 2
+    )
+
+    return 2 * EARTH_RADIUS * asin(sqrt(a))
+
+
+def _parse_gpx_time(text: str) -> datetime:
+    """Parse a GPX timestamp into a naive UTC datetime, as FIT timestamps are"""
+    timestamp = datetime.fromisoformat(text.strip().replace("Z", "+00:00"))
+
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return timestamp
+
+
+def iter_gpx_file(gpxfilename: str) -> Iterator[Track_point]:
+    """Yield the track points of a GPX file, in bounded memory
+
+    The file is parsed with `iterparse`, and each `trkpt` element is removed from
+    its parent as soon as it has been converted, so that memory does not grow with
+    the size of the file. Distances and speeds, which GPX does not provide, are
+    computed from the coordinates.
+    """
+    parents: List[ET.Element] = []
+    distance = 0.0
+    previous: Optional[Tuple[float, float, datetime]] = None
+
+    for event, elem in ET.iterparse(gpxfilename, events=("start", "end")):
+        if event == "start":
+            parents.append(elem)
+
+            continue
+
+        parents.pop()
+
+        if elem.tag.rsplit("}", 1)[-1] != "trkpt":
+            continue
+
+        values: Dict[str, Any] = {}
+
+        for child in elem.iter():
+            name = child.tag.rsplit("}", 1)[-1]
+
+            if child.text is None or not child.text.strip():
+                continue
+
+            if name == "ele":
+                values["altitude"] = values["enhanced_altitude"] = float(child.text)
+            elif name == "time":
+                values["timestamp"] = _parse_gpx_time(child.text)
+            elif name in GPX_EXTENSIONS:
+                values[GPX_EXTENSIONS[name]] = float(child.text)
+
+        if parents:
+            parents[-1].remove(elem)
+
+        if "timestamp" not in values:
+            continue
+
+        lat = float(elem.attrib["lat"])
+        long = float(elem.attrib["lon"])
+        speed: Optional[float] = None
+
+        if previous:
+            delta = haversine(previous[0], previous[1], lat, long)
+            distance += delta
+            elapsed = (values["timestamp"] - previous[2]).total_seconds()
+            speed = delta / elapsed if elapsed > 0 else None
+        previous = (lat, long, values["timestamp"])
+
+        yield Track_point(
+            altitude=values.get("altitude"),
+            cadence=values.get("cadence"),
+            distance=distance,
+            enhanced_altitude=values.get("enhanced_altitude"),
+            enhanced_speed=speed,
+            fractional_cadence=None,
+            heart_rate=values.get("heart_rate"),
+            position_lat=degrees_to_semicircles(lat),
+            position_long=degrees_to_semicircles(long),
+            power=values.get("power"),
+            speed=speed,
+            temperature=values.get("temperature"),
+            timestamp=values["timestamp"],
+            unknown_61=None,
+            unknown_66=None,
+        )
+
+
+def parse_gpx_file(gpxfilename: str) -> Track:
+    return Track(
+        name=filename2activityname(gpxfilename),
+        track_points=list(iter_gpx_file(gpxfilename)),
+    )
+
+
+def iter_fit_file(fitfilename: str) -> Iterator[Track_point]:
+    """Yield the track points of a FIT file, as records are decoded"""
+
+    for data in FitFile(fitfilename).get_messages("record"):
+        yield from_dict(data_class=Track_point, data=data.get_values())
+
+
+def parse_fit_file(fitfilename: str) -> Track:
+    return Track(
+        name=filename2activityname(fitfilename),
+        track_points=list(iter_fit_file(fitfilename)),
+    )
+
+
+def iter_track_points(fitfilename: str) -> Iterator[Track_point]:
+    """Yield the track points of a FIT or GPX file, without caching them"""
+
+    if Path(fitfilename).suffix.lower() == ".gpx":
+        return iter_gpx_file(fitfilename)
+
+    return iter_fit_file(fitfilename)
+
+
+def get_cached_filename(
+    fitfilename: str, cache_path_name: Optional[str] = None
+) -> Path:
     if not cache_path_name:
         cache_path_name = DEFAULT_CACHE_PATH
 
-    cache_path = Path(cache_path_name)
+    return Path(cache_path_name) / (Path(fitfilename).stem + ".pbz2")
+
 
-    if not cache_path.is_dir():
-        # FIXME Add logging support here
-        # https://docs.python-guide.org/writing/logging/
-        # logger.error("tralala")
-        pass
+def get_ui_trace_filename(fitfilename: str, ui_basedir: Optional[str] = None) -> Path:
+    if not ui_basedir:
+        ui_basedir = DEFAULT_UI_BASEDIR
+    activity_name = filename2activityname(fitfilename)
 
-    if not cache_path.exists():
-        cache_path.mkdir(parents=True)
+    return Path(ui_basedir) / "userdata" / f"{activity_name}.json"
 
-    cached_file = cache_path / (Path(fitfilename).stem + ".pbz2")
 
-    activityname = filename2activityname(fitfilename)
+def is_cache_valid(fitfilename: str, cache_path_name: Optional[str] = None) -> bool:
+    """Whether the cached track of a file exists, and is not older than the file"""
+    cached_file = get_cached_filename(fitfilename, cache_path_name)
 
     if not cached_file.exists():
-        to_write: Track = Track(
-            name=activityname,
-            track_points=[
-                from_dict(data_class=Track_point, data=data.get_values())
+        return False
 
-                for data in FitFile(fitfilename).get_messages("record")
-            ],
-        )
-        with bz2.BZ2File(cached_file, "wb") as f_handler:
-            pickle.dump(to_write, f_handler)
+    source_file = Path(fitfilename)
+
+    return (
+        not source_file.exists()
+        or cached_file.stat().st_mtime >= source_file.stat().st_mtime
+    )
+
+
+def parse_file(fitfilename: str) -> Track:
+    if Path(fitfilename).suffix.lower() == ".gpx":
+        return parse_gpx_file(fitfilename)
+
+    return parse_fit_file(fitfilename)
+
+
+@contextmanager
+def atomic_write(filename: Union[str, Path], mode: str = "w") -> Iterator[IO[Any]]:
+    """Open a temporary file, renamed to `filename` once complete
+
+    A reader, or a crash, never sees a truncated file: either the previous content
+    or the new one. On error, the temporary file is removed.
+    """
+    target_file = Path(filename)
+    target_file.parent.mkdir(parents=True, exist_ok=True)
+    # Unique per process and thread, since both may write the same file
+    tmp_file = target_file.with_name(
+        f"{target_file.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    )
+
+    try:
+        with tmp_file.open(mode) as f_handler:
+            yield f_handler
+        tmp_file.replace(target_file)
+    finally:
+        if tmp_file.exists():
+            tmp_file.unlink()
+
+
+def write_cached_track(track: Track, cached_file: Path) -> None:
+    """Write a cached track, through a temporary file renamed once complete
+
+    A reader, or another process warming the cache, never sees a truncated file.
+    """
+
+    with atomic_write(cached_file, "wb") as f_handler:
+        with bz2.BZ2File(f_handler, "wb") as bz2_handler:
+            pickle.dump(track, bz2_handler)
+
+
+def get_ui_coordinates(track_point: Track_point) -> Optional[List[float]]:
+    """GPS coordinates of a track point, in degrees, or None without GPS fix"""
+
+    if not (
+        hasattr(track_point, "position_lat")
+        and track_point.position_lat
+        and hasattr(track_point, "position_long")
+        and track_point.position_long
+    ):
+        return None
+
+    return [
+        semicircles_to_degrees(int(track_point.position_lat)),
+        semicircles_to_degrees(int(track_point.position_long)),
+    ]
+
+
+def write_ui_coordinates(coordinates: List[List[float]], ui_file: Path) -> None:
+    with atomic_write(ui_file) as f_handler:
+        json.dump(coordinates, f_handler, indent=True)
+
+
+def write_ui_trace(track: Track, ui_file: Path) -> None:
+    """Write the GPS coordinates of a track, in degrees, for the web UI"""
+    write_ui_coordinates(
+        [
+            coordinates
+
+            for tp in track.track_points
+
+            if (coordinates := get_ui_coordinates(tp)) is not None
+        ],
+        ui_file,
+    )
+
+
+class Output_writer:
+    """Run output writes in background threads, so that they overlap with parsing
+
+    At most `max_pending` writes are queued: `submit()` blocks beyond, so that the
+    data held by queued writes stays bounded. Writes sharing a `key` (e.g. the
+    output file name) are applied in submission order, and a queued write is
+    skipped if a more recent one with the same key was submitted.
+
+    With `workers=0`, writes run synchronously in `submit()`. The data passed to
+    `submit()` must not be modified afterwards: pass copies of what is still
+    being updated. `flush()` waits for all submitted writes, and raises the first
+    error they raised, if any.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 8) -> None:
+        self.executor = ThreadPoolExecutor(workers) if workers > 0 else None
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.futures: List[Future] = []
+        # Key -> sequence number of its latest submitted write, and write lock
+        self.latest: Dict[str, int] = {}
+        self.key_locks: Dict[str, threading.Lock] = {}
+        self.sequence = 0
+
+    def _run(
+        self, key: Optional[str], sequence: int, function: Callable, *args: Any
+    ) -> None:
+        try:
+            if key is None:
+                function(*args)
+
+                return
+
+            with self.key_locks[key]:
+                if self.latest[key] == sequence:
+                    function(*args)
+        finally:
+            self.slots.release()
+
+    def submit(
+        self, function: Callable, *args: Any, key: Optional[str] = None
+    ) -> None:
+        self.slots.acquire()
+
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+
+            if key is not None:
+                self.latest[key] = sequence
+                self.key_locks.setdefault(key, threading.Lock())
+
+        if self.executor is None:
+            self._run(key, sequence, function, *args)
+
+            return
+
+        future = self.executor.submit(self._run, key, sequence, function, *args)
+
+        with self.lock:
+            self.futures = [f for f in self.futures if not f.done() or f.exception()]
+            self.futures.append(future)
+
+    def flush(self) -> None:
+        with self.lock:
+            futures, self.futures = self.futures, []
+
+        for future in futures:
+            future.result()
+
+    def close(self) -> None:
+        self.flush()
+
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def load_file(
+    fitfilename: str,
+    cache_path_name: Optional[str] = None,
+    writer: Optional[Output_writer] = None,
+    ui_basedir: Optional[str] = None,
+) -> Track:
+    """Load the track of a file from the cache, parsing and caching it if needed
+
+    If `writer` is given, the cache entry and the trace are written in background.
+    """
+    cached_file = get_cached_filename(fitfilename, cache_path_name)
+    ui_file = get_ui_trace_filename(fitfilename, ui_basedir)
+
+    if writer is None:
+        writer = Output_writer(workers=0)
+
+    if is_cache_valid(fitfilename, cache_path_name):
+        with bz2.BZ2File(cached_file, "rb") as f_handler:
+            to_return: Track = pickle.load(f_handler)
+
+        if not ui_file.exists():
+            writer.submit(write_ui_trace, to_return, ui_file, key=str(ui_file))
+    else:
+        to_return = parse_file(fitfilename)
+        writer.submit(write_cached_track, to_return, cached_file, key=str(cached_file))
+        # The trace may be outdated too
+        writer.submit(write_ui_trace, to_return, ui_file, key=str(ui_file))
+
+    return to_return
+
+
+def discover_activity_files(paths: Iterable[str]) -> Iterator[str]:
+    """Yield FIT and GPX files, searching directories recursively"""
+
+    for path_name in paths:
+        path = Path(path_name)
+
+        if path.is_dir():
+            for subpath in sorted(path.rglob("*")):
+                if subpath.suffix.lower() in ACTIVITY_FILE_SUFFIXES:
+                    yield str(subpath)
+        else:
+            yield path_name
+
+
+def load_cached_track(
+    activity_name: str, cache_path_name: Optional[str] = None
+) -> Optional[Track]:
+    """Load the cached track of an activity, if any, without parsing its FIT file"""
+
+    if not cache_path_name:
+        cache_path_name = DEFAULT_CACHE_PATH
+
+    cached_file = Path(cache_path_name) / f"{activity_name}.pbz2"
+
+    if not cached_file.exists():
+        return None
 
     with bz2.BZ2File(cached_file, "rb") as f_handler:
         to_return: Track = pickle.load(f_handler)
 
-    ui_activity_dir = Path(DEFAULT_UI_BASEDIR) / "userdata"
-
-    if not ui_activity_dir.exists():
-        ui_activity_dir.mkdir(parents=True)
-    ui_file = ui_activity_dir / f"{filename2activityname(fitfilename)}.json"
-
-    if not ui_file.exists():
-        with ui_file.open("w") as f_handler:
-            json.dump(
-                [
-                    [
-                        semicircles_to_degrees(tp.position_lat),
-                        semicircles_to_degrees(tp.position_long),
-                    ]
-
-                    for tp in to_return.track_points
-
-                    if hasattr(tp, "position_lat")
-                    and tp.position_lat
-                    and hasattr(tp, "position_long")
-                    and tp.position_long
-                ],
-                f_handler,
-                indent=True,
-            )
-
     return to_return
 
 
@@ -203,38 +635,156 @@ def get_segment_tag(segment_name: str) -> str:
     return re.sub(r"\W+", "", segment_name)
 
 
-def get_segment_timing_handler(segment: Segment_definition) -> TextIO:
-    debug_file = Path("csv/%s_timings.csv" % get_segment_tag(segment.name))
+def get_track_tag(track_name: str) -> str:
+    return re.sub(r"[^0-9]+", "", track_name)
+
+
+class Diagnostics:
+    """Buffered CSV diagnostics, enabled per segment definition
+
+    Diagnostics are produced for segment definitions flagged with `debug`, or whose
+    name, tag or uid is listed in `segments` (`all` enables every segment). Rows are
+    kept in memory, and written by `flush()`, which is also called once `max_rows`
+    rows are buffered. The CSV files are:
+
+    - `<segment>_timings.csv`: activity, kms, and duration (minutes) of each attempt
+    - `<segment>_debug_start.csv`: virtual start and stop points of each attempt,
+      after the start and stop points of the segment definition
+    - `distances.<track>.<segment>.csv`: index, timestamp and distances to the start
+      and stop points of each track point near them, as computed by the matcher
+    """
+
+    def __init__(
+        self,
+        segments: Optional[List[str]] = None,
+        basedir: str = DEFAULT_CSV_DIR,
+        max_rows: int = 100000,
+    ) -> None:
+        self.segments = set(segments or [])
+        self.basedir = Path(basedir)
+        self.max_rows = max_rows
+        self.buffered = 0
+        self.appended: Dict[Path, List[str]] = {}
+        self.headers: Dict[Path, str] = {}
+        self.overwritten: Dict[Path, List[str]] = {}
+
+    def enabled(self, segment: Segment_definition) -> bool:
+        return (
+            segment.debug
+            or "all" in self.segments
+            or not self.segments.isdisjoint(
+                [segment.name, get_segment_tag(segment.name), segment.uid]
+            )
+        )
 
-    if not debug_file.exists():
-        to_return = debug_file.open("w")
-    else:
-        to_return = debug_file.open("a")
+    def _add(self, buffers: Dict[Path, List[str]], path: Path, rows: List[str]) -> None:
+        buffers.setdefault(path, []).extend(rows)
+        self.buffered += len(rows)
+
+        if self.buffered >= self.max_rows:
+            self.flush()
+
+    def add_distances(
+        self,
+        track_name: str,
+        segment: Segment_definition,
+        start_candidates: List[Matched_track_point],
+        stop_candidates: List[Matched_track_point],
+    ) -> None:
+        distances: Dict[int, List[Any]] = {}
+
+        for column, candidates in enumerate([start_candidates, stop_candidates]):
+            for mtp in candidates:
+                row = distances.setdefault(
+                    mtp.idx, [mtp.idx, mtp.track_point.timestamp, "", ""]
+                )
+                row[2 + column] = int(mtp.dist_to_segment)
 
-    return to_return
+        if not distances:
+            return
 
+        path = self.basedir / (
+            f"distances.{get_track_tag(track_name)}.{get_segment_tag(segment.name)}.csv"
+        )
+        self.buffered -= len(self.overwritten.pop(path, []))
+        self._add(
+            self.overwritten,
+            path,
+            [",".join([str(x) for x in distances[idx]]) for idx in sorted(distances)],
+        )
 
-def get_segment_debug_handler(segment: Segment_definition) -> TextIO:
-    debug_file = Path("csv/%s_debug_start.csv" % get_segment_tag(segment.name))
-
-    if not debug_file.exists():
-        to_return = debug_file.open("w")
-        to_return.write(
-            "%s,%s,%s-start\n%s,%s,%s-stop\n"
-            % (
-                semicircles_to_degrees(int(segment.start.longitude)),
-                semicircles_to_degrees(int(segment.start.latitude)),
-                segment.name,
-                semicircles_to_degrees(int(segment.stop.longitude)),
-                semicircles_to_degrees(int(segment.stop.latitude)),
-                segment.name,
-            )
+    def add_timing(
+        self,
+        track_name: str,
+        segment: Segment_definition,
+        virtual_distance: float,
+        virtual_timing: timedelta,
+    ) -> None:
+        path = self.basedir / f"{get_segment_tag(segment.name)}_timings.csv"
+        self._add(
+            self.appended,
+            path,
+            [
+                "%s,%2.2f,%3.2f"
+                % (track_name, virtual_distance, virtual_timing.total_seconds() / 60)
+            ],
         )
 
-    else:
-        to_return = debug_file.open("a")
+    def add_virtual_points(
+        self,
+        track_name: str,
+        segment: Segment_definition,
+        virtual_start: Matched_track_point,
+        virtual_stop: Matched_track_point,
+    ) -> None:
+        path = self.basedir / f"{get_segment_tag(segment.name)}_debug_start.csv"
+        self.headers[path] = "%s,%s,%s-start\n%s,%s,%s-stop\n" % (
+            semicircles_to_degrees(int(segment.start.longitude)),
+            semicircles_to_degrees(int(segment.start.latitude)),
+            segment.name,
+            semicircles_to_degrees(int(segment.stop.longitude)),
+            semicircles_to_degrees(int(segment.stop.latitude)),
+            segment.name,
+        )
+        self._add(
+            self.appended,
+            path,
+            [
+                "%s,%s,%s"
+                % (
+                    semicircles_to_degrees(round(vpoint.track_point.position_long)),
+                    semicircles_to_degrees(round(vpoint.track_point.position_lat)),
+                    track_name,
+                )
 
-    return to_return
+                for vpoint in [virtual_start, virtual_stop]
+
+                # Virtual points are built from candidates, which have a GPS fix
+                if vpoint.track_point.position_long is not None
+                and vpoint.track_point.position_lat is not None
+            ],
+        )
+
+    def flush(self) -> None:
+        if not self.buffered:
+            return
+
+        self.basedir.mkdir(parents=True, exist_ok=True)
+
+        for path, rows in self.overwritten.items():
+            with path.open("w") as f_handler:
+                f_handler.write("\n".join(rows))
+
+        for path, rows in self.appended.items():
+            is_new = not path.exists()
+            with path.open("a") as f_handler:
+                if is_new and path in self.headers:
+                    f_handler.write(self.headers[path])
+                f_handler.write("".join([f"{row}\n" for row in rows]))
+
+        self.buffered = 0
+        self.appended = {}
+        self.overwritten = {}
 
 
 _TYPEHOOKS = {
@@ -251,95 +801,177 @@ def _encode_durations(x: Union[datetime, timedelta]) -> Union[str, float]:
         return x.total_seconds()
 
 
+# Compact columnar format of the segments and activities files: one list of values
+# per field, instead of one object per record. Older files (a list of records) are
+# still read.
+COLUMNAR_FORMAT = "fit2segments-columns"
+COLUMNAR_VERSION = 1
+
+Codec = Tuple[Callable[[Any], Any], Callable[[Any], Any]]
+
+
+def _identity(x: Any) -> Any:
+    return x
+
+
+def _get_codec(field_type: Any) -> Codec:
+    """Return the (encoder, decoder) of a field type, for non-None values"""
+
+    if get_origin(field_type) is Union:
+        # Optional[X]
+        field_type = [t for t in get_args(field_type) if t is not type(None)][0]
+
+    if field_type is datetime:
+        return (datetime.isoformat, datetime.fromisoformat)
+
+    if field_type is timedelta:
+        return (timedelta.total_seconds, lambda x: timedelta(seconds=x))
+
+    if is_dataclass(field_type):
+        # Small nested records (e.g. Metric) are stored as lists of values
+        names = [f.name for f in fields(field_type)]
+        record_class: Any = field_type
+
+        return (
+            lambda x: [getattr(x, name) for name in names],
+            lambda x: record_class(*x),
+        )
+
+    return (_identity, _identity)
+
+
+def _get_codecs(data_class: Any) -> Dict[str, Codec]:
+    return {f.name: _get_codec(f.type) for f in fields(data_class) if f.init}
+
+
+def _encode_columns(records: Iterable[Any], data_class: Any) -> Dict[str, Any]:
+    codecs = _get_codecs(data_class)
+    columns: Dict[str, List[Any]] = {name: [] for name in codecs}
+    length = 0
+
+    for record in records:
+        length += 1
+
+        for name, (encode, _) in codecs.items():
+            value = getattr(record, name)
+            columns[name].append(None if value is None else encode(value))
+
+    return {
+        "format": COLUMNAR_FORMAT,
+        "version": COLUMNAR_VERSION,
+        "length": length,
+        "columns": columns,
+    }
+
+
+def _decode_columns(data: Dict[str, Any], data_class: Any) -> List[Any]:
+    """Build records column by column, without per-record type inspection
+
+    Missing columns (fields added since the file was written) are set to None.
+    """
+    codecs = _get_codecs(data_class)
+    length = data["length"]
+    decoded_columns = []
+
+    for name, (_, decode) in codecs.items():
+        column = data["columns"].get(name, [None] * length)
+
+        if decode is not _identity:
+            column = [None if value is None else decode(value) for value in column]
+        decoded_columns.append(column)
+
+    return [data_class(*values) for values in zip(*decoded_columns)]
+
+
+def _load_records(filename: str, data_class: Any) -> List[Any]:
+    records_file = Path(filename)
+
+    if not records_file.exists():
+        return []
+
+    with records_file.open() as f_handler:
+        data = json.load(f_handler)
+
+    if isinstance(data, dict) and data.get("format") == COLUMNAR_FORMAT:
+        return _decode_columns(data, data_class)
+
+    return [
+        from_dict(
+            data_class=data_class, data=record, config=Config(type_hooks=_TYPEHOOKS)
+        )
+
+        for record in data
+    ]
+
+
+def _write_records(records: Iterable[Any], filename: str, data_class: Any) -> None:
+    with atomic_write(filename) as f_handler:
+        json.dump(
+            _encode_columns(records, data_class), f_handler, separators=(",", ":")
+        )
+
+
 def load_segments(segments_filename: Optional[str] = None,) -> List[Segment]:
     if segments_filename is None:
         segments_filename = DEFAULT_SEGMENTS_FILENAME
-    segments_file = Path(segments_filename)
-    to_return = []
-
-    if segments_file.exists():
-        with segments_file.open() as f_handler:
-            to_return = [
-                from_dict(
-                    data_class=Segment, data=data, config=Config(type_hooks=_TYPEHOOKS),
-                )
-
-                for data in json.load(f_handler)
-            ]
 
-    return to_return
+    return _load_records(segments_filename, Segment)
 
 
 def load_activities(activities_filename: Optional[str] = None,) -> List[Activity]:
     if activities_filename is None:
         activities_filename = DEFAULT_ACTIVITIES_FILENAME
-    activities_file = Path(activities_filename)
-    to_return = []
-
-    if activities_file.exists():
-        with activities_file.open() as f_handler:
-            to_return = [
-                from_dict(
-                    data_class=Activity,
-                    data=data,
-                    config=Config(type_hooks=_TYPEHOOKS),
-                )
 
-                for data in json.load(f_handler)
-            ]
+    return _load_records(activities_filename, Activity)
 
-    return to_return
+
+def _dump_records(records: Iterable[Any], f_handler: IO[str]) -> None:
+    """Write dataclasses as a JSON array, one record at a time"""
+
+    f_handler.write("[")
+
+    for idx, record in enumerate(records):
+        f_handler.write(",\n" if idx else "\n")
+        json.dump(asdict(record), f_handler, indent=True, default=_encode_durations)
+    f_handler.write("\n]")
 
 
 def write_segments(
-    segments: List[Segment], segments_filename: Optional[str] = None,
+    segments: Iterable[Segment], segments_filename: Optional[str] = None,
 ) -> None:
 
     if segments_filename is None:
         segments_filename = DEFAULT_SEGMENTS_FILENAME
-    segments_file = Path(segments_filename)
-    with segments_file.open("w") as f_handler:
-        json.dump(
-            [asdict(s) for s in segments],
-            f_handler,
-            indent=True,
-            default=_encode_durations,
-        )
+    _write_records(segments, segments_filename, Segment)
 
 
 def write_activities(
-    activities: List[Activity], activities_filename: Optional[str] = None,
+    activities: Iterable[Activity], activities_filename: Optional[str] = None,
 ) -> None:
     if activities_filename is None:
         activities_filename = DEFAULT_ACTIVITIES_FILENAME
-    activitys_file = Path(activities_filename)
-    with activitys_file.open("w") as f_handler:
-        json.dump(
-            [asdict(a) for a in activities],
-            f_handler,
-            indent=True,
-            default=_encode_durations,
-        )
+    _write_records(activities, activities_filename, Activity)
 
 
 def write_data_js(
-    segment_definitions: List[Segment_definition],
-    activities: List[Activity],
-    segments: List[Segment],
+    segment_definitions: Iterable[Segment_definition],
+    activities: Iterable[Activity],
+    segments: Iterable[Segment],
+    ui_basedir: Optional[str] = None,
 ) -> None:
+    if not ui_basedir:
+        ui_basedir = DEFAULT_UI_BASEDIR
 
     data = {
-        "segment_definitions": [asdict(sg) for sg in segment_definitions],
-        "activities": [asdict(a) for a in activities],
-        "segments": [asdict(s) for s in segments],
+        "segment_definitions": segment_definitions,
+        "activities": activities,
+        "segments": segments,
     }
 
-    with open(f"{DEFAULT_UI_BASEDIR}/userdata/data.js", "w") as output_handler:
+    with atomic_write(f"{ui_basedir}/userdata/data.js") as output_handler:
         for source_name, content in data.items():
             output_handler.write(f"{source_name} = ")
-
-            for line in json.dumps(content, indent=True, default=_encode_durations):
-                output_handler.write(line)
+            _dump_records(content, output_handler)
             output_handler.write(";\n")
 
 
@@ -381,6 +1013,19 @@ def load_segment_definitions(
         ]
 
 
+def get_memory_usage() -> Optional[int]:
+    """Return the current resident set size of the process in bytes, if available
+
+    Only Linux (`/proc`) gives the current size: `getrusage()` only gives the peak,
+    which never decreases, so that None is returned elsewhere.
+    """
+    try:
+        with open("/proc/self/statm") as f_handler:
+            return int(f_handler.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return None
+
+
 def get_logger(
     name: str, level: int = logging.WARNING, stderr: bool = True, logfile: bool = False
 ) -> logging.Logger:
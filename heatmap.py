@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Generate heatmap tiles of all activities, for the map of the web UI:
+
+- `~/.cache/fit2segments/heatmap`: counts of each tile, and the included activities
+- `ui/userdata/heatmap/<z>/<x>/<y>.png`: tiles, drawn over the map
+- `ui/userdata/heatmap.js`: zoom levels and bounds of the tiles
+
+Only activities not yet in the heatmap are loaded (from the cache, if possible), and
+only the tiles they touch are rewritten. The heatmap is rebuilt if an included
+activity changed, or if the zoom levels changed. Activities whose file was removed
+stay in the heatmap until it is rebuilt with `--rebuild`.
+"""
+
+import argparse
+import logging
+from pathlib import Path
+from typing import Dict
+
+from fitlib import (
+    DEFAULT_CACHE_PATH,
+    discover_activity_files,
+    filename2activityname,
+    get_logger,
+    load_file,
+)
+from heatmaplib import DEFAULT_MAX_ZOOM, DEFAULT_MIN_ZOOM, Heatmap
+from packlib import Pack_store
+
+
+def parse_args() -> argparse.Namespace:
+    """ Call me with args = parse_args() """
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    # Positional arguments
+    parser.add_argument(
+        "fitfiles", nargs="+", help="FIT or GPX files, or directories to search"
+    )
+
+    # Options
+    parser.add_argument(
+        "--cache", default=DEFAULT_CACHE_PATH, help="Cache directory to read tracks"
+    )
+    parser.add_argument(
+        "--min-zoom",
+        type=int,
+        default=DEFAULT_MIN_ZOOM,
+        help="Coarsest zoom level of the tiles",
+    )
+    parser.add_argument(
+        "--max-zoom",
+        type=int,
+        default=DEFAULT_MAX_ZOOM,
+        help="Finest zoom level of the tiles",
+    )
+
+    # Boolean
+    parser.add_argument(
+        "--packed-cache",
+        help="Read tracks from the pack files of the cache",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--rebuild",
+        help="Rebuild the heatmap from scratch, e.g. to drop removed activities",
+        action="store_true",
+    )
+    parser.add_argument("--verbose", "-v", help="Verbose mode", action="store_true")
+
+    args: argparse.Namespace = parser.parse_args()
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    return args
+
+
+def main(args: argparse.Namespace) -> None:
+    filenames = list(discover_activity_files(args.fitfiles))
+    mtimes: Dict[str, float] = {
+        filename2activityname(f): Path(f).stat().st_mtime for f in filenames
+    }
+    heatmap = Heatmap(args.cache)
+    packs = Pack_store(args.cache) if args.packed_cache else None
+
+    if args.rebuild or heatmap.is_outdated(mtimes, args.min_zoom, args.max_zoom):
+        logger.warning("Rebuilding the heatmap")
+        heatmap.clear(args.min_zoom, args.max_zoom)
+
+    dump_every: int = 50
+    added = 0
+
+    for filename in filenames:
+        activity_name = filename2activityname(filename)
+
+        if activity_name in heatmap.index.activities:
+            continue
+
+        track = packs.load_file(filename) if packs else load_file(filename, args.cache)
+        heatmap.add(track, mtimes[activity_name])
+        added += 1
+        logger.info("Added %s", activity_name)
+
+        # Flush from time to time, to bound the pending tile increments
+        if added % dump_every == 0:
+            heatmap.flush()
+
+    heatmap.flush()
+
+    if packs:
+        packs.flush()
+    logger.warning(
+        "%s activities added, %s in the heatmap",
+        added,
+        len(heatmap.index.activities),
+    )
+
+
+if __name__ == "__main__":
+    logger = get_logger(__name__)
+    args = parse_args()
+    main(args)
+    logging.debug("Done")
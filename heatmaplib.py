@@ -0,0 +1,335 @@
+"""
+Heatmap tiles of all activities, for the web UI.
+
+Tracks are rasterized on the standard web map tiles (Web Mercator, 256x256 pixels,
+`<z>/<x>/<y>`) at several zoom levels: the count of a pixel is the number of
+activities passing through it. Consecutive points are joined by a line, unless too
+far apart (e.g. GPS fix lost).
+
+- counts are stored per tile in the cache (`<cache>/heatmap/<z>/<x>/<y>.cnt`, a
+  zlib'ed uint32 array), with an index of the activities they include
+- tiles are rendered as PNG files (`ui/userdata/heatmap/<z>/<x>/<y>.png`), and the
+  zoom levels and bounds exported in `ui/userdata/heatmap.js`
+
+Each track is rasterized once, at the finest zoom level: coarser levels are derived
+by shifting the pixel coordinates. Adding activities only rewrites the tiles they
+touch; if an included activity changed or disappeared, the heatmap is rebuilt.
+"""
+
+import json
+import shutil
+import struct
+import sys
+import zlib
+from array import array
+from dataclasses import asdict, dataclass, field
+from math import cos, log, log1p, pi, radians, tan
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from dacite import from_dict
+
+from fitlib import (
+    DEFAULT_CACHE_PATH,
+    DEFAULT_UI_BASEDIR,
+    Track,
+    atomic_write,
+    semicircles_to_degrees,
+)
+
+HEATMAP_DIRNAME = "heatmap"
+HEATMAP_INDEX_FILENAME = "index.json"
+TILE_SIZE = 256
+DEFAULT_MIN_ZOOM = 5
+DEFAULT_MAX_ZOOM = 15
+# Consecutive points further apart, in pixels at the finest zoom level, are not
+# joined (about 300 m at zoom level 15 and 45° of latitude)
+MAX_JOIN_PIXELS = 64
+# Web Mercator is undefined at the poles
+MAX_LATITUDE = 85.0511
+# Counts from which pixels get the hottest color
+MAX_HEAT = 255
+
+Pixel = Tuple[int, int]
+Tile = Tuple[int, int, int]
+
+
+@dataclass
+class Heatmap_index:
+    # Activity name -> modification time of its source file
+    activities: Dict[str, float] = field(default_factory=dict)
+    # [[south, west], [north, east]], in degrees
+    bounds: Optional[List[List[float]]] = None
+    # False while tiles are being written: if so, they may not match the index
+    complete: bool = True
+    max_zoom: int = DEFAULT_MAX_ZOOM
+    min_zoom: int = DEFAULT_MIN_ZOOM
+
+
+def get_pixel(latitude: float, longitude: float, zoom: int) -> Pixel:
+    """Global pixel coordinates of a point, in degrees, at a zoom level"""
+    scale = TILE_SIZE * 2 ** zoom
+    phi = radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude)))
+    x = (longitude + 180) / 360 * scale
+    y = (1 - log(tan(phi) + 1 / cos(phi)) / pi) / 2 * scale
+
+    return (min(int(x), scale - 1), min(int(y), scale - 1))
+
+
+def rasterize(track: Track, zoom: int) -> Set[Pixel]:
+    """Pixels a track passes through, joining consecutive points by lines"""
+    to_return: Set[Pixel] = set()
+    previous: Optional[Pixel] = None
+
+    for tp in track.track_points:
+        if not tp.position_lat or not tp.position_long:
+            continue
+
+        pixel = get_pixel(
+            semicircles_to_degrees(int(tp.position_lat)),
+            semicircles_to_degrees(int(tp.position_long)),
+            zoom,
+        )
+
+        if previous is not None:
+            dx, dy = pixel[0] - previous[0], pixel[1] - previous[1]
+            steps = max(abs(dx), abs(dy))
+
+            if 1 < steps <= MAX_JOIN_PIXELS:
+                to_return.update(
+                    (previous[0] + dx * i // steps, previous[1] + dy * i // steps)
+
+                    for i in range(1, steps)
+                )
+        to_return.add(pixel)
+        previous = pixel
+
+    return to_return
+
+
+def get_palette() -> Tuple[bytes, bytes]:
+    """Colors and opacities of the counts 0 to `MAX_HEAT`: from red to yellow"""
+    colors = bytearray(3)
+    alphas = bytearray(1)
+
+    for count in range(1, MAX_HEAT + 1):
+        heat = log1p(count) / log1p(MAX_HEAT)
+        colors += bytes([255, int(255 * heat), int(64 * heat)])
+        alphas.append(int(128 + 127 * heat))
+
+    return (bytes(colors), bytes(alphas))
+
+
+PALETTE = get_palette()
+
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data))
+        + chunk_type
+        + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data))
+    )
+
+
+def render_png(counts: array) -> bytes:
+    """Encode the counts of a tile as an indexed PNG image"""
+    # Low bytes of the counts, the others being zero up to MAX_HEAT
+    low_byte = 0 if sys.byteorder == "little" else counts.itemsize - 1
+    pixels = bytearray(counts.tobytes()[low_byte :: counts.itemsize])
+
+    if max(counts) > MAX_HEAT:
+        for offset, count in enumerate(counts):
+            if count > MAX_HEAT:
+                pixels[offset] = MAX_HEAT
+    # Each row starts with its filter type (0: none)
+    rows = b"".join(
+        [
+            b"\x00" + bytes(pixels[row : row + TILE_SIZE])
+
+            for row in range(0, len(pixels), TILE_SIZE)
+        ]
+    )
+    colors, alphas = PALETTE
+
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            _png_chunk(
+                b"IHDR", struct.pack(">IIBBBBB", TILE_SIZE, TILE_SIZE, 8, 3, 0, 0, 0)
+            ),
+            _png_chunk(b"PLTE", colors),
+            _png_chunk(b"tRNS", alphas),
+            _png_chunk(b"IDAT", zlib.compress(rows)),
+            _png_chunk(b"IEND", b""),
+        ]
+    )
+
+
+class Heatmap:
+    """Tile counts of the included activities, written on `flush()`"""
+
+    def __init__(
+        self,
+        cache_path_name: Optional[str] = None,
+        ui_basedir: Optional[str] = None,
+    ) -> None:
+        if not cache_path_name:
+            cache_path_name = DEFAULT_CACHE_PATH
+
+        if not ui_basedir:
+            ui_basedir = DEFAULT_UI_BASEDIR
+        self.tile_dir = Path(cache_path_name) / HEATMAP_DIRNAME
+        self.png_dir = Path(ui_basedir) / "userdata" / HEATMAP_DIRNAME
+        self.js_file = Path(ui_basedir) / "userdata" / "heatmap.js"
+        self.index = Heatmap_index()
+        # Tile -> pixel offset in the tile -> count increment, not written yet
+        self.increments: Dict[Tile, Dict[int, int]] = {}
+        self.dirty = False
+        index_file = self.tile_dir / HEATMAP_INDEX_FILENAME
+
+        if index_file.exists():
+            with index_file.open() as f_handler:
+                self.index = from_dict(
+                    data_class=Heatmap_index, data=json.load(f_handler)
+                )
+
+    def is_outdated(
+        self, mtimes: Dict[str, float], min_zoom: int, max_zoom: int
+    ) -> bool:
+        """Whether included activities changed, or the zooms changed
+
+        `mtimes` maps the name of activities to the modification time of their
+        source file: only the included activities among them are checked, so that
+        heatmaps can be updated from a subset of the files. Activities whose file
+        disappeared are only dropped by a rebuild. The heatmap is also outdated if
+        its last flush was interrupted.
+        """
+
+        if not self.index.complete:
+            return True
+
+        if (self.index.min_zoom, self.index.max_zoom) != (min_zoom, max_zoom):
+            return True
+
+        return any(
+            name in mtimes and mtimes[name] != mtime
+
+            for name, mtime in self.index.activities.items()
+        )
+
+    def clear(self, min_zoom: int, max_zoom: int) -> None:
+        """Remove all tiles, to rebuild the heatmap from scratch"""
+
+        for path in [self.tile_dir, self.png_dir]:
+            if path.exists():
+                shutil.rmtree(path)
+        self.index = Heatmap_index(min_zoom=min_zoom, max_zoom=max_zoom)
+        self.increments = {}
+        self.dirty = True
+
+    def add(self, track: Track, mtime: float) -> None:
+        pixels = rasterize(track, self.index.max_zoom)
+
+        for zoom in range(self.index.max_zoom, self.index.min_zoom - 1, -1):
+            for x, y in pixels:
+                tile = (zoom, x // TILE_SIZE, y // TILE_SIZE)
+                offset = (y % TILE_SIZE) * TILE_SIZE + x % TILE_SIZE
+                increments = self.increments.setdefault(tile, {})
+                increments[offset] = increments.get(offset, 0) + 1
+
+            # One pixel at the next zoom level covers 2x2 pixels
+            pixels = {(x // 2, y // 2) for x, y in pixels}
+
+        self.index.activities[track.name] = mtime
+        self.update_bounds(track)
+        self.dirty = True
+
+    def update_bounds(self, track: Track) -> None:
+        latitudes = [
+            semicircles_to_degrees(int(tp.position_lat))
+
+            for tp in track.track_points
+
+            if tp.position_lat and tp.position_long
+        ]
+        longitudes = [
+            semicircles_to_degrees(int(tp.position_long))
+
+            for tp in track.track_points
+
+            if tp.position_lat and tp.position_long
+        ]
+
+        if not latitudes:
+            return
+
+        if self.index.bounds is not None:
+            (south, west), (north, east) = self.index.bounds
+            latitudes += [south, north]
+            longitudes += [west, east]
+        self.index.bounds = [
+            [min(latitudes), min(longitudes)],
+            [max(latitudes), max(longitudes)],
+        ]
+
+    def get_tile_filename(self, tile: Tile) -> Path:
+        zoom, x, y = tile
+
+        return self.tile_dir / str(zoom) / str(x) / f"{y}.cnt"
+
+    def load_tile(self, tile: Tile) -> array:
+        to_return = array("I")
+        tile_file = self.get_tile_filename(tile)
+
+        if tile_file.exists():
+            to_return.frombytes(zlib.decompress(tile_file.read_bytes()))
+        else:
+            to_return.frombytes(bytes(4 * TILE_SIZE * TILE_SIZE))
+
+        return to_return
+
+    def write_index(self) -> None:
+        with atomic_write(self.tile_dir / HEATMAP_INDEX_FILENAME) as f_handler:
+            json.dump(asdict(self.index), f_handler)
+
+    def flush(self) -> None:
+        """Add the increments to the touched tiles, render them, write the index"""
+
+        if not self.dirty:
+            return
+
+        self.index.complete = False
+        self.write_index()
+
+        for tile, increments in self.increments.items():
+            counts = self.load_tile(tile)
+
+            for offset, increment in increments.items():
+                counts[offset] += increment
+
+            with atomic_write(self.get_tile_filename(tile), "wb") as f_handler:
+                f_handler.write(zlib.compress(counts.tobytes()))
+            zoom, x, y = tile
+            png_file = self.png_dir / str(zoom) / str(x) / f"{y}.png"
+
+            with atomic_write(png_file, "wb") as f_handler:
+                f_handler.write(render_png(counts))
+
+        self.increments = {}
+        self.index.complete = True
+        self.write_index()
+
+        with atomic_write(self.js_file) as f_handler:
+            f_handler.write("heatmap = ")
+            json.dump(
+                {
+                    "bounds": self.index.bounds,
+                    "count": len(self.index.activities),
+                    "max_zoom": self.index.max_zoom,
+                    "min_zoom": self.index.min_zoom,
+                },
+                f_handler,
+            )
+            f_handler.write(";\n")
+        self.dirty = False
@@ -1,30 +1,69 @@
 #!/usr/bin/env python
 """
+Import the Strava segments listed in `strava_segments.json` files into
+`segment_definitions.json`.
+
+Segments are fetched concurrently, with retries, exponential backoff and rate
+limiting. Responses are cached in `~/.cache/fit2segments/requests_cache`. With
+`--incremental`, the segments already present in the output file are kept and not
+fetched again.
 """
 
 import argparse
 import json
 import logging
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict
 from pathlib import Path
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
 import requests
 import requests_cache
 from bs4 import BeautifulSoup
 
-from fitlib import Segment_definition, Segment_definition_point, get_logger
+from fitlib import (
+    DEFAULT_SEGMENT_DEFINITIONS_FILENAME,
+    Segment_definition,
+    Segment_definition_point,
+    get_logger,
+)
 
 requests_cache.install_cache(
     str(Path.home() / ".cache" / "fit2segments" / "requests_cache")
 )
 
+DEFAULT_BASE_URL = "https://www.strava.com"
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
 headers = {
     "cookie": "explore_activity_type=cycling; G_ENABLED_IDPS=google; _ga=GA1.2.615208174.1605042358; sp=2aa4bf96-50a8-42dd-bc02-355203e01fbb; _strava4_session=1l7jtacu7dh51gkr8mcfg2aogmrc9c4s; ajs_anonymous_id=%22b3b72ac5-7a62-4c74-b7cc-bcdd53836b88%22; _sp_id.f55d=61988c17-863b-41c0-b9cb-1ec43a47f6bf.1607287259.1.1607287383.1607287259.f5c8d595-1214-4aba-9042-dd73a289c8a6; _gid=GA1.2.1038856937.1611197897; iterableEndUserId=wbwilliam7%40gmail.com; iterableEmailCampaignId=1393220; iterableTemplateId=1934428; iterableMessageId=e49f39f0b6a4469c9ea8461344553d04; _sp_ses.047d=*; elevate_daily_connection_done=true; elevate_athlete_update_done=true; fbm_284597785309=base_domain=.www.strava.com; _sp_id.047d=eb14ffe9-6f80-48ea-a580-99567a3b3682.1602189983.45.1611263211.1611203545.3f221abb-04fb-4e7c-ab8e-4ea0f4339271; fbsr_284597785309=HpPGWG7UJ6j6tZFoj7ekjCF3q4sSG55P6kxrJIhd3HQ.eyJ1c2VyX2lkIjoiMzI2NTk5NTk5MzQzMDgyNyIsImNvZGUiOiJBUUJmN2FEbDdyTkxCZVpUWTVqZVV6LXlRZE9VSXJjXzF1NHZvcUVPNFRjbTQ4N2xqdnpOT0VlNkVqQ1J3QXFyY0ZIQ3FQdFd6R0ZOLWJjZmFlVXk1YmtNNkxtX0NWQlhKUU9ncnNqc09MalZDWmo1bE15NVFZQWdkbUxkV25lbjRGc3VKd3BKdk84QUs5Wm91XzlsVlh5Mk9DaUJxS0daR1hmeFRHWGREaU9FaVhvb1lncTNGY1ctSTQzVVNPbUE3eV9zUlBOd3o2M1ZMTmNUbXJBUnNZR1N0ZWFiTFBJLVRVR3lRUUZSSUVQU183Si0zakJpSmdaZnlVcWNhR0Q4VTl6bTdwRml1cV83WnRHS3R4TUZIR0ZaVGxPSmc1cGVZWE42NEZYd3hWOE9pYnVmTHU1MEZlRUhpSFdUbFVDR2owZ3dBMzAyMWVWeHNGV2NQb1dOOUkwNSIsIm9hdXRoX3Rva2VuIjoiRUFBQUFRa05aQWt0MEJBSktaQURXbnlUbnRZTVVqNGVoYjlEbGl1MWtLU3M0d2djUmZyMUd1MmtVaUN3Z2dXVUtuenFlSzdya2lLZlBYVWJJenhMazAyM1N6WW16ZVF1VTNuN3ltU2RiNGFIdlVCV05VbkVFYmNHSjFNTDRYakl1b1dWbXhaQ2NtcVpDTnBJWkM2T1pDQW8zbkdsTDYyVGF4VWQwZ1lCaEdjWkFZWDRXNzdseFhPM3EyUENHa09BSEwxQlIwYVR0a2ZVSjZydzBjNVdKR1FjIiwiYWxnb3JpdGhtIjoiSE1BQy1TSEEyNTYiLCJpc3N1ZWRfYXQiOjE2MTEyNjMyMTJ9"
 }
 
 
+class Rate_limiter:
+    """Space requests at least `1 / rate` seconds apart, across all threads"""
+
+    def __init__(self, rate: Optional[float]) -> None:
+        self.interval = 1 / rate if rate else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
 def parse_args() -> argparse.Namespace:
     """ Call me with args = parse_args() """
     parser: argparse.ArgumentParser = argparse.ArgumentParser(
@@ -34,7 +73,38 @@ def parse_args() -> argparse.Namespace:
     # Positional arguments
     parser.add_argument("strava_segments_files", nargs="+", help="Strava segment files")
 
+    # Options
+    parser.add_argument(
+        "--output",
+        "-o",
+        default=DEFAULT_SEGMENT_DEFINITIONS_FILENAME,
+        help="Segment definitions file to write",
+    )
+    parser.add_argument(
+        "--base-url",
+        default=DEFAULT_BASE_URL,
+        help="Base URL of the Strava web site (or of a local stand-in server)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=8, help="Number of concurrent downloads"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=10.0,
+        help="Maximum number of requests per second, 0 to disable",
+    )
+    parser.add_argument(
+        "--retries", type=int, default=4, help="Number of retries per request"
+    )
+
     # Boolean
+    parser.add_argument(
+        "--incremental",
+        "-i",
+        help="Only fetch segments not already in the output file",
+        action="store_true",
+    )
     parser.add_argument("--verbose", "-v", help="Verbose mode", action="store_true")
 
     args: argparse.Namespace = parser.parse_args()
@@ -47,16 +117,49 @@ def parse_args() -> argparse.Namespace:
     return args
 
 
+def fetch(
+    url: str, limiter: Rate_limiter, retries: int = 4, backoff: float = 1.0
+) -> requests.Response:
+    """GET `url`, retrying with exponential backoff on errors and throttling"""
+
+    error = ""
+
+    for attempt in range(retries + 1):
+        if attempt:
+            delay = backoff * 2 ** (attempt - 1)
+            logger.warning("%s: %s, retrying in %ss", url, error, delay)
+            time.sleep(delay)
+
+        limiter.wait()
+        try:
+            response = requests.get(url, headers=headers, timeout=30)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = str(e)
+
+            continue
+
+        if response.status_code not in RETRY_STATUS_CODES:
+            response.raise_for_status()
+
+            return response
+
+        error = f"HTTP {response.status_code}"
+        retry_after = response.headers.get("Retry-After", "")
+
+        if retry_after.isdigit():
+            time.sleep(int(retry_after))
+
+    raise requests.HTTPError(f"{url}: {error} after {retries + 1} attempts")
+
+
 def get_segment_start_stops(
-    seg_id: int,
+    seg_id: int, base_url: str, limiter: Rate_limiter, retries: int = 4
 ) -> Tuple[Segment_definition_point, Segment_definition_point, List[List[float]]]:
-    print(seg_id)
-    
-    data_req = requests.get(
-        (f"https://www.strava.com/stream/segments/{seg_id}" f"?streams%5B%5D=latlng"), headers=headers
+    logger.debug("Fetching stream of segment %s", seg_id)
+
+    data_req = fetch(
+        f"{base_url}/stream/segments/{seg_id}?streams%5B%5D=latlng", limiter, retries
     )
-    # assert data_req.status_code == 200
-    print(data_req.text)
     data = data_req.json()
 
     start = Segment_definition_point(
@@ -75,10 +178,12 @@ def get_segment_start_stops(
     return (start, stop, data["latlng"])
 
 
-def get_segment_public_metadata(seg_id: int) -> Dict[str, Any]:
+def get_segment_public_metadata(
+    seg_id: int, base_url: str, limiter: Rate_limiter, retries: int = 4
+) -> Dict[str, Any]:
+    logger.debug("Fetching metadata of segment %s", seg_id)
 
-    metadata_req = requests.get(f"https://www.strava.com/segments/{seg_id}", headers=headers)
-    assert metadata_req.status_code == 200
+    metadata_req = fetch(f"{base_url}/segments/{seg_id}", limiter, retries)
     soup = BeautifulSoup(metadata_req.text, "html.parser")
 
     strava_name = soup.find(id="js-full-name").text
@@ -110,8 +215,36 @@ def get_segment_public_metadata(seg_id: int) -> Dict[str, Any]:
     return to_return
 
 
-def import_from_strava(filename: str) -> List[Segment_definition]:
-    """docstring for import_from_strava"""
+def import_segment(
+    seg_id: int, base_url: str, limiter: Rate_limiter, retries: int = 4
+) -> Segment_definition:
+    start, stop, latlng = get_segment_start_stops(seg_id, base_url, limiter, retries)
+    metadata = get_segment_public_metadata(seg_id, base_url, limiter, retries)
+
+    return Segment_definition(
+        debug=False,
+        name=metadata["name"],
+        start=start,
+        stop=stop,
+        strava_id=metadata["strava_id"],
+        latlng=latlng,
+    )
+
+
+def import_from_strava(
+    filename: str,
+    base_url: str = DEFAULT_BASE_URL,
+    known_ids: Optional[Set[int]] = None,
+    workers: int = 8,
+    limiter: Optional[Rate_limiter] = None,
+    retries: int = 4,
+) -> List[Segment_definition]:
+    """Import the segments listed in `filename`, skipping `known_ids`
+
+    Segments are fetched by a pool of `workers` threads sharing `limiter`. A segment
+    that still fails after `retries` retries is logged and left out, so that it can
+    be picked up by a later incremental import.
+    """
     strava_segments_file: Path = Path(filename)
     assert strava_segments_file.exists()
     with strava_segments_file.open() as f_handler:
@@ -119,36 +252,79 @@ def import_from_strava(filename: str) -> List[Segment_definition]:
 
     # Also supports: streams%5B%5D=distance&streams%5B%5D=altitude&_=1590644676298
 
-    to_return = []
+    if known_ids is None:
+        known_ids = set()
+
+    if limiter is None:
+        limiter = Rate_limiter(None)
+
+    seg_ids: List[int] = []
 
     for strava_segment in strava_segments:
-        seg_name: str = str(strava_segment["name"])
         seg_id: int = int(strava_segment["strava_segment_id"])
-        logger.warning("Importing segment %s", seg_name)
-
-        start, stop, latlng = get_segment_start_stops(seg_id)
-        metadata = get_segment_public_metadata(seg_id)
-        new_segment_definition: Segment_definition = Segment_definition(
-            debug=False,
-            name=metadata["name"],
-            start=start,
-            stop=stop,
-            strava_id=metadata["strava_id"],
-            latlng=latlng,
-        )
-        to_return.append(new_segment_definition)
+
+        if seg_id in known_ids or seg_id in seg_ids:
+            logger.debug("Skipping known segment %s", strava_segment["name"])
+
+            continue
+        logger.warning("Importing segment %s", strava_segment["name"])
+        seg_ids.append(seg_id)
+
+    to_return = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(import_segment, seg_id, base_url, limiter, retries)
+
+            for seg_id in seg_ids
+        ]
+
+        for seg_id, future in zip(seg_ids, futures):
+            try:
+                to_return.append(future.result())
+            except (requests.RequestException, AssertionError, KeyError) as e:
+                logger.error("Segment %s could not be imported: %s", seg_id, e)
 
     return to_return
 
 
 def main(args: argparse.Namespace) -> None:
+    output_file = Path(args.output)
+    known_segments: List[Dict[str, Any]] = []
+
+    if args.incremental and output_file.exists():
+        with output_file.open() as f_handler:
+            known_segments = json.load(f_handler)
+
+    known_ids = {seg["strava_id"] for seg in known_segments if seg.get("strava_id")}
+    limiter = Rate_limiter(args.rate)
     imported_segments = []
 
     for strava_segments_file in args.strava_segments_files:
-        imported_segments.extend(import_from_strava(strava_segments_file))
+        imported_segments.extend(
+            import_from_strava(
+                strava_segments_file,
+                base_url=args.base_url.rstrip("/"),
+                known_ids=known_ids,
+                workers=args.workers,
+                limiter=limiter,
+                retries=args.retries,
+            )
+        )
+        known_ids.update(seg.strava_id for seg in imported_segments if seg.strava_id)
 
-    with open("segment_definitions.json", "w") as f_handler:
-        json.dump([asdict(seg) for seg in imported_segments], f_handler, indent=True)
+    logger.warning(
+        "%s segments imported, %s already known",
+        len(imported_segments),
+        len(known_segments),
+    )
+
+    with output_file.open("w") as f_handler:
+        json.dump(
+            known_segments + [asdict(seg) for seg in imported_segments],
+            f_handler,
+            indent=True,
+        )
 
 
 if __name__ == "__main__":
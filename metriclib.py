@@ -0,0 +1,162 @@
+"""
+Metrics of segment attempts, all computed in one pass over the track points.
+
+`SEGMENT_METRICS` maps each metric field of `Segment` to the accumulator computing
+it: its source field, unit conversion and aggregation. All accumulators are fed
+each pair of consecutive track points once, with the seconds elapsed between them,
+so that adding a metric does not add a pass over the points.
+
+Like a 1 Hz resampling, the value of each point is weighted by the seconds elapsed
+since the previous point, and the value of the first point is ignored.
+"""
+
+from abc import ABC, abstractmethod
+from math import sqrt
+from typing import Any, Callable, Dict, List, Optional
+
+from fitlib import Elevation_counter, Metric, Track_point
+
+
+class Accumulator(ABC):
+    """Metric of an attempt, fed each pair of consecutive track points"""
+
+    @abstractmethod
+    def add(
+        self, previous: Track_point, track_point: Track_point, seconds: int
+    ) -> None:
+        pass
+
+    @abstractmethod
+    def result(self) -> Any:
+        pass
+
+
+class Weighted_metric(Accumulator):
+    """Time-weighted average, standard deviation, min and max of a field
+
+    The metric is None if any point lacks the field, or if fewer than 2 seconds
+    are covered.
+    """
+
+    def __init__(self, field_name: str, factor: float = 1.0) -> None:
+        self.field_name = field_name
+        self.factor = factor
+        self.missing = False
+        self.weight = 0
+        self.mean = 0.0
+        # Weighted sum of squared differences from the mean (West's algorithm)
+        self.squares = 0.0
+        self.lower = float("inf")
+        self.upper = float("-inf")
+
+    def add(
+        self, previous: Track_point, track_point: Track_point, seconds: int
+    ) -> None:
+        value = getattr(track_point, self.field_name, None)
+
+        if value is None or getattr(previous, self.field_name, None) is None:
+            self.missing = True
+
+            return
+
+        if self.missing or seconds == 0:
+            return
+
+        value *= self.factor
+        self.weight += seconds
+        delta = value - self.mean
+        self.mean += delta * seconds / self.weight
+        self.squares += seconds * delta * (value - self.mean)
+        self.lower = min(self.lower, value)
+        self.upper = max(self.upper, value)
+
+    def result(self) -> Optional[Metric]:
+        if self.missing or self.weight < 2:
+            return None
+
+        return Metric(
+            avg=self.mean,
+            upper=self.upper,
+            lower=self.lower,
+            stdev=sqrt(max(self.squares, 0.0) / (self.weight - 1)),
+        )
+
+
+class Elevation_gain(Accumulator):
+    """Elevation gain, in meters, cf. `Elevation_counter`"""
+
+    def __init__(self) -> None:
+        self.counter = Elevation_counter()
+        self.started = False
+
+    def add(
+        self, previous: Track_point, track_point: Track_point, seconds: int
+    ) -> None:
+        if not self.started:
+            self.counter.add(previous.enhanced_altitude)
+            self.started = True
+        self.counter.add(track_point.enhanced_altitude)
+
+    def result(self) -> Optional[float]:
+        return self.counter.gain if self.counter.reference is not None else None
+
+
+class Grade(Accumulator):
+    """Grade, in percent, from the first to the last point with altitude and distance"""
+
+    def __init__(self) -> None:
+        self.first: Optional[Track_point] = None
+        self.last: Optional[Track_point] = None
+
+    def add(
+        self, previous: Track_point, track_point: Track_point, seconds: int
+    ) -> None:
+        for tp in [previous, track_point]:
+            if tp.enhanced_altitude is None or tp.distance is None:
+                continue
+
+            if self.first is None:
+                self.first = tp
+            self.last = tp
+
+    def result(self) -> Optional[float]:
+        if self.first is None or self.last is None:
+            return None
+
+        assert self.first.distance is not None and self.last.distance is not None
+        assert self.first.enhanced_altitude is not None
+        assert self.last.enhanced_altitude is not None
+        distance = self.last.distance - self.first.distance
+        climb = self.last.enhanced_altitude - self.first.enhanced_altitude
+
+        return 100 * climb / distance if distance > 0 else None
+
+
+# Segment field -> accumulator factory
+SEGMENT_METRICS: Dict[str, Callable[[], Accumulator]] = {
+    "cadence": lambda: Weighted_metric("cadence"),
+    "elevation_gain": Elevation_gain,
+    "grade": Grade,
+    "heart_rate": lambda: Weighted_metric("heart_rate"),
+    "power": lambda: Weighted_metric("power"),
+    # cf. <https://github.com/pcolby/bipolar/issues/74>
+    "speed": lambda: Weighted_metric("enhanced_speed", 3.6),
+    "temperature": lambda: Weighted_metric("temperature"),
+}
+
+
+def compute_metrics(segment_points: List[Track_point]) -> Dict[str, Any]:
+    """Compute all `SEGMENT_METRICS` of the points of an attempt, in one pass"""
+    accumulators = [factory() for factory in SEGMENT_METRICS.values()]
+
+    for previous, track_point in zip(segment_points, segment_points[1:]):
+        seconds = (track_point.timestamp - previous.timestamp).seconds
+
+        for accumulator in accumulators:
+            accumulator.add(previous, track_point, seconds)
+
+    return {
+        metric_name: accumulator.result()
+
+        for metric_name, accumulator in zip(SEGMENT_METRICS, accumulators)
+    }
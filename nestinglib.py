@@ -0,0 +1,139 @@
+"""
+Detection of nested segments, e.g. a short segment that is the last 2 km of a
+longer climb.
+
+- Segment definitions: a definition is nested in another if its start and stop
+  points lie, in this order, on the polyline of the other. Polyline points are
+  indexed in a grid, so that only definitions passing near a start point are
+  checked, instead of comparing all pairs.
+- Attempts: within an activity, an attempt is nested in another if it starts after
+  and stops before it, and if its definition is nested in the definition of the
+  other, i.e. it also lies within the other along the track (attempts do not
+  record distances). Attempts are sorted by start time and swept once.
+
+Both set the `nested_in` field (uids of the enclosing segments).
+"""
+
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from fitlib import Segment, Segment_definition, haversine, semicircles_to_degrees
+
+# Max distance, in meters, between the start/stop of a segment and the polyline
+NESTING_TOLERANCE = 50.0
+# Grid cell size, in degrees, larger than the tolerance
+GRID_CELL_SIZE = 0.01
+
+
+def _get_cell(lat: float, long: float) -> Tuple[int, int]:
+    return (int(lat // GRID_CELL_SIZE), int(long // GRID_CELL_SIZE))
+
+
+def _get_nearby_cells(lat: float, long: float) -> List[Tuple[int, int]]:
+    cell_lat, cell_long = _get_cell(lat, long)
+
+    return [(cell_lat + i, cell_long + j) for i in (-1, 0, 1) for j in (-1, 0, 1)]
+
+
+def _find_on_polyline(
+    polyline: List[List[float]], lat: float, long: float, first: int = 0
+) -> int:
+    """Index of the first polyline point from `first` within the tolerance, or -1"""
+
+    for idx in range(first, len(polyline)):
+        if haversine(polyline[idx][0], polyline[idx][1], lat, long) < NESTING_TOLERANCE:
+            return idx
+
+    return -1
+
+
+def index_nested_definitions(segment_definitions: List[Segment_definition]) -> None:
+    """Set `nested_in` of each definition, from the polylines of the others"""
+    grid: Dict[Tuple[int, int], Set[int]] = {}
+
+    for sd_idx, segment_definition in enumerate(segment_definitions):
+        segment_definition.nested_in = []
+
+        for lat, long in segment_definition.latlng or []:
+            grid.setdefault(_get_cell(lat, long), set()).add(sd_idx)
+
+    for segment_definition in segment_definitions:
+        ends = [
+            (
+                semicircles_to_degrees(int(point.latitude)),
+                semicircles_to_degrees(int(point.longitude)),
+            )
+
+            for point in [segment_definition.start, segment_definition.stop]
+        ]
+        candidates = [
+            set().union(*[grid.get(cell, set()) for cell in _get_nearby_cells(*end)])
+
+            for end in ends
+        ]
+
+        for parent_idx in sorted(candidates[0] & candidates[1]):
+            parent = segment_definitions[parent_idx]
+
+            if (
+                parent.uid == segment_definition.uid
+                or parent.uid in segment_definition.nested_in
+                or not parent.latlng
+            ):
+                continue
+
+            start_idx = _find_on_polyline(parent.latlng, *ends[0])
+            stop_idx = _find_on_polyline(parent.latlng, *ends[1], first=start_idx + 1)
+
+            # The segment must follow the parent, and be strictly shorter
+            if start_idx < 0 or stop_idx < 0:
+                continue
+
+            if start_idx == 0 and stop_idx == len(parent.latlng) - 1:
+                continue
+
+            segment_definition.nested_in.append(parent.uid)
+
+
+def index_nested_segments(
+    segments: List[Segment],
+    segment_definitions: Optional[List[Segment_definition]] = None,
+) -> None:
+    """Set `nested_in` of each attempt, from the other attempts of its activity
+
+    If `segment_definitions` are given, with their `nested_in` set (cf.
+    `index_nested_definitions()`), an attempt is only nested in the attempts of the
+    segments its definition is nested in: overlapping in time is not enough, e.g.
+    for an out-and-back segment within a loop.
+    """
+    by_activity: Dict[str, List[Segment]] = {}
+    nested_definitions: Optional[Dict[str, Set[str]]] = None
+
+    if segment_definitions is not None:
+        nested_definitions = {sd.uid: set(sd.nested_in) for sd in segment_definitions}
+
+    for segment in segments:
+        by_activity.setdefault(segment.activity_name, []).append(segment)
+
+    for activity_segments in by_activity.values():
+        # Sort by start time, longest first, so that parents come before children
+        activity_segments.sort(key=lambda s: (s.start_time, -s.duration))
+        active: List[Tuple[datetime, Segment]] = []
+
+        for segment in activity_segments:
+            stop_time = segment.start_time + segment.duration
+            active = [(stop, s) for stop, s in active if stop > segment.start_time]
+            segment.nested_in = [
+                s.segment_uid
+
+                for stop, s in active
+
+                if stop >= stop_time
+                and s.segment_uid != segment.segment_uid
+                and (
+                    nested_definitions is None
+                    or s.segment_uid
+                    in nested_definitions.get(segment.segment_uid, set())
+                )
+            ]
+            active.append((stop_time, segment))
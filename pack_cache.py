@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Maintain the packed track cache (`~/.cache/fit2segments/packs`), used by
+`fit2segments.py --packed-cache`:
+
+- with `--import-loose`, pack the `.pbz2` files of the cache directory
+- rewrite the packs holding too many superseded tracks (e.g. re-parsed files)
+"""
+
+import argparse
+import logging
+
+from fitlib import DEFAULT_CACHE_PATH, get_logger
+from packlib import DEFAULT_MAX_DEAD_RATIO, Pack_store
+
+
+def parse_args() -> argparse.Namespace:
+    """ Call me with args = parse_args() """
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    # Options
+    parser.add_argument(
+        "--cache", default=DEFAULT_CACHE_PATH, help="Cache directory to pack"
+    )
+    parser.add_argument(
+        "--max-dead-ratio",
+        type=float,
+        default=DEFAULT_MAX_DEAD_RATIO,
+        help="Rewrite packs with a larger share of superseded bytes",
+    )
+
+    # Boolean
+    parser.add_argument(
+        "--import-loose",
+        "-i",
+        help="Pack the .pbz2 files of the cache directory",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--remove", help="Remove the .pbz2 files once packed", action="store_true"
+    )
+    parser.add_argument("--verbose", "-v", help="Verbose mode", action="store_true")
+
+    args: argparse.Namespace = parser.parse_args()
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    return args
+
+
+def main(args: argparse.Namespace) -> None:
+    packs = Pack_store(args.cache)
+
+    if args.import_loose:
+        logger.warning("%s cached tracks packed", packs.import_loose(args.remove))
+        packs.flush()
+
+    for pack_name in packs.repack(args.max_dead_ratio):
+        logger.warning("%s repacked", pack_name)
+
+
+if __name__ == "__main__":
+    logger = get_logger(__name__)
+    args = parse_args()
+    main(args)
+    logging.debug("Done")
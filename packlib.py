@@ -0,0 +1,251 @@
+"""
+Packed track cache: cached tracks appended into a few large files, instead of one
+`.pbz2` file per activity.
+
+Tracks are stored in one pack file per year (`<cache>/packs/<year>.pack`), each
+entry being the same bz2'ed pickle as a `.pbz2` file. An index
+(`<cache>/packs/index.json`) maps each activity to its pack, offset and length, and
+to the modification time of its source file, so that:
+
+- a single track is read with one seek and one read
+- new (or re-parsed) tracks are appended, and the index updated on `flush()`
+- all tracks of a pack are read sequentially, in one pass over the file
+- `repack()` rewrites the packs holding superseded entries (packs are then named
+  `<year>.<timestamp>.pack`, new tracks still go to `<year>.pack`)
+
+A crash before `flush()` only leaves unreferenced bytes at the end of packs, which
+the next repack drops. There must be a single writer at a time.
+"""
+
+import bz2
+import json
+import os
+import pickle
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from dacite import from_dict
+
+from fitlib import (
+    DEFAULT_CACHE_PATH,
+    Output_writer,
+    Track,
+    filename2activityname,
+    get_ui_trace_filename,
+    parse_file,
+    write_ui_trace,
+)
+
+PACK_DIRNAME = "packs"
+PACK_INDEX_FILENAME = "index.json"
+# Packs with a larger share of superseded bytes are rewritten by `repack()`
+DEFAULT_MAX_DEAD_RATIO = 0.2
+
+
+@dataclass
+class Pack_entry:
+    length: int
+    mtime: float
+    offset: int
+    pack: str
+
+
+def get_pack_name(track: Track) -> str:
+    if not track.track_points:
+        return "empty.pack"
+
+    return f"{track.track_points[0].timestamp.year}.pack"
+
+
+class Pack_store:
+    """Cached tracks, packed by year, with an offset index"""
+
+    def __init__(self, cache_path_name: Optional[str] = None) -> None:
+        if not cache_path_name:
+            cache_path_name = DEFAULT_CACHE_PATH
+        self.pack_dir = Path(cache_path_name) / PACK_DIRNAME
+        self.index: Dict[str, Pack_entry] = {}
+        self.dirty = False
+        index_file = self.pack_dir / PACK_INDEX_FILENAME
+
+        if index_file.exists():
+            with index_file.open() as f_handler:
+                self.index = {
+                    name: from_dict(data_class=Pack_entry, data=data)
+
+                    for name, data in json.load(f_handler).items()
+                }
+
+    def is_valid(self, fitfilename: str) -> bool:
+        """Whether the packed track of a file exists, and is not older than the file"""
+        entry = self.index.get(filename2activityname(fitfilename))
+
+        if entry is None:
+            return False
+
+        source_file = Path(fitfilename)
+
+        return not source_file.exists() or entry.mtime >= source_file.stat().st_mtime
+
+    def get(self, activity_name: str) -> Optional[Track]:
+        entry = self.index.get(activity_name)
+
+        if entry is None:
+            return None
+
+        with (self.pack_dir / entry.pack).open("rb") as f_handler:
+            f_handler.seek(entry.offset)
+            data = f_handler.read(entry.length)
+        to_return: Track = pickle.loads(bz2.decompress(data))
+
+        return to_return
+
+    def add_data(
+        self, activity_name: str, pack_name: str, data: bytes, mtime: float
+    ) -> None:
+        """Append a compressed track, superseding its previous entry, if any"""
+        self.pack_dir.mkdir(parents=True, exist_ok=True)
+
+        with (self.pack_dir / pack_name).open("ab") as f_handler:
+            offset = f_handler.tell()
+            f_handler.write(data)
+
+        self.index[activity_name] = Pack_entry(
+            length=len(data), mtime=mtime, offset=offset, pack=pack_name
+        )
+        self.dirty = True
+
+    def add(self, track: Track, mtime: float) -> None:
+        self.add_data(
+            track.name, get_pack_name(track), bz2.compress(pickle.dumps(track)), mtime
+        )
+
+    def load_file(
+        self,
+        fitfilename: str,
+        writer: Optional[Output_writer] = None,
+        ui_basedir: Optional[str] = None,
+    ) -> Track:
+        """Load the track of a file from the packs, parsing and packing it if needed
+
+        If `writer` is given, the trace is written in background. Packing is not:
+        the index is not thread-safe.
+        """
+
+        if self.is_valid(fitfilename):
+            track = self.get(filename2activityname(fitfilename))
+            assert track is not None
+        else:
+            track = parse_file(fitfilename)
+            source_file = Path(fitfilename)
+            self.add(track, source_file.stat().st_mtime if source_file.exists() else 0)
+            # The trace may be missing or outdated
+            ui_file = get_ui_trace_filename(fitfilename, ui_basedir)
+
+            if writer is None:
+                writer = Output_writer(workers=0)
+            writer.submit(write_ui_trace, track, ui_file, key=str(ui_file))
+
+        return track
+
+    def import_loose(self, remove: bool = False) -> int:
+        """Pack the `.pbz2` files of the cache directory, return how many were packed
+
+        Their compressed data is copied as is, only decompressed to get the year.
+        """
+        imported = 0
+
+        for cached_file in sorted(self.pack_dir.parent.glob("*.pbz2")):
+            data = cached_file.read_bytes()
+            track: Track = pickle.loads(bz2.decompress(data))
+            self.add_data(
+                track.name, get_pack_name(track), data, cached_file.stat().st_mtime
+            )
+            imported += 1
+
+            if remove:
+                # Removed files must be in the index first
+                self.flush()
+                cached_file.unlink()
+
+        return imported
+
+    def iter_tracks(self, pack_name: Optional[str] = None) -> Iterator[Track]:
+        """Yield all tracks (of a pack), reading each pack sequentially"""
+        entries_by_pack: Dict[str, List[Pack_entry]] = {}
+
+        for entry in self.index.values():
+            if pack_name is None or entry.pack == pack_name:
+                entries_by_pack.setdefault(entry.pack, []).append(entry)
+
+        for name in sorted(entries_by_pack):
+            with (self.pack_dir / name).open("rb") as f_handler:
+                for entry in sorted(entries_by_pack[name], key=lambda e: e.offset):
+                    f_handler.seek(entry.offset)
+                    yield pickle.loads(bz2.decompress(f_handler.read(entry.length)))
+
+    def flush(self) -> None:
+        """Write the index, through a temporary file renamed once complete"""
+
+        if not self.dirty:
+            return
+
+        self.pack_dir.mkdir(parents=True, exist_ok=True)
+        index_file = self.pack_dir / PACK_INDEX_FILENAME
+        tmp_file = index_file.with_name(f"{index_file.name}.{os.getpid()}.tmp")
+
+        with tmp_file.open("w") as f_handler:
+            json.dump({k: asdict(v) for k, v in self.index.items()}, f_handler)
+        tmp_file.replace(index_file)
+        self.dirty = False
+
+    def repack(self, max_dead_ratio: float = DEFAULT_MAX_DEAD_RATIO) -> List[str]:
+        """Rewrite the packs with too many superseded bytes, return their names
+
+        Live entries are copied to a new pack, the index is written, and only then
+        is the old pack removed: a crash leaves, at worst, an unreferenced pack,
+        removed by the next repack.
+        """
+        live_sizes: Dict[str, int] = {}
+
+        for entry in self.index.values():
+            live_sizes[entry.pack] = live_sizes.get(entry.pack, 0) + entry.length
+
+        to_return = []
+
+        for pack_file in sorted(self.pack_dir.glob("*.pack")):
+            size = pack_file.stat().st_size
+            live_size = live_sizes.get(pack_file.name, 0)
+
+            if live_size and (size - live_size) / size <= max_dead_ratio:
+                continue
+
+            if live_size:
+                new_pack_name = f"{pack_file.name.split('.')[0]}.{time.time_ns()}.pack"
+                entries = sorted(
+                    [(n, e) for n, e in self.index.items() if e.pack == pack_file.name],
+                    key=lambda x: x[1].offset,
+                )
+
+                with pack_file.open("rb") as f_in, (
+                    self.pack_dir / new_pack_name
+                ).open("wb") as f_out:
+                    for name, entry in entries:
+                        f_in.seek(entry.offset)
+                        self.index[name] = Pack_entry(
+                            length=entry.length,
+                            mtime=entry.mtime,
+                            offset=f_out.tell(),
+                            pack=new_pack_name,
+                        )
+                        f_out.write(f_in.read(entry.length))
+
+                self.dirty = True
+                self.flush()
+
+            pack_file.unlink()
+            to_return.append(pack_file.name)
+
+        return to_return
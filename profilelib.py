@@ -0,0 +1,300 @@
+"""
+Distance-aligned profiles of segment attempts, to compare attempts along a segment.
+
+The track slice of each matched segment is resampled on a common distance grid
+(every `DEFAULT_PROFILE_STEP` meters from the virtual start): elapsed time, heart
+rate, cadence and speed at each grid distance. Since all attempts of a segment share
+the same grid, time gaps or metric differences between two attempts are plain
+element-wise differences.
+
+Profiles are stored as float32 arrays, base64-encoded, one JSON line per attempt,
+in one file per segment definition.
+"""
+
+import base64
+import json
+import sys
+from array import array
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from fitlib import DEFAULT_CACHE_PATH, Segment, Track_point, atomic_write
+
+DEFAULT_PROFILE_STEP = 10.0
+PROFILE_FIELDS = {
+    "heart_rate": ("heart_rate", 1.0),
+    "cadence": ("cadence", 1.0),
+    "speed": ("enhanced_speed", 3.6),
+}
+
+
+@dataclass
+class Profile:
+    activity_name: str
+    start_time: datetime
+    step: float
+    # Seconds elapsed since the virtual start, at each grid distance
+    elapsed: array
+    # Metric name -> value at each grid distance, for available metrics
+    metrics: Dict[str, array]
+
+
+def _interpolate(
+    x0: float, y0: Optional[float], x1: float, y1: Optional[float], x: float
+) -> float:
+    if y0 is None or y1 is None:
+        known = y1 if y0 is None else y0
+
+        return float("nan") if known is None else known
+
+    if x1 == x0:
+        return y1
+
+    return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+
+
+def compute_profile(
+    segment: Segment,
+    segment_points: List[Track_point],
+    step: float = DEFAULT_PROFILE_STEP,
+) -> Optional[Profile]:
+    """Resample the points of an attempt on a grid of `step` meters
+
+    `segment_points` run from the virtual start to the virtual stop. Points without
+    distance are ignored: returns None if no point has one.
+    """
+    segment_points = [tp for tp in segment_points if tp.distance is not None]
+
+    if not segment_points:
+        return None
+
+    start = segment_points[0]
+    distances = [tp.distance - start.distance for tp in segment_points]  # type: ignore
+    seconds = [
+        (tp.timestamp - start.timestamp).total_seconds() for tp in segment_points
+    ]
+    values = {
+        metric_name: [
+            None
+            if getattr(tp, field_name) is None
+            else getattr(tp, field_name) * factor
+
+            for tp in segment_points
+        ]
+
+        for metric_name, (field_name, factor) in PROFILE_FIELDS.items()
+
+        if any(getattr(tp, field_name) is not None for tp in segment_points)
+    }
+
+    elapsed = array("f")
+    metrics = {metric_name: array("f") for metric_name in values}
+    idx = 0
+    grid_distance = 0.0
+
+    while grid_distance <= distances[-1]:
+        # Find the interval [idx, idx + 1] containing the grid distance
+        while idx + 1 < len(distances) - 1 and distances[idx + 1] < grid_distance:
+            idx += 1
+        upper = min(idx + 1, len(distances) - 1)
+
+        elapsed.append(
+            _interpolate(
+                distances[idx],
+                seconds[idx],
+                distances[upper],
+                seconds[upper],
+                grid_distance,
+            )
+        )
+
+        for metric_name, metric_values in values.items():
+            metrics[metric_name].append(
+                _interpolate(
+                    distances[idx],
+                    metric_values[idx],
+                    distances[upper],
+                    metric_values[upper],
+                    grid_distance,
+                )
+            )
+        grid_distance += step
+
+    return Profile(
+        activity_name=segment.activity_name,
+        start_time=segment.start_time,
+        step=step,
+        elapsed=elapsed,
+        metrics=metrics,
+    )
+
+
+def _encode_array(values: array) -> str:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+
+    return base64.b64encode(values.tobytes()).decode()
+
+
+def _decode_array(data: str) -> array:
+    to_return = array("f")
+    to_return.frombytes(base64.b64decode(data))
+
+    if sys.byteorder == "big":
+        to_return.byteswap()
+
+    return to_return
+
+
+def _encode_profile(profile: Profile) -> str:
+    return json.dumps(
+        {
+            "activity_name": profile.activity_name,
+            "start_time": profile.start_time.isoformat(),
+            "step": profile.step,
+            "elapsed": _encode_array(profile.elapsed),
+            "metrics": {k: _encode_array(v) for k, v in profile.metrics.items()},
+        }
+    )
+
+
+def _decode_profile(line: str) -> Profile:
+    data = json.loads(line)
+
+    return Profile(
+        activity_name=data["activity_name"],
+        start_time=datetime.fromisoformat(data["start_time"]),
+        step=data["step"],
+        elapsed=_decode_array(data["elapsed"]),
+        metrics={k: _decode_array(v) for k, v in data["metrics"].items()},
+    )
+
+
+def get_profiles_filename(
+    segment_uid: str, cache_path_name: Optional[str] = None
+) -> Path:
+    if not cache_path_name:
+        cache_path_name = DEFAULT_CACHE_PATH
+
+    return Path(cache_path_name) / "profiles" / f"{segment_uid}.jsonl"
+
+
+class Profile_store:
+    """Buffer new profiles, and append them to their segment file on `flush()`"""
+
+    def __init__(
+        self,
+        cache_path_name: Optional[str] = None,
+        step: float = DEFAULT_PROFILE_STEP,
+    ) -> None:
+        self.cache_path_name = cache_path_name
+        self.step = step
+        self.pending: Dict[str, List[Profile]] = {}
+
+    def add(self, segment: Segment, segment_points: List[Track_point]) -> None:
+        profile = compute_profile(segment, segment_points, self.step)
+
+        if profile is not None:
+            self.pending.setdefault(segment.segment_uid, []).append(profile)
+
+    def flush(self) -> None:
+        """Append the new profiles to their segment file
+
+        If an attempt is profiled again (e.g. its activity re-imported), or the file
+        already holds duplicates, the file is rewritten instead, with one profile per
+        attempt, so that it does not grow with each run.
+        """
+
+        for segment_uid, profiles in self.pending.items():
+            profiles_file = get_profiles_filename(segment_uid, self.cache_path_name)
+            lines, duplicated = _read_profile_lines(profiles_file)
+            new_lines: Dict[Tuple[str, str], str] = {}
+
+            for profile in profiles:
+                key = (profile.activity_name, profile.start_time.isoformat())
+                new_lines[key] = _encode_profile(profile)
+
+            if duplicated or lines.keys() & new_lines.keys():
+                lines.update(new_lines)
+
+                with atomic_write(profiles_file) as f_handler:
+                    f_handler.write("".join([f"{line}\n" for line in lines.values()]))
+
+                continue
+
+            profiles_file.parent.mkdir(parents=True, exist_ok=True)
+
+            with profiles_file.open("a") as f_handler:
+                f_handler.write("".join([f"{line}\n" for line in new_lines.values()]))
+
+        self.pending = {}
+
+
+def _read_profile_lines(
+    profiles_file: Path,
+) -> Tuple[Dict[Tuple[str, str], str], bool]:
+    """Lines of a profile file by (activity name, start time), without decoding the
+    arrays, and whether an attempt has several lines (the last one wins)
+    """
+    to_return: Dict[Tuple[str, str], str] = {}
+    duplicated = False
+
+    if not profiles_file.exists():
+        return (to_return, duplicated)
+
+    with profiles_file.open() as f_handler:
+        for line in f_handler:
+            data = json.loads(line)
+            key = (data["activity_name"], data["start_time"])
+            duplicated = duplicated or key in to_return
+            to_return[key] = line.rstrip("\n")
+
+    return (to_return, duplicated)
+
+
+def load_profiles(
+    segment_uid: str, cache_path_name: Optional[str] = None
+) -> Dict[Tuple[str, datetime], Profile]:
+    """Load the profiles of a segment, by (activity name, start time)
+
+    If an attempt has been profiled several times, the last profile wins.
+    """
+    profiles_file = get_profiles_filename(segment_uid, cache_path_name)
+    to_return: Dict[Tuple[str, datetime], Profile] = {}
+
+    if profiles_file.exists():
+        with profiles_file.open() as f_handler:
+            for line in f_handler:
+                profile = _decode_profile(line)
+                to_return[(profile.activity_name, profile.start_time)] = profile
+
+    return to_return
+
+
+def get_profile(
+    profiles: Dict[Tuple[str, datetime], Profile], segment: Segment
+) -> Optional[Profile]:
+    return profiles.get((segment.activity_name, segment.start_time))
+
+
+def time_gaps(profile: Profile, reference: Profile) -> List[float]:
+    """Seconds behind (positive) or ahead of `reference`, at each grid distance"""
+
+    return [p - r for p, r in zip(profile.elapsed, reference.elapsed)]
+
+
+def metric_differences(
+    profile: Profile, reference: Profile, metric_name: str
+) -> Optional[List[float]]:
+    """Differences of a metric with `reference`, at each grid distance"""
+
+    if metric_name not in profile.metrics or metric_name not in reference.metrics:
+        return None
+
+    return [
+        p - r
+        for p, r in zip(profile.metrics[metric_name], reference.metrics[metric_name])
+    ]
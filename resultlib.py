@@ -0,0 +1,161 @@
+"""
+Content-addressed cache of match results, so that stores can be rebuilt without
+parsing nor matching activity files again.
+
+A result holds the activity built from a file, and its segments, for each segment
+definition it was matched against. It is keyed by the SHA-256 of the file content
+and the matcher version (`<cache>/results/<hash[:2]>/<hash>.<version>.json`, in
+the columnar format of the stores), so that:
+
+- a renamed or moved file is recognized, and its result reused
+- a new matcher version (different segments for the same file) misses the cache
+
+An index (`<cache>/results/files.json`) maps each file to its size, modification
+time and hash, so that unchanged files are not hashed again.
+"""
+
+import json
+from dataclasses import asdict, dataclass, replace
+from hashlib import sha256
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from dacite import from_dict
+
+from fitlib import (
+    DEFAULT_CACHE_PATH,
+    Activity,
+    Segment,
+    _decode_columns,
+    _encode_columns,
+    atomic_write,
+    filename2activityname,
+)
+
+RESULT_DIRNAME = "results"
+RESULT_INDEX_FILENAME = "files.json"
+
+
+@dataclass
+class File_entry:
+    hash: str
+    mtime: float
+    size: int
+
+
+@dataclass
+class Match_result:
+    activity: Activity
+    # Segment definition uid -> segments found (possibly none)
+    segments: Dict[str, List[Segment]]
+
+
+def hash_file(filename: str) -> str:
+    to_return = sha256()
+
+    with open(filename, "rb") as f_handler:
+        for chunk in iter(lambda: f_handler.read(2 ** 20), b""):
+            to_return.update(chunk)
+
+    return to_return.hexdigest()
+
+
+class Result_store:
+    """Match results, by file content and matcher version"""
+
+    def __init__(
+        self, matcher_version: int, cache_path_name: Optional[str] = None
+    ) -> None:
+        if not cache_path_name:
+            cache_path_name = DEFAULT_CACHE_PATH
+        self.result_dir = Path(cache_path_name) / RESULT_DIRNAME
+        self.matcher_version = matcher_version
+        self.files: Dict[str, File_entry] = {}
+        self.dirty = False
+        index_file = self.result_dir / RESULT_INDEX_FILENAME
+
+        if index_file.exists():
+            with index_file.open() as f_handler:
+                self.files = {
+                    name: from_dict(data_class=File_entry, data=data)
+
+                    for name, data in json.load(f_handler).items()
+                }
+
+    def get_hash(self, filename: str) -> str:
+        """Hash of a file, only computed if its size or modification time changed"""
+        path_name = str(Path(filename).resolve())
+        stat = Path(filename).stat()
+        entry = self.files.get(path_name)
+
+        if entry is None or (entry.size, entry.mtime) != (stat.st_size, stat.st_mtime):
+            entry = File_entry(
+                hash=hash_file(filename), mtime=stat.st_mtime, size=stat.st_size
+            )
+            self.files[path_name] = entry
+            self.dirty = True
+
+        return entry.hash
+
+    def get_result_filename(self, filename: str) -> Path:
+        file_hash = self.get_hash(filename)
+        result_name = f"{file_hash}.{self.matcher_version}.json"
+
+        return self.result_dir / file_hash[:2] / result_name
+
+    def get(self, filename: str) -> Optional[Match_result]:
+        """Result of a file, with the activity and segments named after the file"""
+        result_file = self.get_result_filename(filename)
+
+        if not result_file.exists():
+            return None
+
+        with result_file.open() as f_handler:
+            data = json.load(f_handler)
+
+        activity_name = filename2activityname(filename)
+        (activity,) = _decode_columns(data["activity"], Activity)
+        segments: Dict[str, List[Segment]] = {uid: [] for uid in data["matched"]}
+
+        for segment in _decode_columns(data["segments"], Segment):
+            segments[segment.segment_uid].append(
+                replace(segment, activity_name=activity_name)
+            )
+
+        return Match_result(
+            activity=replace(activity, name=activity_name), segments=segments
+        )
+
+    def add(self, filename: str, result: Match_result) -> None:
+        """Store the result of a file, merged with the segments already stored"""
+        previous = self.get(filename)
+
+        if previous is not None:
+            result = Match_result(
+                activity=result.activity,
+                segments={**previous.segments, **result.segments},
+            )
+
+        with atomic_write(self.get_result_filename(filename)) as f_handler:
+            json.dump(
+                {
+                    "activity": _encode_columns([result.activity], Activity),
+                    "matched": list(result.segments),
+                    "segments": _encode_columns(
+                        [s for segments in result.segments.values() for s in segments],
+                        Segment,
+                    ),
+                },
+                f_handler,
+                separators=(",", ":"),
+            )
+
+    def flush(self) -> None:
+        """Write the file index, through a temporary file renamed once complete"""
+
+        if not self.dirty:
+            return
+
+        with atomic_write(self.result_dir / RESULT_INDEX_FILENAME) as f_handler:
+            json.dump({k: asdict(v) for k, v in self.files.items()}, f_handler)
+        self.dirty = False
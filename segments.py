@@ -4,15 +4,19 @@
 
 import argparse
 import logging
-from typing import List
+from typing import List, Optional, Tuple
 
+from curvelib import compute_segment_curves, get_best_value
 from fitlib import (
+    DEFAULT_CACHE_PATH,
     Segment,
     Segment_definition,
     get_logger,
     load_segment_definitions,
     load_segments,
 )
+from packlib import Pack_store
+from profilelib import get_profile, load_profiles, metric_differences, time_gaps
 
 
 def parse_args() -> argparse.Namespace:
@@ -24,7 +28,29 @@ def parse_args() -> argparse.Namespace:
     # Positional arguments
     parser.add_argument("seg_ids", nargs="+", help="Segment IDs")
 
+    # Options
+    parser.add_argument(
+        "--cache", default=DEFAULT_CACHE_PATH, help="Cache directory of the tracks"
+    )
+    parser.add_argument(
+        "--compare",
+        "-c",
+        metavar="ACTIVITY",
+        help="Compare the attempts of this activity with the PR and season best",
+    )
+
     # Boolean
+    parser.add_argument(
+        "--best-efforts",
+        "-b",
+        help="Show best 1 and 5 min heart rates of each attempt (needs track cache)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--packed-cache",
+        help="Tracks are cached in pack files, cf. fit2segments.py --packed-cache",
+        action="store_true",
+    )
     parser.add_argument("--verbose", "-v", help="Verbose mode", action="store_true")
 
     args: argparse.Namespace = parser.parse_args()
@@ -41,10 +67,37 @@ def render_segment_summary(segment_definition: Segment_definition) -> None:
     print(segment_definition.name)
 
 
-def render_segment_in_context(rank: int, segment: Segment) -> None:
+def get_best_efforts_str(
+    segment: Segment,
+    cache_path_name: Optional[str] = None,
+    packs: Optional[Pack_store] = None,
+) -> str:
+    curves = compute_segment_curves(segment, cache_path_name, packs)
+
+    if curves is None:
+        return f"{'no track':>11}"
+
+    if "heart_rate" not in curves:
+        return " " * 11
+
+    best = [get_best_value(curves["heart_rate"], d) for d in [60, 300]]
+
+    return " ".join([f"{v:>5.1f}" if v else f"{'-':>5}" for v in best])
+
+
+def render_segment_in_context(
+    rank: int,
+    segment: Segment,
+    best_efforts: bool = False,
+    cache_path_name: Optional[str] = None,
+    packs: Optional[Pack_store] = None,
+) -> None:
     duration = str(segment.duration)
     start_time = str(segment.start_time.date())
-    temp = segment.temperature.avg
+    temp_str = "   "
+
+    if segment.temperature:
+        temp_str = f"{segment.temperature.avg:>3.0f}"
 
     # Heart rate
     hr = segment.heart_rate
@@ -79,10 +132,15 @@ def render_segment_in_context(rank: int, segment: Segment) -> None:
             f"{rank:<5} "
             f"{duration:<10} "
             f"{start_time:<10}  "
-            f"{temp:>3.0f}  "
+            f"{temp_str}  "
             f"{hr_str}  "
             f"{cad_str}  "
             f"{speed_str}  "
+            + (
+                get_best_efforts_str(segment, cache_path_name, packs)
+                if best_efforts
+                else ""
+            )
         )
     )
 
@@ -91,6 +149,9 @@ def render_segment(
     segment_uid: str,
     segments: List[Segment],
     segment_definitions: List[Segment_definition],
+    best_efforts: bool = False,
+    cache_path_name: Optional[str] = None,
+    packs: Optional[Pack_store] = None,
 ) -> None:
     """docstring for render_segment"""
     matching_segment_definitions = [
@@ -117,19 +178,99 @@ def render_segment(
         "Rank  Time       -- Date --   °C  ------- Heart rate -----  "
         "------- Cadence -------  "
         "------- Speed ----------"
+        + ("  Best HR 1'/5'" if best_efforts else "")
     )
 
     for idx, matching_segment in enumerate(matching_segments):
-        render_segment_in_context(idx + 1, matching_segment)
+        render_segment_in_context(
+            idx + 1, matching_segment, best_efforts, cache_path_name, packs
+        )
+
+
+def render_comparison(
+    segment_uid: str,
+    activity_name: str,
+    segments: List[Segment],
+    cache_path_name: Optional[str] = None,
+) -> None:
+    """Show time gaps and HR differences with the PR and season best, every km"""
+    attempts = sorted(
+        [s for s in segments if s.segment_uid == segment_uid], key=lambda x: x.duration,
+    )
+    profiles = load_profiles(segment_uid, cache_path_name)
+    # References need a profile too (e.g. attempts matched before profiles were not)
+    profiled_attempts = [s for s in attempts if get_profile(profiles, s) is not None]
+
+    for segment in [s for s in attempts if s.activity_name == activity_name]:
+        profile = get_profile(profiles, segment)
+
+        if profile is None:
+            print(f"No profile for the attempt of {segment.start_time}")
+
+            continue
+
+        # The attempt itself is profiled: there is a reference for each
+        references = {
+            "PR": profiled_attempts[0],
+            "Season best": [
+                s
+
+                for s in profiled_attempts
+
+                if s.start_time.year == segment.start_time.year
+            ][0],
+        }
+        print()
+        print(f"Attempt of {segment.start_time} ({str(segment.duration)})")
+        print("  km" + "".join([f"{label:>24}" for label in references]))
+
+        comparisons: List[Tuple[List[float], Optional[List[float]]]] = []
+
+        for reference in references.values():
+            reference_profile = get_profile(profiles, reference)
+            assert reference_profile is not None
+            comparisons.append(
+                (
+                    time_gaps(profile, reference_profile),
+                    metric_differences(profile, reference_profile, "heart_rate"),
+                )
+            )
+
+        every = max(int(1000 / profile.step), 1)
+        last = len(profile.elapsed) - 1
+
+        for idx in list(range(every, last, every)) + [last]:
+            columns = []
+
+            for gaps, hr_differences in comparisons:
+                if idx >= len(gaps):
+                    columns.append(f"{'-':>24}")
+
+                    continue
+                hr_str = f"{hr_differences[idx]:+5.0f} bpm" if hr_differences else ""
+                columns.append(f"{gaps[idx]:>+10.0f} s {hr_str:>11}")
+
+            print(f"{idx * profile.step / 1000:>4.1f}" + "".join(columns))
 
 
 def main(args: argparse.Namespace) -> None:
 
     segment_definitions = load_segment_definitions()
     segments = load_segments()
+    packs = Pack_store(args.cache) if args.packed_cache else None
 
     for seg_id in args.seg_ids:
-        render_segment(seg_id, segments, segment_definitions)
+        render_segment(
+            seg_id,
+            segments,
+            segment_definitions,
+            args.best_efforts,
+            args.cache,
+            packs,
+        )
+
+        if args.compare:
+            render_comparison(seg_id, args.compare, segments, args.cache)
 
 
 if __name__ == "__main__":
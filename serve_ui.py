@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+"""
+Serve the web UI, and a JSON API on top of `activities.json` and `segments.json`:
+
+- `/api/activities?from=YYYY-MM-DD&to=YYYY-MM-DD&name=NAME&gps=1&offset=0&limit=50`:
+  activities, most recent first, optionally within a date range, by name or with
+  (`gps=1`) or without (`gps=0`) GPS
+- `/api/segment_definitions`: all segment definitions
+- `/api/segments?uid=UID&activity=NAME&ranks=1&offset=0&limit=50`: segments, by
+  start time, with their all-time and same-year ranks if `ranks=1`
+- `/api/leaderboard/UID?year=YYYY&offset=0&limit=50`: attempts of a segment, by
+  duration, with their rank
+- `/api/traces/NAME`: trace of an activity
+
+Lists are paginated (`total`, `offset`, `limit`, `items`), in reverse order with
+`order=desc`. Responses carry ETag and
+Last-Modified headers derived from the store files, answer conditional requests
+with 304, and are gzip'ed when the client accepts it. Other paths are served as
+static files from the UI directory.
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import threading
+from dataclasses import asdict, dataclass, field
+from datetime import date
+from email.utils import formatdate, parsedate_to_datetime
+from hashlib import sha256
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from fitlib import (
+    DEFAULT_ACTIVITIES_FILENAME,
+    DEFAULT_SEGMENT_DEFINITIONS_FILENAME,
+    DEFAULT_SEGMENTS_FILENAME,
+    DEFAULT_UI_BASEDIR,
+    Activity,
+    Segment,
+    Segment_definition,
+    _encode_durations,
+    get_logger,
+    load_activities,
+    load_segment_definitions,
+    load_segments,
+)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+GZIP_MIN_SIZE = 1024
+
+logger = get_logger(__name__)
+
+
+def parse_args() -> argparse.Namespace:
+    """ Call me with args = parse_args() """
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    # Options
+    parser.add_argument("--bind", default="127.0.0.1", help="Address to bind to")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen to")
+
+    # Boolean
+    parser.add_argument("--verbose", "-v", help="Verbose mode", action="store_true")
+
+    args: argparse.Namespace = parser.parse_args()
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    return args
+
+
+@dataclass
+class Store_snapshot:
+    """Store content loaded at once, never modified afterwards"""
+
+    activities: List[Activity] = field(default_factory=list)
+    last_modified: float = 0.0
+    segment_definitions: List[Segment_definition] = field(default_factory=list)
+    segments: List[Segment] = field(default_factory=list)
+    # Segment uid -> segments, by duration
+    segments_by_uid: Dict[str, List[Segment]] = field(default_factory=dict)
+    # Activity name -> segments, by start time
+    segments_by_activity: Dict[str, List[Segment]] = field(default_factory=dict)
+    # id() of a segment -> its ranks, cf. `get_ranks()`
+    ranks: Dict[int, Dict[str, int]] = field(default_factory=dict)
+    version: str = ""
+
+
+class Store:
+    """Activities, segments and segment definitions, indexed for the API
+
+    The store files are reloaded when their modification time changes, into a new
+    snapshot: requests being served keep a consistent view of the previous one.
+    """
+
+    def __init__(
+        self,
+        activities_filename: str = DEFAULT_ACTIVITIES_FILENAME,
+        segments_filename: str = DEFAULT_SEGMENTS_FILENAME,
+        segment_definitions_filename: str = DEFAULT_SEGMENT_DEFINITIONS_FILENAME,
+    ) -> None:
+        self.filenames = [
+            activities_filename,
+            segments_filename,
+            segment_definitions_filename,
+        ]
+        self.lock = threading.Lock()
+        self.stamps: List[Tuple[int, int]] = []
+        self.snapshot = Store_snapshot()
+
+    def refresh(self) -> Store_snapshot:
+        """Reload the store files if they changed, and return the current snapshot"""
+        stats = [Path(f).stat() if Path(f).exists() else None for f in self.filenames]
+        stamps = [(s.st_mtime_ns, s.st_size) if s else (0, 0) for s in stats]
+
+        with self.lock:
+            if stamps == self.stamps:
+                return self.snapshot
+
+            activities_filename, segments_filename, definitions_filename = (
+                self.filenames
+            )
+            segments = sorted(
+                load_segments(segments_filename), key=lambda s: s.start_time
+            )
+            segments_by_uid: Dict[str, List[Segment]] = {}
+            segments_by_activity: Dict[str, List[Segment]] = {}
+
+            for segment in segments:
+                segments_by_uid.setdefault(segment.segment_uid, []).append(segment)
+                segments_by_activity.setdefault(segment.activity_name, []).append(
+                    segment
+                )
+
+            for uid_segments in segments_by_uid.values():
+                uid_segments.sort(key=lambda s: s.duration)
+            ranks = get_ranks(segments_by_uid)
+
+            # Swapped at once, once complete
+            self.snapshot = Store_snapshot(
+                activities=sorted(
+                    load_activities(activities_filename),
+                    key=lambda a: a.start_time,
+                    reverse=True,
+                ),
+                last_modified=max([s.st_mtime for s in stats if s] + [0]),
+                segment_definitions=load_segment_definitions(definitions_filename)
+                if Path(definitions_filename).exists()
+                else [],
+                segments=segments,
+                segments_by_uid=segments_by_uid,
+                segments_by_activity=segments_by_activity,
+                ranks=ranks,
+                version=sha256(str(stamps).encode()).hexdigest()[:16],
+            )
+            self.stamps = stamps
+            logger.info(
+                "Store loaded: %s activities, %s segments",
+                len(self.snapshot.activities),
+                len(segments),
+            )
+
+            return self.snapshot
+
+
+def paginate(items: List[Any], query: Dict[str, List[str]]) -> Dict[str, Any]:
+    """Page of items, in reverse order if `order=desc`
+
+    Raises ValueError on invalid parameters, answered with a 400.
+    """
+    offset = max(int(query.get("offset", ["0"])[0]), 0)
+    limit = min(int(query.get("limit", [str(DEFAULT_PAGE_SIZE)])[0]), MAX_PAGE_SIZE)
+    order = query.get("order", ["asc"])[0]
+
+    if limit < 0:
+        raise ValueError(f"Invalid limit: {limit}")
+
+    if order not in ["asc", "desc"]:
+        raise ValueError(f"Invalid order: {order}")
+
+    if order == "desc":
+        items = items[::-1]
+
+    return {
+        "total": len(items),
+        "offset": offset,
+        "limit": limit,
+        "items": [
+            asdict(i) if hasattr(i, "__dataclass_fields__") else i
+            for i in items[offset : offset + limit]
+        ],
+    }
+
+
+def get_activities(
+    snapshot: Store_snapshot, query: Dict[str, List[str]]
+) -> Dict[str, Any]:
+    activities = snapshot.activities
+
+    if "name" in query:
+        activities = [a for a in activities if a.name == query["name"][0]]
+
+    if "gps" in query:
+        gps_available = query["gps"][0] == "1"
+        activities = [a for a in activities if a.gps_available == gps_available]
+
+    if "from" in query:
+        start = date.fromisoformat(query["from"][0])
+        activities = [a for a in activities if a.start_time.date() >= start]
+
+    if "to" in query:
+        stop = date.fromisoformat(query["to"][0])
+        activities = [a for a in activities if a.start_time.date() <= stop]
+
+    return paginate(activities, query)
+
+
+def get_ranks(segments_by_uid: Dict[str, List[Segment]]) -> Dict[int, Dict[str, int]]:
+    """All-time and same-year ranks of all segments, and numbers of attempts
+
+    Segments are not hashable: ranks are indexed by the `id()` of the segments,
+    which the snapshot holding them keeps alive.
+    """
+    to_return: Dict[int, Dict[str, int]] = {}
+
+    for attempts in segments_by_uid.values():
+        attempts_by_year: Dict[int, List[Segment]] = {}
+
+        for rank, segment in enumerate(attempts, start=1):
+            attempts_by_year.setdefault(segment.start_time.year, []).append(segment)
+            to_return[id(segment)] = {"rank": rank, "attempts": len(attempts)}
+
+        for year_attempts in attempts_by_year.values():
+            for year_rank, segment in enumerate(year_attempts, start=1):
+                to_return[id(segment)]["year_rank"] = year_rank
+                to_return[id(segment)]["year_attempts"] = len(year_attempts)
+
+    return to_return
+
+
+def get_segments(
+    snapshot: Store_snapshot, query: Dict[str, List[str]]
+) -> Dict[str, Any]:
+    """Segments, with their ranks if `ranks=1`"""
+
+    if "activity" in query:
+        segments = snapshot.segments_by_activity.get(query["activity"][0], [])
+    elif "uid" in query:
+        segments = sorted(
+            snapshot.segments_by_uid.get(query["uid"][0], []),
+            key=lambda s: s.start_time,
+        )
+    else:
+        segments = snapshot.segments
+
+    if "activity" in query and "uid" in query:
+        segments = [s for s in segments if s.segment_uid == query["uid"][0]]
+
+    if query.get("ranks", ["0"])[0] != "1":
+        return paginate(segments, query)
+
+    page = paginate(list(range(len(segments))), query)
+    page["items"] = [
+        dict(asdict(segments[idx]), **snapshot.ranks[id(segments[idx])])
+
+        for idx in page["items"]
+    ]
+
+    return page
+
+
+def get_leaderboard(
+    snapshot: Store_snapshot, uid: str, query: Dict[str, List[str]]
+) -> Dict[str, Any]:
+    ranked = list(enumerate(snapshot.segments_by_uid.get(uid, []), start=1))
+
+    if "year" in query:
+        year = int(query["year"][0])
+        ranked = [(r, s) for r, s in ranked if s.start_time.year == year]
+
+    page = paginate(ranked, query)
+    page["items"] = [dict(asdict(s), rank=rank) for rank, s in page["items"]]
+
+    return page
+
+
+class Handler(SimpleHTTPRequestHandler):
+    store: Store
+    trace_dir: Path
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+
+        if not url.path.startswith("/api/"):
+            super().do_GET()
+
+            return
+
+        snapshot = self.store.refresh()
+        query = parse_qs(url.query)
+        parts = url.path.strip("/").split("/")[1:]
+
+        route = self.route(snapshot, parts, query)
+
+        if route is None:
+            self.send_error(HTTPStatus.NOT_FOUND)
+
+            return
+
+        etag, last_modified, get_body = route
+        self.send_json(etag, last_modified, get_body)
+
+    def route(
+        self, snapshot: Store_snapshot, parts: List[str], query: Dict[str, List[str]]
+    ) -> Optional[Tuple[str, float, Any]]:
+        """Return the ETag, modification time and body builder of an API path"""
+        etag = sha256(f"{snapshot.version}{self.path}".encode()).hexdigest()[:32]
+        last_modified = snapshot.last_modified
+
+        if parts == ["activities"]:
+            return (etag, last_modified, lambda: get_activities(snapshot, query))
+
+        if parts == ["segment_definitions"]:
+            return (
+                etag,
+                last_modified,
+                lambda: [asdict(sd) for sd in snapshot.segment_definitions],
+            )
+
+        if parts == ["segments"]:
+            return (etag, last_modified, lambda: get_segments(snapshot, query))
+
+        if len(parts) == 2 and parts[0] == "leaderboard":
+            return (
+                etag,
+                last_modified,
+                lambda: get_leaderboard(snapshot, parts[1], query),
+            )
+
+        if len(parts) == 2 and parts[0] == "traces":
+            trace_file = self.trace_dir / f"{Path(parts[1]).name}.json"
+
+            if not trace_file.exists():
+                return None
+            stat = trace_file.stat()
+
+            return (
+                f"{stat.st_mtime_ns:x}-{stat.st_size:x}",
+                stat.st_mtime,
+                lambda: json.loads(trace_file.read_text()),
+            )
+
+        return None
+
+    def not_modified(self, etag: str, last_modified: float) -> bool:
+        if_none_match = self.headers.get("If-None-Match")
+
+        if if_none_match:
+            return etag in [t.strip().strip('"') for t in if_none_match.split(",")]
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+
+            return int(last_modified) <= since
+
+        return False
+
+    def send_json(self, etag: str, last_modified: float, get_body: Any) -> None:
+        if self.not_modified(etag, last_modified):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", f'"{etag}"')
+            self.end_headers()
+
+            return
+
+        try:
+            content = get_body()
+        except ValueError as e:
+            self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+
+            return
+
+        body = json.dumps(content, default=_encode_durations).encode()
+        gzipped = (
+            "gzip" in self.headers.get("Accept-Encoding", "")
+            and len(body) > GZIP_MIN_SIZE
+        )
+
+        if gzipped:
+            body = gzip.compress(body)
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", f'"{etag}"')
+        self.send_header("Last-Modified", formatdate(last_modified, usegmt=True))
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(format, *args)
+
+
+def make_server(
+    store: Store, bind: str = "127.0.0.1", port: int = 8000
+) -> ThreadingHTTPServer:
+    ui_dir = Path(DEFAULT_UI_BASEDIR).resolve()
+
+    class Store_handler(Handler):
+        pass
+
+    Store_handler.store = store
+    Store_handler.trace_dir = ui_dir / "userdata"
+
+    return ThreadingHTTPServer(
+        (bind, port),
+        lambda *a, **kw: Store_handler(*a, directory=str(ui_dir), **kw),
+    )
+
+
+def main(args: argparse.Namespace) -> None:
+    store = Store()
+    store.refresh()
+    server = make_server(store, args.bind, args.port)
+    logger.warning("Serving on http://%s:%s/index.html", args.bind, args.port)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
+    logging.debug("Done")
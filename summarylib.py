@@ -0,0 +1,256 @@
+"""
+Activity summaries from the `session` and `lap` messages of FIT files.
+
+Devices write the totals of an activity (start time, elapsed and timer times,
+distance, ascent, calories, average heart rate...) in its `session` message(s), at
+the end of the file. Decoding them does not require decoding the `record` messages:
+the file is scanned message header by message header, only the payloads of
+`session` and `lap` messages being decoded. This is much cheaper than decoding the
+whole file with `fitparse`, so that activities without segments to match (e.g.
+home trainer rides, without GPS) are summarized without loading their track.
+
+cf. the FIT protocol (<https://developer.garmin.com/fit/protocol/>): a 12 or 14-byte
+file header, then definition messages (layout of a local message type) and data
+messages (payload of a local message type), then a CRC. Several FIT files may be
+chained in one file.
+"""
+
+import mmap
+import struct
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+# Global message numbers
+SESSION_MESSAGE = 18
+LAP_MESSAGE = 19
+# FIT timestamps are seconds since 1989-12-31 00:00 UTC
+FIT_EPOCH = datetime(1989, 12, 31)
+
+# Field definition number: (name, struct format, scale), for the session and lap
+# messages (same numbers in both)
+SUMMARY_FIELDS = {
+    2: ("start_time", "I", 1),
+    3: ("start_position_lat", "i", 1),
+    4: ("start_position_long", "i", 1),
+    7: ("total_elapsed_time", "I", 1000),
+    8: ("total_timer_time", "I", 1000),
+    9: ("total_distance", "I", 100),
+    11: ("total_calories", "H", 1),
+    16: ("avg_heart_rate", "B", 1),
+    22: ("total_ascent", "H", 1),
+    23: ("total_descent", "H", 1),
+}
+# Invalid value of each struct format, i.e. field not set
+INVALID_VALUES = {"B": 0xFF, "H": 0xFFFF, "I": 0xFFFFFFFF, "i": 0x7FFFFFFF}
+
+# Local message type -> (global message number, byte order, [(field number, size)],
+# payload size)
+Definition = Tuple[int, str, List[Tuple[int, int]], int]
+# Content of a FIT file, read or memory-mapped
+Fit_data = Union[bytes, mmap.mmap]
+
+
+@dataclass
+class Fit_summary:
+    avg_heart_rate: Optional[float]
+    calories: Optional[float]
+    distance: Optional[float]
+    duration: timedelta
+    elevation_gain: Optional[float]
+    elevation_loss: Optional[float]
+    # None if no session or lap defines a start position: unknown
+    gps_available: Optional[bool]
+    moving_time: Optional[timedelta]
+    start_time: datetime
+
+
+def decode_summary_fields(
+    data: Fit_data, offset: int, definition: Definition
+) -> Dict[str, Optional[float]]:
+    """Decode the summary fields of a session or lap message, skipping the others
+
+    Fields defined in the message but not set (invalid value) are None.
+    """
+    _, byteorder, field_sizes, _ = definition
+    to_return: Dict[str, Optional[float]] = {}
+
+    for number, size in field_sizes:
+        if number in SUMMARY_FIELDS:
+            name, fmt, scale = SUMMARY_FIELDS[number]
+
+            if struct.calcsize(fmt) == size:
+                (value,) = struct.unpack_from(byteorder + fmt, data, offset)
+
+                if value == INVALID_VALUES[fmt]:
+                    to_return[name] = None
+                else:
+                    to_return[name] = value / scale if scale != 1 else value
+        offset += size
+
+    return to_return
+
+
+def scan_fit_messages(
+    data: Fit_data,
+) -> Tuple[List[Dict[str, Optional[float]]], List[Dict[str, Optional[float]]]]:
+    """Return the summary fields of the session and lap messages of FIT content
+
+    Raises ValueError if the content is not a valid FIT file.
+    """
+    sessions = []
+    laps = []
+    start = 0
+
+    # Chained FIT files
+    while start < len(data):
+        if len(data) < start + 12 or data[start + 8 : start + 12] != b".FIT":
+            raise ValueError("Not a FIT file")
+
+        header_size = data[start]
+        (data_size,) = struct.unpack_from("<I", data, start + 4)
+        offset = start + header_size
+        end = offset + data_size
+
+        if end > len(data):
+            raise ValueError("Truncated FIT file")
+
+        definitions: Dict[int, Definition] = {}
+
+        while offset < end:
+            header = data[offset]
+            offset += 1
+
+            if header & 0x80:
+                # Compressed timestamp header: data message
+                local_type = (header >> 5) & 0x03
+            elif header & 0x40:
+                # Definition message
+                local_type = header & 0x0F
+                byteorder = ">" if data[offset + 1] else "<"
+                (global_number,) = struct.unpack_from(byteorder + "H", data, offset + 2)
+                nb_fields = data[offset + 4]
+                offset += 5
+                field_sizes = [
+                    (data[offset + 3 * i], data[offset + 3 * i + 1])
+
+                    for i in range(nb_fields)
+                ]
+                offset += 3 * nb_fields
+                size = sum(s for _, s in field_sizes)
+
+                if header & 0x20:
+                    # Developer fields: only their size matters
+                    nb_developer_fields = data[offset]
+                    offset += 1
+                    size += sum(
+                        data[offset + 3 * i + 1] for i in range(nb_developer_fields)
+                    )
+                    offset += 3 * nb_developer_fields
+                definitions[local_type] = (global_number, byteorder, field_sizes, size)
+
+                continue
+            else:
+                local_type = header & 0x0F
+
+            if local_type not in definitions:
+                raise ValueError("Data message without definition")
+
+            definition = definitions[local_type]
+            global_number = definition[0]
+
+            if global_number == SESSION_MESSAGE:
+                sessions.append(decode_summary_fields(data, offset, definition))
+            elif global_number == LAP_MESSAGE:
+                laps.append(decode_summary_fields(data, offset, definition))
+            offset += definition[3]
+
+        # Skip the CRC
+        start = end + 2
+
+    return (sessions, laps)
+
+
+def read_fit_summary(fitfilename: str) -> Optional[Fit_summary]:
+    """Summary of a FIT file, from its session messages
+
+    Returns None if the file is not a valid FIT file or has no session with a start
+    time and an elapsed time, in which case the summary has to be derived from the
+    track points. The GPS is deemed available if any session or lap has a start
+    position, and not available if they define start positions that are all unset:
+    if no session or lap defines a start position, whether the GPS is available is
+    unknown (None), and the track has to be loaded. Multisport activities (several
+    sessions) are summed up.
+    """
+
+    if Path(fitfilename).suffix.lower() != ".fit":
+        return None
+
+    # Mapped rather than read: only the message headers and the session and lap
+    # payloads are accessed, not copied
+    try:
+        with open(fitfilename, "rb") as f_handler, mmap.mmap(
+            f_handler.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            messages, laps = scan_fit_messages(data)
+    except (OSError, ValueError, IndexError, struct.error):
+        return None
+
+    # Start positions defined by the sessions and laps, set or not
+    start_positions = [
+        (m["start_position_lat"], m["start_position_long"])
+
+        for m in messages + laps
+
+        if "start_position_lat" in m and "start_position_long" in m
+    ]
+    # Set fields only
+    sessions = [
+        {name: value for name, value in m.items() if value is not None}
+
+        for m in messages
+    ]
+    sessions = [
+        s for s in sessions if "start_time" in s and "total_elapsed_time" in s
+    ]
+
+    if not sessions:
+        return None
+
+    def get_total(name: str) -> Optional[float]:
+        values = [s[name] for s in sessions if name in s]
+
+        return sum(values) if values else None
+
+    duration = sum(s["total_elapsed_time"] for s in sessions)
+    moving_time = get_total("total_timer_time")
+    heart_rates = [
+        (s["avg_heart_rate"], s["total_elapsed_time"])
+
+        for s in sessions
+
+        if "avg_heart_rate" in s
+    ]
+    heart_rate_duration = sum(d for _, d in heart_rates)
+
+    return Fit_summary(
+        avg_heart_rate=sum(hr * d for hr, d in heart_rates) / heart_rate_duration
+        if heart_rate_duration
+        else None,
+        calories=get_total("total_calories"),
+        distance=get_total("total_distance"),
+        duration=timedelta(seconds=duration),
+        elevation_gain=get_total("total_ascent"),
+        elevation_loss=get_total("total_descent"),
+        gps_available=any(
+            lat is not None and long is not None for lat, long in start_positions
+        )
+        if start_positions
+        else None,
+        moving_time=timedelta(seconds=moving_time)
+        if moving_time is not None
+        else None,
+        start_time=FIT_EPOCH
+        + timedelta(seconds=min(s["start_time"] for s in sessions)),
+    )
@@ -0,0 +1,90 @@
+"""
+Consistency of the aggregates of `aggregatelib.py` with the activities and segments
+they were built from.
+
+Run with `python -m pytest`.
+"""
+
+from dataclasses import replace
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from aggregatelib import (
+    add_activity,
+    add_segment,
+    build_aggregates,
+    is_consistent,
+    load_aggregates,
+    remove_activity,
+    write_aggregates,
+)
+from fitlib import Activity, Segment
+
+
+def get_activity(name: str, start_time: datetime) -> Activity:
+    return Activity(
+        avg_heart_rate=None,
+        calories=None,
+        distance=30000.0,
+        duration=timedelta(hours=1, seconds=0.5),
+        elevation_gain=None,
+        elevation_loss=None,
+        gps_available=True,
+        matched_against_segments=[],
+        moving_time=None,
+        name=name,
+        start_time=start_time,
+        year=start_time.year,
+    )
+
+
+def get_segment(activity: Activity) -> Segment:
+    return Segment(
+        activity_name=activity.name,
+        cadence=None,
+        duration=timedelta(minutes=10),
+        elevation_gain=None,
+        grade=None,
+        heart_rate=None,
+        moving_time=None,
+        nested_in=None,
+        power=None,
+        segment_name="Climb",
+        segment_uid="uid1",
+        speed=None,
+        start_time=activity.start_time + timedelta(minutes=5),
+        temperature=None,
+    )
+
+
+def test_is_consistent(tmp_path: Path) -> None:
+    activities = [
+        get_activity("a", datetime(2020, 5, 24, 10)),
+        get_activity("b", datetime(2021, 6, 1, 9)),
+    ]
+    segments = [get_segment(activities[0])]
+    aggregates = build_aggregates(activities, segments)
+
+    assert is_consistent(aggregates, activities, segments)
+    assert is_consistent(aggregates, activities[::-1], segments)
+
+    # Same counts, other activities or attempts
+    other = get_activity("c", datetime(2021, 7, 1, 9))
+
+    assert not is_consistent(aggregates, [activities[0], other], segments)
+    assert not is_consistent(aggregates, activities, [get_segment(activities[1])])
+
+    # Maintained incrementally, and through the aggregates file
+    add_activity(aggregates, other)
+    add_segment(aggregates, get_segment(other))
+    renamed = replace(activities[1], name="b2")
+    remove_activity(aggregates, activities[1])
+    add_activity(aggregates, renamed)
+    aggregates_file = str(tmp_path / "aggregates.json")
+    write_aggregates(aggregates, aggregates_file)
+
+    assert is_consistent(
+        load_aggregates(aggregates_file),
+        [activities[0], renamed, other],
+        segments + [get_segment(other)],
+    )
@@ -0,0 +1,126 @@
+"""
+Best efforts curves of `curvelib.py`, and their envelopes as activities are added,
+re-imported or removed.
+
+Run with `python -m pytest`.
+"""
+
+import json
+import os
+from dataclasses import asdict
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from curvelib import (
+    Best_efforts,
+    Curve,
+    get_best_value,
+    get_curves_filename,
+    is_curves_outdated,
+    mean_max,
+    remove_best_efforts,
+    update_best_efforts,
+)
+
+START_TIMES = {
+    "a2020": datetime(2020, 5, 24, 10),
+    "b2020": datetime(2020, 6, 1, 9),
+    "c2021": datetime(2021, 4, 2, 8),
+}
+
+
+def get_curves(heart_rate_1min: float) -> Dict[str, Curve]:
+    return {"heart_rate": Curve(durations=[1, 60], values=[190.0, heart_rate_1min])}
+
+
+def cache_curves(tmp_path: Path, activity_name: str, curves: Dict[str, Curve]) -> None:
+    with get_curves_filename(activity_name, str(tmp_path)).open("w") as f_handler:
+        json.dump({k: asdict(v) for k, v in curves.items()}, f_handler)
+
+
+def get_best_efforts(tmp_path: Path) -> Best_efforts:
+    """Envelopes of 3 activities over 2 years, their curves cached"""
+    to_return = Best_efforts()
+
+    for activity_name, heart_rate in [("a2020", 170), ("b2020", 160), ("c2021", 165)]:
+        curves = get_curves(heart_rate)
+        cache_curves(tmp_path, activity_name, curves)
+        update_best_efforts(
+            to_return, activity_name, START_TIMES[activity_name], curves
+        )
+
+    return to_return
+
+
+def get_1min(best_efforts: Best_efforts, period: str) -> Tuple[Optional[float], str]:
+    envelope = best_efforts.envelopes[period]["heart_rate"]
+
+    return (
+        get_best_value(envelope, 60),
+        envelope.activity_names[envelope.durations.index(60)],
+    )
+
+
+def test_mean_max() -> None:
+    curve = mean_max([1.0, 3.0, 2.0, 5.0, 0.0], [1, 2, 5, 6])
+
+    assert curve.durations == [1, 2, 5]
+    assert curve.values == [5.0, 3.5, 2.2]
+
+
+def test_update_best_efforts(tmp_path: Path) -> None:
+    best_efforts = get_best_efforts(tmp_path)
+
+    assert best_efforts.activity_names == ["a2020", "b2020", "c2021"]
+    assert get_1min(best_efforts, "all") == (170, "a2020")
+    assert get_1min(best_efforts, "2020") == (170, "a2020")
+    assert get_1min(best_efforts, "2021") == (165, "c2021")
+
+
+def test_update_best_efforts_reimported(tmp_path: Path) -> None:
+    best_efforts = get_best_efforts(tmp_path)
+    curves = get_curves(150)
+    cache_curves(tmp_path, "a2020", curves)
+
+    update_best_efforts(
+        best_efforts, "a2020", START_TIMES["a2020"], curves, START_TIMES, str(tmp_path)
+    )
+
+    # Its previous values are replaced by the next best ones
+    assert sorted(best_efforts.activity_names) == ["a2020", "b2020", "c2021"]
+    assert get_1min(best_efforts, "all") == (165, "c2021")
+    assert get_1min(best_efforts, "2020") == (160, "b2020")
+
+
+def test_remove_best_efforts(tmp_path: Path) -> None:
+    best_efforts = get_best_efforts(tmp_path)
+
+    remove_best_efforts(best_efforts, {"c2021"}, START_TIMES, str(tmp_path))
+
+    assert best_efforts.activity_names == ["a2020", "b2020"]
+    assert get_1min(best_efforts, "all") == (170, "a2020")
+    assert "2021" not in best_efforts.envelopes
+
+    # Without cached curves, other activities of the period are unlisted, to be
+    # added again
+    get_curves_filename("b2020", str(tmp_path)).unlink()
+    remove_best_efforts(best_efforts, {"a2020"}, START_TIMES, str(tmp_path))
+
+    assert best_efforts.activity_names == []
+    assert best_efforts.envelopes == {}
+
+
+def test_is_curves_outdated(tmp_path: Path) -> None:
+    fitfile = tmp_path / "a2020.fit"
+    fitfile.touch()
+    cache_curves(tmp_path, "a2020", get_curves(170))
+
+    assert not is_curves_outdated("a2020", str(fitfile), str(tmp_path))
+    assert not is_curves_outdated("b2020", str(fitfile), str(tmp_path))
+
+    # Re-exported since
+    mtime = get_curves_filename("a2020", str(tmp_path)).stat().st_mtime + 10
+    os.utime(fitfile, (mtime, mtime))
+
+    assert is_curves_outdated("a2020", str(fitfile), str(tmp_path))
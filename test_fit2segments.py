@@ -0,0 +1,202 @@
+"""
+Matching of `fit2segments.py`: its faster paths find the same attempts as the
+plain one, on a random track that goes back and forth over its segments.
+
+Run with `python -m pytest`.
+"""
+
+import argparse
+import logging
+import random
+from dataclasses import replace
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, List, Tuple
+
+import pytest
+
+import fit2segments
+from fit2segments import (
+    MATCH_THRESHOLD,
+    distance,
+    find_candidates,
+    get_match_executor,
+    match,
+    match_stream,
+)
+from fitlib import Segment_definition, Segment_definition_point, Track, Track_point
+from tracklib import get_track_handle
+
+# Latitude and longitude, in semicircles
+Position = Tuple[int, int]
+
+
+@pytest.fixture(autouse=True)
+def logger(monkeypatch: Any) -> None:
+    """`fit2segments.py` binds its logger when run as a script"""
+    monkeypatch.setattr(
+        fit2segments, "logger", logging.getLogger("fit2seg"), raising=False
+    )
+
+
+def get_path(seed: int, length: int) -> List[Position]:
+    rng = random.Random(seed)
+    latitude, longitude = 500000000, 60000000
+    to_return = []
+
+    for _ in range(length):
+        latitude += rng.randint(-900, 1000)
+        longitude += rng.randint(-900, 1000)
+        to_return.append((latitude, longitude))
+
+    return to_return
+
+
+def get_track(seed: int, path: List[Position]) -> Track:
+    """Out and back along `path`, then out again faster, with a few GPS dropouts"""
+    rng = random.Random(seed)
+    timestamp = datetime(2020, 5, 24, 10)
+    track_points = []
+
+    for idx, (latitude, longitude) in enumerate(path + path[::-1] + path[::3]):
+        timestamp += timedelta(seconds=rng.choice([1, 1, 1, 2, 5, 12]))
+        fix = rng.random() > 0.01
+        track_points.append(
+            Track_point(
+                altitude=100.0,
+                cadence=80.0,
+                distance=8.0 * idx + 1,
+                enhanced_altitude=None,
+                enhanced_speed=None,
+                fractional_cadence=0.0,
+                heart_rate=140.0 + idx % 13,
+                position_lat=latitude + rng.randint(-500, 500) if fix else None,
+                position_long=longitude if fix else None,
+                speed=8.0,
+                temperature=20.0,
+                timestamp=timestamp,
+                unknown_61=None,
+                unknown_66=None,
+            )
+        )
+
+    return Track(name="2020-05-24-10-00-00", track_points=track_points)
+
+
+def get_segment_definitions(
+    seed: int, path: List[Position], count: int
+) -> List[Segment_definition]:
+    """Segments along the path (one way or the other), and a few away from it"""
+    rng = random.Random(seed)
+    to_return = []
+
+    for idx in range(count):
+        first = rng.randrange(len(path) - 400)
+        start, stop = path[first], path[first + rng.randint(100, 399)]
+
+        if idx % 4 == 1:
+            start, stop = stop, start
+        elif idx % 4 == 3:
+            start = (start[0] - 10 ** 7, start[1])
+        to_return.append(
+            Segment_definition(
+                debug=False,
+                name=f"s{idx}",
+                strava_id=None,
+                latlng=None,
+                start=Segment_definition_point(
+                    0, start[0] + rng.randint(-3000, 3000), start[1], 5
+                ),
+                stop=Segment_definition_point(
+                    0, stop[0], stop[1] + rng.randint(-3000, 3000), 5
+                ),
+            )
+        )
+
+    return to_return
+
+
+@pytest.mark.parametrize("seed", [1, 2])
+def test_match_stream(seed: int) -> None:
+    path = get_path(seed, 2000)
+    track = get_track(seed, path)
+    segment_definitions = get_segment_definitions(seed, path, 40)
+
+    segments = match(track, segment_definitions, argparse.Namespace())
+    streamed = list(
+        match_stream(track.name, iter(track.track_points), segment_definitions)
+    )
+
+    assert len(segments) > 20
+    # Yielded as their stop is passed, rather than by definition
+    assert sorted(streamed, key=lambda s: (s.segment_uid, s.start_time)) == sorted(
+        segments, key=lambda s: (s.segment_uid, s.start_time)
+    )
+
+
+@pytest.mark.parametrize("seed", [1, 2])
+def test_find_candidates(seed: int) -> None:
+    path = get_path(seed, 2000)
+    rng = random.Random(seed)
+    track_points = [
+        # GPS jumps, e.g. while in a tunnel
+        replace(tp, position_lat=tp.position_lat + rng.randint(-(10 ** 6), 10 ** 6))
+        if tp.position_lat and rng.random() < 0.002
+        else tp
+
+        for tp in get_track(seed, path).track_points
+
+        if tp.position_lat
+    ]
+    segment_definitions = get_segment_definitions(seed, path, 40)
+
+    full_scan = [
+        [
+            [
+                (idx, int(distance(tp, point)))
+
+                for idx, tp in enumerate(track_points)
+
+                if distance(tp, point) < MATCH_THRESHOLD
+            ]
+
+            for point in [sd.start, sd.stop]
+        ]
+
+        for sd in segment_definitions
+    ]
+
+    candidates = find_candidates(track_points, segment_definitions, MATCH_THRESHOLD)
+
+    assert sum([len(starts) for starts, _ in full_scan]) > 20
+    assert [
+        [[(c.idx, c.dist_to_segment) for c in cs] for cs in pair]
+
+        for pair in candidates
+    ] == full_scan
+
+
+def test_match_chunks(tmp_path: Path, monkeypatch: Any) -> None:
+    # Chunks of about 1000 points, scanned by worker processes
+    monkeypatch.setattr(fit2segments, "LONG_TRACK_POINTS", 1000)
+    monkeypatch.setattr(fit2segments, "MATCH_CHUNK_DURATION", timedelta(minutes=37))
+    path = get_path(3, 2000)
+    track = get_track(3, path)
+    segment_definitions = get_segment_definitions(3, path, 40)
+    source_file = tmp_path / f"{track.name}.fit"
+    source_file.touch()
+    track_handle = get_track_handle(str(source_file), str(tmp_path), track)
+
+    segments = match(track, segment_definitions, argparse.Namespace())
+
+    with get_match_executor(segment_definitions, 2) as executor:
+        chunked = match(
+            track,
+            segment_definitions,
+            argparse.Namespace(),
+            executor=executor,
+            track_handle=track_handle,
+        )
+
+    assert len(segments) > 20
+    assert chunked == segments
@@ -0,0 +1,196 @@
+"""
+Round trips of the segments and activities files, in the columnar format and in the
+former format (a list of records), cf. `fitlib._write_records()`.
+
+Run with `python -m pytest`.
+"""
+
+import json
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List
+
+from fitlib import (
+    COLUMNAR_FORMAT,
+    Activity,
+    Metric,
+    Segment,
+    _decode_columns,
+    _dump_records,
+    _encode_columns,
+    _load_records,
+    _write_records,
+    load_activities,
+    load_segments,
+    write_activities,
+    write_segments,
+)
+
+
+def get_activities() -> List[Activity]:
+    return [
+        Activity(
+            avg_heart_rate=142.5,
+            calories=812.0,
+            distance=42195.0,
+            duration=timedelta(hours=3, minutes=2, seconds=5),
+            elevation_gain=310.0,
+            elevation_loss=305.5,
+            gps_available=True,
+            matched_against_segments=["uid1", "uid2"],
+            moving_time=timedelta(hours=2, minutes=58),
+            name="2020-05-24-10-42-18",
+            start_time=datetime(2020, 5, 24, 10, 42, 18),
+            year=2020,
+        ),
+        # Home trainer ride: no GPS, optional fields not set
+        Activity(
+            avg_heart_rate=None,
+            calories=None,
+            distance=None,
+            duration=timedelta(minutes=45),
+            elevation_gain=None,
+            elevation_loss=None,
+            gps_available=False,
+            matched_against_segments=[],
+            moving_time=None,
+            name="2021-01-03-18-00-00",
+            start_time=datetime(2021, 1, 3, 18),
+            year=2021,
+        ),
+    ]
+
+
+def get_segments() -> List[Segment]:
+    return [
+        Segment(
+            activity_name="2020-05-24-10-42-18",
+            cadence=Metric(avg=85.5, upper=110.0, lower=60.0, stdev=7.25),
+            duration=timedelta(minutes=12, seconds=34),
+            elevation_gain=152.0,
+            grade=6.5,
+            heart_rate=Metric(avg=165.0, upper=181.0, lower=142.0, stdev=8.5),
+            moving_time=timedelta(minutes=12, seconds=30),
+            nested_in=["uid2"],
+            power=None,
+            segment_name="Climb",
+            segment_uid="uid1",
+            speed=Metric(avg=11.5, upper=19.0, lower=7.0, stdev=2.0),
+            start_time=datetime(2020, 5, 24, 11, 5, 1),
+            temperature=Metric(avg=21.0, upper=23.0, lower=19.0, stdev=1.0),
+        ),
+        Segment(
+            activity_name="2020-05-24-10-42-18",
+            cadence=None,
+            duration=timedelta(hours=1, seconds=1),
+            elevation_gain=None,
+            grade=None,
+            heart_rate=None,
+            moving_time=None,
+            nested_in=None,
+            power=None,
+            segment_name="Loop",
+            segment_uid="uid2",
+            speed=None,
+            start_time=datetime(2020, 5, 24, 10, 50),
+            temperature=None,
+        ),
+    ]
+
+
+def write_legacy_records(records: List, filename: Path) -> None:
+    """Write records in the former format, a list of objects"""
+
+    with filename.open("w") as f_handler:
+        _dump_records(records, f_handler)
+
+
+def test_encode_decode_columns_activities() -> None:
+    activities = get_activities()
+    data = _encode_columns(activities, Activity)
+
+    assert data["format"] == COLUMNAR_FORMAT
+    assert data["length"] == 2
+    assert data["columns"]["duration"] == [10925.0, 2700.0]
+    assert data["columns"]["start_time"][0] == "2020-05-24T10:42:18"
+    assert data["columns"]["moving_time"][1] is None
+    assert _decode_columns(data, Activity) == activities
+
+
+def test_encode_decode_columns_segments() -> None:
+    segments = get_segments()
+    data = _encode_columns(segments, Segment)
+
+    # Nested records are stored as lists of values
+    assert data["columns"]["heart_rate"] == [[165.0, 181.0, 142.0, 8.5], None]
+    assert _decode_columns(data, Segment) == segments
+
+
+def test_encode_decode_columns_through_json() -> None:
+    segments = get_segments()
+    data = json.loads(json.dumps(_encode_columns(segments, Segment)))
+
+    assert _decode_columns(data, Segment) == segments
+
+
+def test_decode_missing_columns() -> None:
+    data = _encode_columns(get_segments(), Segment)
+    del data["columns"]["power"]
+    del data["columns"]["nested_in"]
+
+    segments = _decode_columns(data, Segment)
+
+    assert [s.power for s in segments] == [None, None]
+    assert [s.nested_in for s in segments] == [None, None]
+
+
+def test_decode_empty_columns() -> None:
+    data = _encode_columns([], Activity)
+
+    assert data["length"] == 0
+    assert _decode_columns(data, Activity) == []
+
+
+def test_write_load_records(tmp_path: Path) -> None:
+    activities_filename = str(tmp_path / "activities.json")
+    segments_filename = str(tmp_path / "segments.json")
+
+    write_activities(get_activities(), activities_filename)
+    write_segments(get_segments(), segments_filename)
+
+    with open(segments_filename) as f_handler:
+        assert json.load(f_handler)["format"] == COLUMNAR_FORMAT
+    assert load_activities(activities_filename) == get_activities()
+    assert load_segments(segments_filename) == get_segments()
+
+
+def test_load_missing_records(tmp_path: Path) -> None:
+    assert _load_records(str(tmp_path / "missing.json"), Segment) == []
+
+
+def test_load_legacy_records(tmp_path: Path) -> None:
+    activities_file = tmp_path / "activities.json"
+    segments_file = tmp_path / "segments.json"
+
+    write_legacy_records(get_activities(), activities_file)
+    write_legacy_records(get_segments(), segments_file)
+
+    with segments_file.open() as f_handler:
+        assert isinstance(json.load(f_handler), list)
+    assert _load_records(str(activities_file), Activity) == get_activities()
+    assert _load_records(str(segments_file), Segment) == get_segments()
+
+
+def test_legacy_to_columnar_to_legacy(tmp_path: Path) -> None:
+    legacy_file = tmp_path / "legacy.json"
+    columnar_file = tmp_path / "columnar.json"
+    legacy_again_file = tmp_path / "legacy_again.json"
+
+    write_legacy_records(get_segments(), legacy_file)
+    segments = _load_records(str(legacy_file), Segment)
+    _write_records(segments, str(columnar_file), Segment)
+    segments = _load_records(str(columnar_file), Segment)
+    write_legacy_records(segments, legacy_again_file)
+
+    assert legacy_again_file.read_text() == legacy_file.read_text()
+    assert _load_records(str(legacy_again_file), Segment) == get_segments()
@@ -0,0 +1,217 @@
+"""
+Imports of `import_strava_segments.py` from a local stand-in for the Strava web
+site, given by `--base-url`.
+
+Run with `python -m pytest`.
+"""
+
+import argparse
+import json
+import logging
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple, Type
+
+import pytest
+import requests
+import requests_cache
+
+import import_strava_segments
+from import_strava_segments import Rate_limiter, fetch, import_from_strava, main
+
+SEGMENT_PAGE = """<html><body>
+<span id="js-full-name">Col du test #{seg_id}</span>
+<b class="stat-text">5.2km</b>
+<b class="stat-text">7.1%</b>
+<b class="stat-text">1,200m</b>
+<b class="stat-text">1,570m</b>
+<b class="stat-text">370m</b>
+<b class="stat-text">2</b>
+</body></html>"""
+
+
+class Strava_handler(BaseHTTPRequestHandler):
+    """Segment streams and pages, after the failures planned for each path"""
+
+    # Path -> statuses of the first requests
+    failures: Dict[str, List[int]] = {}
+    # Time and path of each request
+    received: List[Tuple[float, str]] = []
+
+    def do_GET(self) -> None:
+        self.received.append((time.monotonic(), self.path))
+        statuses = self.failures.get(self.path)
+
+        if statuses:
+            self.send_response(statuses.pop(0))
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+
+            return
+
+        stream = re.fullmatch(
+            r"/stream/segments/(\d+)\?streams%5B%5D=latlng", self.path
+        )
+        page = re.fullmatch(r"/segments/(\d+)", self.path)
+
+        if stream:
+            seg_id = int(stream.group(1))
+            body = json.dumps({"latlng": [[45.0, 5.0 + seg_id / 100], [45.1, 5.2]]})
+        elif page:
+            body = SEGMENT_PAGE.format(seg_id=page.group(1))
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+            return
+
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+
+@pytest.fixture
+def handler(monkeypatch: Any) -> Iterator[Type[Strava_handler]]:
+    """Fresh request log, responses not cached, logger bound as by the script"""
+    monkeypatch.setattr(
+        import_strava_segments,
+        "logger",
+        logging.getLogger("import_strava_segments"),
+        raising=False,
+    )
+
+    with requests_cache.disabled():
+        yield type("Handler", (Strava_handler,), {"failures": {}, "received": []})
+
+
+@pytest.fixture
+def base_url(handler: Type[Strava_handler]) -> Iterator[str]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+
+    server.shutdown()
+    server.server_close()
+
+
+def write_strava_segments(tmp_path: Path, seg_ids: List[int]) -> str:
+    strava_segments_file = tmp_path / "strava_segments.json"
+    strava_segments_file.write_text(
+        json.dumps(
+            [{"name": f"Segment {i}", "strava_segment_id": i} for i in seg_ids]
+        )
+    )
+
+    return str(strava_segments_file)
+
+
+def get_fetched_ids(handler: Type[Strava_handler]) -> List[int]:
+    return sorted(
+        [
+            int(path.split("/")[-1])
+
+            for _, path in handler.received
+
+            if path.startswith("/segments/")
+        ]
+    )
+
+
+def test_import_incremental(
+    tmp_path: Path, handler: Type[Strava_handler], base_url: str
+) -> None:
+    output_file = tmp_path / "segment_definitions.json"
+    args = argparse.Namespace(
+        strava_segments_files=[write_strava_segments(tmp_path, [1, 2, 1])],
+        output=str(output_file),
+        base_url=f"{base_url}/",
+        workers=2,
+        rate=0,
+        retries=0,
+        incremental=True,
+    )
+
+    main(args)
+    imported = json.loads(output_file.read_text())
+
+    # Listed twice, fetched once
+    assert get_fetched_ids(handler) == [1, 2]
+    assert sorted([(s["strava_id"], s["name"]) for s in imported]) == [
+        (1, "Col Du Test 1"),
+        (2, "Col Du Test 2"),
+    ]
+    assert imported[0]["start"]["latitude"] == 45.0
+    assert imported[0]["stop"]["longitude"] == 5.2
+
+    handler.received.clear()
+    args.strava_segments_files = [write_strava_segments(tmp_path, [1, 2, 3])]
+    main(args)
+
+    # Known segments are kept, not fetched again
+    assert get_fetched_ids(handler) == [3]
+    assert sorted([s["strava_id"] for s in json.loads(output_file.read_text())]) == [
+        1,
+        2,
+        3,
+    ]
+
+
+def test_fetch_retries(handler: Type[Strava_handler], base_url: str) -> None:
+    limiter = Rate_limiter(None)
+    handler.failures["/segments/1"] = [429, 503]
+
+    response = fetch(f"{base_url}/segments/1", limiter, retries=2, backoff=0.01)
+
+    assert response.status_code == 200
+    assert get_fetched_ids(handler) == [1, 1, 1]
+
+    handler.failures["/segments/2"] = [500, 502]
+
+    with pytest.raises(requests.HTTPError):
+        fetch(f"{base_url}/segments/2", limiter, retries=1, backoff=0.01)
+
+    assert get_fetched_ids(handler) == [1, 1, 1, 2, 2]
+
+    # Other errors are not retried
+    with pytest.raises(requests.HTTPError):
+        fetch(f"{base_url}/unknown", limiter, retries=2, backoff=0.01)
+
+    assert len(handler.received) == 6
+
+
+def test_failed_segments_are_left_out(
+    tmp_path: Path, handler: Type[Strava_handler], base_url: str
+) -> None:
+    handler.failures["/segments/2"] = [404]
+
+    imported = import_from_strava(
+        write_strava_segments(tmp_path, [1, 2, 3]), base_url, retries=0
+    )
+
+    assert [s.strava_id for s in imported] == [1, 3]
+
+
+def test_rate_limiter(
+    tmp_path: Path, handler: Type[Strava_handler], base_url: str
+) -> None:
+    rate = 20.0
+
+    import_from_strava(
+        write_strava_segments(tmp_path, [1, 2, 3]),
+        base_url,
+        workers=3,
+        limiter=Rate_limiter(rate),
+    )
+    times = sorted([t for t, _ in handler.received])
+
+    # 2 requests per segment, spaced across worker threads
+    assert len(times) == 6
+    assert times[-1] - times[0] >= 0.9 * (len(times) - 1) / rate
@@ -0,0 +1,107 @@
+"""
+Profile files of `profilelib.py`, as attempts are profiled again.
+
+Run with `python -m pytest`.
+"""
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List
+
+from fitlib import Segment, Track_point
+from profilelib import Profile_store, get_profiles_filename, load_profiles
+
+SEGMENT_UID = "uid1"
+
+
+def get_segment(activity_name: str, start_time: datetime) -> Segment:
+    return Segment(
+        activity_name=activity_name,
+        cadence=None,
+        duration=timedelta(minutes=1),
+        elevation_gain=None,
+        grade=None,
+        heart_rate=None,
+        moving_time=None,
+        nested_in=None,
+        power=None,
+        segment_name="Climb",
+        segment_uid=SEGMENT_UID,
+        speed=None,
+        start_time=start_time,
+        temperature=None,
+    )
+
+
+def get_points(start_time: datetime, heart_rate: float) -> List[Track_point]:
+    return [
+        Track_point(
+            altitude=None,
+            cadence=None,
+            distance=5.0 * idx,
+            enhanced_altitude=None,
+            enhanced_speed=None,
+            fractional_cadence=None,
+            heart_rate=heart_rate,
+            position_lat=None,
+            position_long=None,
+            speed=None,
+            temperature=None,
+            timestamp=start_time + timedelta(seconds=idx),
+            unknown_61=None,
+            unknown_66=None,
+        )
+
+        for idx in range(60)
+    ]
+
+
+def add_profile(
+    profiles: Profile_store, activity_name: str, start_time: datetime, heart_rate: float
+) -> None:
+    profiles.add(
+        get_segment(activity_name, start_time), get_points(start_time, heart_rate)
+    )
+
+
+def count_lines(tmp_path: Path) -> int:
+    with get_profiles_filename(SEGMENT_UID, str(tmp_path)).open() as f_handler:
+        return len(f_handler.readlines())
+
+
+def test_flush(tmp_path: Path) -> None:
+    first, second = datetime(2020, 5, 24, 10), datetime(2020, 6, 1, 9)
+    profiles = Profile_store(str(tmp_path))
+    add_profile(profiles, "a", first, 140.0)
+    profiles.flush()
+    add_profile(profiles, "b", second, 150.0)
+    profiles.flush()
+
+    # New attempts are appended
+    assert count_lines(tmp_path) == 2
+
+    # Attempt profiled again: the file is rewritten
+    add_profile(profiles, "a", first, 145.0)
+    profiles.flush()
+    loaded = load_profiles(SEGMENT_UID, str(tmp_path))
+
+    assert count_lines(tmp_path) == 2
+    assert loaded[("a", first)].metrics["heart_rate"][0] == 145.0
+    assert loaded[("b", second)].metrics["heart_rate"][0] == 150.0
+
+
+def test_flush_compacts_duplicates(tmp_path: Path) -> None:
+    start_time = datetime(2020, 5, 24, 10)
+    profiles_file = get_profiles_filename(SEGMENT_UID, str(tmp_path))
+    profiles = Profile_store(str(tmp_path))
+    add_profile(profiles, "a", start_time, 140.0)
+    profiles.flush()
+    # As appended by previous versions, whenever an attempt was profiled again
+    line = profiles_file.read_text()
+    profiles_file.write_text(3 * line)
+
+    add_profile(profiles, "b", start_time, 150.0)
+    profiles.flush()
+
+    assert count_lines(tmp_path) == 2
+    assert len(load_profiles(SEGMENT_UID, str(tmp_path))) == 2
@@ -0,0 +1,186 @@
+"""
+JSON API of `serve_ui.py`, served on localhost from store files written in a
+temporary directory.
+
+Run with `python -m pytest`.
+"""
+
+import gzip
+import json
+import threading
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+from fitlib import Activity, Segment, write_activities, write_segments
+from serve_ui import Store, make_server
+
+SEGMENT_UID = "uid1"
+
+
+def get_activity(name: str, start_time: datetime, gps_available: bool) -> Activity:
+    return Activity(
+        avg_heart_rate=None,
+        calories=None,
+        distance=30000.0,
+        duration=timedelta(hours=1),
+        elevation_gain=None,
+        elevation_loss=None,
+        gps_available=gps_available,
+        matched_against_segments=[SEGMENT_UID],
+        moving_time=None,
+        name=name,
+        start_time=start_time,
+        year=start_time.year,
+    )
+
+
+def get_segment(activity: Activity, minutes: int) -> Segment:
+    return Segment(
+        activity_name=activity.name,
+        cadence=None,
+        duration=timedelta(minutes=minutes),
+        elevation_gain=None,
+        grade=None,
+        heart_rate=None,
+        moving_time=None,
+        nested_in=None,
+        power=None,
+        segment_name="Climb",
+        segment_uid=SEGMENT_UID,
+        speed=None,
+        start_time=activity.start_time + timedelta(minutes=5),
+        temperature=None,
+    )
+
+
+@pytest.fixture
+def server(tmp_path: Path, monkeypatch: Any) -> Iterator[ThreadingHTTPServer]:
+    """Server of 3 activities (one without GPS) and 2 attempts, on a free port"""
+    monkeypatch.chdir(tmp_path)
+    activities = [
+        get_activity("a2020", datetime(2020, 5, 24, 10), True),
+        get_activity("a2021", datetime(2021, 6, 1, 9), True),
+        get_activity("ht2021", datetime(2021, 12, 1, 18), False),
+    ]
+    write_activities(activities)
+    write_segments([get_segment(activities[0], 12), get_segment(activities[1], 10)])
+    (tmp_path / "ui" / "userdata").mkdir(parents=True)
+    (tmp_path / "ui" / "userdata" / "a2020.json").write_text(
+        json.dumps([[44.9 + i / 1e5, 5.1] for i in range(500)])
+    )
+
+    store = Store()
+    store.refresh()
+    to_return = make_server(store, "127.0.0.1", 0)
+    thread = threading.Thread(target=to_return.serve_forever, daemon=True)
+    thread.start()
+
+    yield to_return
+
+    to_return.shutdown()
+    to_return.server_close()
+
+
+def get(
+    server: ThreadingHTTPServer, path: str, headers: Optional[Dict[str, str]] = None
+) -> Tuple[int, Dict[str, str], bytes]:
+    """Status, headers and body of a GET request"""
+    url = f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+    try:
+        with urlopen(Request(url, headers=headers or {})) as response:
+            return (response.status, dict(response.headers), response.read())
+    except HTTPError as e:
+        return (e.code, dict(e.headers), b"")
+
+
+def get_items(server: ThreadingHTTPServer, path: str) -> List[Dict[str, Any]]:
+    status, _, body = get(server, path)
+    assert status == 200
+
+    return json.loads(body)["items"]
+
+
+def test_activities(server: ThreadingHTTPServer) -> None:
+    status, headers, body = get(server, "/api/activities?limit=2")
+    page = json.loads(body)
+
+    assert status == 200
+    assert headers["Content-Type"] == "application/json"
+    assert page["total"] == 3
+    assert page["limit"] == 2
+    # Most recent first
+    assert [a["name"] for a in page["items"]] == ["ht2021", "a2021"]
+    assert [a["name"] for a in get_items(server, "/api/activities?gps=1")] == [
+        "a2021",
+        "a2020",
+    ]
+    assert [
+        a["name"] for a in get_items(server, "/api/activities?from=2021-01-01&gps=0")
+    ] == ["ht2021"]
+    assert [a["name"] for a in get_items(server, "/api/activities?name=a2020")] == [
+        "a2020"
+    ]
+
+
+def test_segments_and_leaderboard(server: ThreadingHTTPServer) -> None:
+    segments = get_items(server, "/api/segments?activity=a2020&ranks=1")
+
+    assert len(segments) == 1
+    assert segments[0]["rank"] == 2
+    assert segments[0]["attempts"] == 2
+    assert segments[0]["year_rank"] == 1
+    assert segments[0]["year_attempts"] == 1
+    assert [
+        s["activity_name"]
+        for s in get_items(server, f"/api/segments?uid={SEGMENT_UID}&order=desc")
+    ] == ["a2021", "a2020"]
+    assert [
+        (s["activity_name"], s["rank"])
+        for s in get_items(server, f"/api/leaderboard/{SEGMENT_UID}")
+    ] == [("a2021", 1), ("a2020", 2)]
+    leaderboard_2020 = get_items(server, f"/api/leaderboard/{SEGMENT_UID}?year=2020")
+
+    # All-time rank
+    assert [s["rank"] for s in leaderboard_2020] == [2]
+
+
+def test_etag_not_modified(server: ThreadingHTTPServer) -> None:
+    status, headers, _ = get(server, "/api/activities")
+    etag = headers["ETag"]
+    since = headers["Last-Modified"]
+
+    assert status == 200
+    assert get(server, "/api/activities", {"If-None-Match": etag})[0] == 304
+    assert get(server, "/api/activities", {"If-Modified-Since": since})[0] == 304
+    # Another path, another ETag
+    assert get(server, "/api/activities?limit=1", {"If-None-Match": etag})[0] == 200
+
+
+def test_gzip(server: ThreadingHTTPServer) -> None:
+    status, headers, body = get(
+        server, "/api/traces/a2020", {"Accept-Encoding": "gzip"}
+    )
+
+    assert status == 200
+    assert headers["Content-Encoding"] == "gzip"
+    assert len(json.loads(gzip.decompress(body))) == 500
+
+    status, headers, body = get(server, "/api/traces/a2020")
+
+    assert "Content-Encoding" not in headers
+    assert len(json.loads(body)) == 500
+
+
+def test_errors(server: ThreadingHTTPServer) -> None:
+    assert get(server, "/api/traces/missing")[0] == 404
+    assert get(server, "/api/unknown")[0] == 404
+    assert get(server, "/api/activities?limit=-1")[0] == 400
+    assert get(server, "/api/activities?order=random")[0] == 400
+    assert get(server, "/api/activities?from=yesterday")[0] == 400
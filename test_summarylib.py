@@ -0,0 +1,238 @@
+"""
+Summaries of FIT files from their session and lap messages, on FIT files built
+message by message.
+
+Run with `python -m pytest`.
+"""
+
+import struct
+from datetime import timedelta
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import pytest
+
+from summarylib import (
+    FIT_EPOCH,
+    LAP_MESSAGE,
+    SESSION_MESSAGE,
+    decode_summary_fields,
+    read_fit_summary,
+    scan_fit_messages,
+)
+
+RECORD_MESSAGE = 20
+START_TIME = 1000000000
+INVALID_POSITION = 0x7FFFFFFF
+# Field definition number, struct format, base type
+SESSION_FIELDS = [
+    (253, "I", 0x86),
+    (2, "I", 0x86),
+    (7, "I", 0x86),
+    (8, "I", 0x86),
+    (9, "I", 0x86),
+    (11, "H", 0x84),
+    (16, "B", 0x02),
+    (22, "H", 0x84),
+    (23, "H", 0x84),
+    # Not a summary field
+    (5, "B", 0x00),
+]
+LAP_FIELDS = [(253, "I", 0x86), (2, "I", 0x86), (3, "i", 0x85), (4, "i", 0x85)]
+RECORD_FIELDS = [(253, "I", 0x86), (3, "B", 0x02)]
+
+
+def get_definition(
+    local_type: int,
+    global_number: int,
+    fields: List[Tuple[int, str, int]],
+    byteorder: str = "<",
+    developer_fields: int = 0,
+) -> bytes:
+    header = 0x40 | local_type | (0x20 if developer_fields else 0)
+    to_return = bytes([header, 0, 1 if byteorder == ">" else 0])
+    to_return += struct.pack(byteorder + "HB", global_number, len(fields))
+
+    for number, fmt, base_type in fields:
+        to_return += bytes([number, struct.calcsize(fmt), base_type])
+
+    if developer_fields:
+        to_return += bytes([developer_fields])
+        to_return += b"".join([bytes([idx, 2, 0]) for idx in range(developer_fields)])
+
+    return to_return
+
+
+def get_message(
+    local_type: int,
+    fields: List[Tuple[int, str, int]],
+    values: List[int],
+    byteorder: str = "<",
+) -> bytes:
+    fmt = byteorder + "".join([f for _, f, _ in fields])
+
+    return bytes([local_type]) + struct.pack(fmt, *values)
+
+
+def get_fit_content(
+    lap_position: Optional[int], byteorder: str = "<", records: int = 100
+) -> bytes:
+    """A FIT file: records (with a developer field), a lap and a session
+
+    The lap has a start position if `lap_position` is not None (invalid if equal to
+    INVALID_POSITION), none at all otherwise.
+    """
+    messages = get_definition(
+        0, RECORD_MESSAGE, RECORD_FIELDS, byteorder, developer_fields=1
+    )
+
+    for idx in range(records):
+        values = struct.pack(byteorder + "IBH", START_TIME + idx, 120, 7)
+        messages += bytes([0]) + values
+
+        # Compressed timestamp header
+        if idx % 10 == 0:
+            messages += bytes([0x80 | 5]) + values
+
+    if lap_position is None:
+        lap_fields = LAP_FIELDS[:2]
+        lap_values = [START_TIME + records, START_TIME]
+    else:
+        lap_fields = LAP_FIELDS
+        lap_values = [START_TIME + records, START_TIME, lap_position, lap_position]
+    messages += get_definition(1, LAP_MESSAGE, lap_fields, byteorder)
+    messages += get_message(1, lap_fields, lap_values, byteorder)
+    messages += get_definition(2, SESSION_MESSAGE, SESSION_FIELDS, byteorder)
+    messages += get_message(
+        2,
+        SESSION_FIELDS,
+        [START_TIME + records, START_TIME, 3600500, 3500000, 3000000, 750]
+        + [142, 0xFFFF, 120, 2],
+        byteorder,
+    )
+
+    header = bytes([14, 0x20]) + struct.pack("<HI", 2100, len(messages)) + b".FIT"
+
+    # No CRC is checked
+    return header + b"\0\0" + messages + b"\0\0"
+
+
+def write_fit_file(tmp_path: Path, name: str, content: bytes) -> str:
+    fitfile = tmp_path / name
+    fitfile.write_bytes(content)
+
+    return str(fitfile)
+
+
+def test_decode_summary_fields() -> None:
+    fields = [(2, "I", 0x86), (3, "i", 0x85), (5, "H", 0x84), (9, "I", 0x86)]
+    data = b"\xff" + struct.pack(">IiHI", START_TIME, INVALID_POSITION, 7, 123456)
+
+    decoded = decode_summary_fields(
+        data, 1, (LAP_MESSAGE, ">", [(n, struct.calcsize(f)) for n, f, _ in fields], 14)
+    )
+
+    # Unset fields are None, unknown fields are skipped, values are scaled
+    assert decoded == {
+        "start_time": START_TIME,
+        "start_position_lat": None,
+        "total_distance": 1234.56,
+    }
+
+
+def test_scan_fit_messages() -> None:
+    sessions, laps = scan_fit_messages(get_fit_content(500000000, ">"))
+
+    assert laps == [
+        {
+            "start_time": START_TIME,
+            "start_position_lat": 500000000,
+            "start_position_long": 500000000,
+        }
+    ]
+    assert sessions == [
+        {
+            "start_time": START_TIME,
+            "total_elapsed_time": 3600.5,
+            "total_timer_time": 3500.0,
+            "total_distance": 30000.0,
+            "total_calories": 750,
+            "avg_heart_rate": 142,
+            "total_ascent": None,
+            "total_descent": 120,
+        }
+    ]
+
+
+def test_read_fit_summary_gps(tmp_path: Path) -> None:
+    summary = read_fit_summary(
+        write_fit_file(tmp_path, "gps.fit", get_fit_content(500000000))
+    )
+
+    assert summary is not None
+    assert summary.gps_available is True
+    assert summary.start_time == FIT_EPOCH + timedelta(seconds=START_TIME)
+    assert summary.duration == timedelta(seconds=3600.5)
+    assert summary.moving_time == timedelta(seconds=3500)
+    assert summary.distance == 30000.0
+    assert summary.calories == 750
+    assert summary.avg_heart_rate == 142
+    assert summary.elevation_gain is None
+    assert summary.elevation_loss == 120
+
+
+def test_read_fit_summary_no_gps(tmp_path: Path) -> None:
+    # Start positions defined, but not set
+    summary = read_fit_summary(
+        write_fit_file(tmp_path, "ht.fit", get_fit_content(INVALID_POSITION))
+    )
+
+    assert summary is not None
+    assert summary.gps_available is False
+
+
+def test_read_fit_summary_no_start_position(tmp_path: Path) -> None:
+    summary = read_fit_summary(
+        write_fit_file(tmp_path, "unknown.fit", get_fit_content(None))
+    )
+
+    assert summary is not None
+    assert summary.gps_available is None
+    assert summary.distance == 30000.0
+
+
+def test_read_fit_summary_chained(tmp_path: Path) -> None:
+    content = get_fit_content(INVALID_POSITION) + get_fit_content(500000000)
+    summary = read_fit_summary(write_fit_file(tmp_path, "multisport.fit", content))
+
+    # Sessions are summed up, any start position means GPS
+    assert summary is not None
+    assert summary.gps_available is True
+    assert summary.duration == timedelta(seconds=7201)
+    assert summary.calories == 1500
+
+
+def test_read_fit_summary_truncated(tmp_path: Path) -> None:
+    content = get_fit_content(500000000)
+
+    with pytest.raises(ValueError):
+        scan_fit_messages(content[:-100])
+
+    assert read_fit_summary(write_fit_file(tmp_path, "a.fit", content[:-100])) is None
+    assert read_fit_summary(write_fit_file(tmp_path, "b.fit", content[:10])) is None
+
+
+def test_read_fit_summary_corrupt(tmp_path: Path) -> None:
+    content = bytearray(get_fit_content(500000000))
+    # First definition message turned into a data message without definition
+    content[14] = 0x03
+
+    with pytest.raises(ValueError):
+        scan_fit_messages(bytes(content))
+
+    assert read_fit_summary(write_fit_file(tmp_path, "a.fit", bytes(content))) is None
+    assert read_fit_summary(write_fit_file(tmp_path, "b.fit", b"garbage" * 10)) is None
+    assert read_fit_summary(write_fit_file(tmp_path, "empty.fit", b"")) is None
+    assert read_fit_summary(str(tmp_path / "missing.fit")) is None
+    # Not a FIT file, whatever its content
+    assert read_fit_summary(write_fit_file(tmp_path, "a.gpx", b"")) is None
@@ -0,0 +1,109 @@
+"""
+Track files of `tracklib.py`, read in this process and in worker processes.
+
+Run with `python -m pytest`.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List
+
+from fit2segments import compute_attempt_metrics
+from fitlib import Track, Track_point
+from metriclib import compute_metrics
+from tracklib import Track_handle, get_track_handle, open_track_arrays
+
+
+def get_track() -> Track:
+    start_time = datetime(2020, 5, 24, 10, 42, 18)
+
+    return Track(
+        name="2020-05-24-10-42-18",
+        track_points=[
+            Track_point(
+                altitude=100.0 + idx % 7,
+                cadence=80.0 + idx % 11,
+                distance=8.0 * idx + 1,
+                enhanced_altitude=None,
+                enhanced_speed=None,
+                fractional_cadence=0.0,
+                heart_rate=140.0 + idx % 13,
+                # No GPS fix for a few points
+                position_lat=None if idx % 50 == 7 else 500000000.0 + 100 * idx,
+                position_long=None if idx % 50 == 7 else 60000000.0 - 50 * idx,
+                speed=8.0,
+                temperature=20.0,
+                timestamp=start_time + timedelta(seconds=idx),
+                unknown_61=None,
+                unknown_66=None,
+                power=None if idx % 3 else 200.0,
+            )
+
+            for idx in range(500)
+        ],
+    )
+
+
+def read_points(track_handle: Track_handle, first: int, last: int) -> List[Track_point]:
+    """Read points through a handle, in a worker process"""
+
+    with track_handle.open() as track_arrays:
+        return track_arrays.to_track(first, last).track_points
+
+
+def test_write_open_track_arrays(tmp_path: Path) -> None:
+    track = get_track()
+    source_file = tmp_path / f"{track.name}.fit"
+    source_file.touch()
+    track_handle = get_track_handle(str(source_file), str(tmp_path), track)
+
+    track_arrays = open_track_arrays(track_handle.filename)
+
+    assert track_handle.name == track.name
+    assert len(track_arrays) == len(track.track_points)
+    assert track_arrays.columns["heart_rate"][3] == 143.0
+    assert track_arrays.to_track() == track
+    track_arrays.close()
+
+
+def test_worker_reads_points_through_handle(tmp_path: Path) -> None:
+    track = get_track()
+    source_file = tmp_path / f"{track.name}.fit"
+    source_file.touch()
+    track_handle = get_track_handle(str(source_file), str(tmp_path), track)
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        points = executor.submit(read_points, track_handle, 0, 500).result()
+        chunk = executor.submit(read_points, track_handle, 120, 180).result()
+        metrics = executor.submit(compute_attempt_metrics, track_handle, 5, 60).result()
+
+    assert points == track.track_points
+    assert chunk == track.track_points[120:180]
+    # Points without GPS fix are ignored, as when matching
+    assert metrics == compute_metrics(
+        [tp for tp in track.track_points[5:60] if tp.position_lat]
+    )
+
+
+def test_track_file_is_rewritten_when_stale(tmp_path: Path) -> None:
+    track = get_track()
+    source_file = tmp_path / f"{track.name}.fit"
+    source_file.touch()
+    track_handle = get_track_handle(str(source_file), str(tmp_path), track)
+    short_track = Track(name=track.name, track_points=track.track_points[:10])
+
+    # Up to date: not rewritten
+    get_track_handle(str(source_file), str(tmp_path), short_track)
+
+    with track_handle.open() as track_arrays:
+        assert len(track_arrays) == 500
+
+    # Source file modified since
+    mtime = Path(track_handle.filename).stat().st_mtime + 10
+    os.utime(source_file, (mtime, mtime))
+    get_track_handle(str(source_file), str(tmp_path), short_track)
+
+    with track_handle.open() as track_arrays:
+        assert len(track_arrays) == 10
@@ -0,0 +1,233 @@
+"""
+Array-backed tracks, memory-mapped from the cache and shared between processes.
+
+A track is stored as one float64 column per track point field, in a single file
+next to the pickled track (`<cache>/<name>.trk`):
+
+- a magic number and the length of the header
+- a JSON header: name, number of points, byte order and column offsets
+- the columns, 8-byte aligned; missing values are NaN, timestamps are seconds since
+  the epoch (FIT timestamps are naive UTC)
+
+Columns are read through a read-only `mmap`, so that opening a track copies nothing:
+processes mapping the same file share its pages in the OS page cache. Worker
+processes are sent a `Track_handle` (a file name) and the offsets of the points
+they work on, instead of a pickled `Track`.
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from dataclasses import dataclass, fields
+from datetime import datetime, timedelta
+from math import isnan
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from fitlib import (
+    DEFAULT_CACHE_PATH,
+    Track,
+    Track_point,
+    filename2activityname,
+    load_file,
+)
+
+TRACK_MAGIC = b"F2ST"
+EPOCH = datetime(1970, 1, 1)
+TRACK_FIELDS = [f.name for f in fields(Track_point)]
+
+
+@dataclass(frozen=True)
+class Track_handle:
+    """What worker processes receive, to map a track by themselves"""
+
+    name: str
+    filename: str
+
+    def open(self) -> "Track_arrays":
+        return open_track_arrays(self.filename)
+
+
+class Track_arrays:
+    """Columns of a track, as float64 views on a memory-mapped file
+
+    `columns[field]` is a `memoryview`, indexable like a list, without copying:
+    slices of it must be released before the track is closed. Track points are only
+    built on demand, by `track_point()` or `to_track()`.
+    """
+
+    def __init__(self, name: str, columns: Dict[str, "memoryview[float]"]) -> None:
+        self.name = name
+        self.columns = columns
+        self._mmap: Optional[mmap.mmap] = None
+
+    def __len__(self) -> int:
+        return len(self.columns["timestamp"])
+
+    def __enter__(self) -> "Track_arrays":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def get_timestamp(self, idx: int) -> datetime:
+        return EPOCH + timedelta(seconds=self.columns["timestamp"][idx])
+
+    def track_point(self, idx: int) -> Track_point:
+        values: Dict[str, Any] = {
+            field_name: None if isnan(column[idx]) else column[idx]
+
+            for field_name, column in self.columns.items()
+        }
+        values["timestamp"] = self.get_timestamp(idx)
+
+        return Track_point(**values)
+
+    def to_track(self, first: int = 0, last: Optional[int] = None) -> Track:
+        """Build the `Track` of points `first` to `last` (excluded)"""
+
+        if last is None:
+            last = len(self)
+
+        return Track(
+            name=self.name,
+            track_points=[self.track_point(idx) for idx in range(first, last)],
+        )
+
+    def close(self) -> None:
+        if self._mmap is None:
+            return
+
+        for column in self.columns.values():
+            column.release()
+        self.columns = {}
+        self._mmap.close()
+        self._mmap = None
+
+
+def get_track_arrays_filename(
+    activity_name: str, cache_path_name: Optional[str] = None
+) -> Path:
+    if not cache_path_name:
+        cache_path_name = DEFAULT_CACHE_PATH
+
+    return Path(cache_path_name) / f"{activity_name}.trk"
+
+
+def get_columns(track: Track) -> Dict[str, array]:
+    """float64 columns of the track point fields, NaN for missing values"""
+    to_return: Dict[str, array] = {f: array("d") for f in TRACK_FIELDS}
+    nan = float("nan")
+
+    for tp in track.track_points:
+        for field_name in TRACK_FIELDS:
+            if field_name == "timestamp":
+                to_return[field_name].append((tp.timestamp - EPOCH).total_seconds())
+
+                continue
+
+            value = getattr(tp, field_name, None)
+            to_return[field_name].append(nan if value is None else value)
+
+    return to_return
+
+
+def write_track_arrays(track: Track, track_arrays_file: Path) -> None:
+    """Write the columns of a track, through a temporary file renamed once complete"""
+    columns = get_columns(track)
+
+    offsets: Dict[str, int] = {}
+    offset = 0
+
+    for field_name in TRACK_FIELDS:
+        offsets[field_name] = offset
+        offset += 8 * len(columns[field_name])
+
+    header = json.dumps(
+        {
+            "name": track.name,
+            "length": len(track.track_points),
+            "byteorder": sys.byteorder,
+            "offsets": offsets,
+        }
+    ).encode()
+    # Pad the header, so that the columns are 8-byte aligned
+    header += b" " * (-(len(TRACK_MAGIC) + 4 + len(header)) % 8)
+
+    track_arrays_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = track_arrays_file.with_name(
+        f"{track_arrays_file.name}.{os.getpid()}.tmp"
+    )
+
+    with tmp_file.open("wb") as f_handler:
+        f_handler.write(TRACK_MAGIC + struct.pack("<I", len(header)) + header)
+
+        for field_name in TRACK_FIELDS:
+            columns[field_name].tofile(f_handler)
+    tmp_file.replace(track_arrays_file)
+
+
+def open_track_arrays(filename: str) -> Track_arrays:
+    """Map the columns of a track file, without reading them"""
+
+    with open(filename, "rb") as f_handler:
+        mapped = mmap.mmap(f_handler.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mapped[: len(TRACK_MAGIC)] != TRACK_MAGIC:
+        mapped.close()
+        raise ValueError(f"{filename} is not a track file")
+
+    start = len(TRACK_MAGIC) + 4
+    (header_length,) = struct.unpack("<I", mapped[len(TRACK_MAGIC) : start])
+    header = json.loads(mapped[start : start + header_length])
+    start += header_length
+    length = header["length"]
+    view = memoryview(mapped)
+    columns: Dict[str, "memoryview[float]"] = {}
+
+    for field_name, offset in header["offsets"].items():
+        column = view[start + offset : start + offset + 8 * length].cast("d")
+
+        if header["byteorder"] != sys.byteorder:
+            # Foreign file: swap a private copy
+            swapped = array("d", column)
+            swapped.byteswap()
+            column.release()
+            columns[field_name] = memoryview(swapped)
+        else:
+            columns[field_name] = column
+    view.release()
+
+    to_return = Track_arrays(header["name"], columns)
+    to_return._mmap = mapped
+
+    return to_return
+
+
+def get_track_handle(
+    fitfilename: str,
+    cache_path_name: Optional[str] = None,
+    track: Optional[Track] = None,
+) -> Track_handle:
+    """Return the handle of a track, writing its track file first if needed
+
+    The track file is written from `track`, if given (e.g. already loaded by the
+    caller), else from the cached track.
+    """
+    activity_name = filename2activityname(fitfilename)
+    track_arrays_file = get_track_arrays_filename(activity_name, cache_path_name)
+    source_file = Path(fitfilename)
+
+    if not track_arrays_file.exists() or (
+        source_file.exists()
+        and track_arrays_file.stat().st_mtime < source_file.stat().st_mtime
+    ):
+        write_track_arrays(
+            track if track is not None else load_file(fitfilename, cache_path_name),
+            track_arrays_file,
+        )
+
+    return Track_handle(name=activity_name, filename=str(track_arrays_file))
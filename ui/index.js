@@ -1,11 +1,120 @@
+// Page size of the lists fetched from the API (cf. serve_ui.py)
+const PAGE_SIZE = 50;
+
+// Fetch a document of the API
+const api = function api(path, params = {}) {
+  const query = new URLSearchParams(params).toString();
+  return fetch(query ? `api/${path}?${query}` : `api/${path}`).then(
+    (response) => {
+      if (!response.ok) {
+        throw new Error(`api/${path}: ${response.status}`);
+      }
+      return response.json();
+    }
+  );
+};
+
+// Convert segments loaded from JSON into proper structure (e.g. time, duration)
+const convertLoadedSegment = function convertLoadedSegment(segment) {
+  const newStartTime = new Date(null);
+  const toReturn = segment;
+  newStartTime.setUTCMilliseconds(Date.parse(segment.start_time) + 7200000);
+  toReturn.start_time = newStartTime;
+  const newDuration = new Date(null);
+  newDuration.setSeconds(segment.duration);
+  toReturn.duration = newDuration;
+  [toReturn.definition] = app.segmentDefinitions.filter(
+    (sg) => sg.uid === toReturn.segment_uid
+  );
+  // Segments this attempt is part of, within its activity
+  toReturn.parents = app.segmentDefinitions.filter((sg) =>
+    (segment.nested_in || []).includes(sg.uid)
+  );
+
+  return toReturn;
+};
+
+// Create adequate string representations for rendering a segment
+const prepareSegmentRendering = function prepareSegmentRendering(segment) {
+  const toReturn = segment;
+  toReturn.start_time_str = segment.start_time.toISOString();
+  toReturn.start_date_str = toReturn.start_time_str.substr(0, 10);
+  toReturn.duration_str = segment.duration.toISOString().substr(11, 8);
+  toReturn.year = toReturn.start_time_str.substring(0, 4);
+
+  [
+    toReturn.speed_str,
+    toReturn.temperature_str,
+  ] = [
+    toReturn.speed,
+    toReturn.temperature,
+  ].map((metric) => {
+    if (metric != null) {
+      const [avg, stdev, lower, upper] = [
+        metric.avg,
+        metric.stdev,
+        metric.lower,
+        metric.upper,
+      ].map((v) => (Number.isInteger(v) ? v : v.toFixed(1)));
+      return `${avg} ± ${stdev} ∈ [${lower}:${upper}]`;
+    }
+    return "";
+  });
+
+  return toReturn;
+};
+
+// Convert activities loaded from JSON into proper structure (e.g. time, duration)
+const convertLoadedActivity = function convertLoadedActivity(activity) {
+  const newStartTime = new Date(null);
+  const toReturn = activity;
+  newStartTime.setUTCMilliseconds(Date.parse(activity.start_time) + 7200000);
+  toReturn.start_time = newStartTime;
+  const newDuration = new Date(null);
+  newDuration.setSeconds(activity.duration);
+  toReturn.duration = newDuration;
+  return toReturn;
+};
+
+// Create adequate string representations for rendering a activity
+const prepareActivityRendering = function prepareActivityRendering(activity) {
+  const toReturn = activity;
+  toReturn.start_time_str = activity.start_time.toString();
+  toReturn.duration_str = activity.duration.toISOString().substr(11, 8);
+  return toReturn;
+};
+
+// Render an activity: its trace, and its segments with their ranks
 const renderActivity = function renderActivity(activity) {
-  fetch(`userdata/${activity.name}.json`)
-    .then((response) => response.json())
-    .then((data) => {
-      this.$root.track = data;
-      this.$root.data_to_render_type = "activity";
-      this.$root.data_to_render = activity;
-    });
+  Promise.all([
+    api(`traces/${activity.name}`),
+    api("segments", {
+      activity: activity.name,
+      ranks: 1,
+      limit: 1000,
+    }),
+  ]).then(([track, segments]) => {
+    this.$root.track = track;
+    // By start time, longest first: segments follow the ones they are part of
+    this.$root.context = segments.items
+      .map(convertLoadedSegment)
+      .sort((a, b) => a.start_time - b.start_time || b.duration - a.duration)
+      .map(prepareSegmentRendering);
+    this.$root.data_to_render_type = "activity";
+    this.$root.data_to_render = activity;
+  });
+};
+
+// Render an activity known by its name only, e.g. from a segment
+const renderActivityByName = function renderActivityByName(name) {
+  api("activities", { name }).then((page) => {
+    if (page.items.length) {
+      renderActivity.call(
+        this,
+        prepareActivityRendering(convertLoadedActivity(page.items[0]))
+      );
+    }
+  });
 };
 
 // Corresponding items
@@ -18,12 +127,22 @@ Vue.component("activityItem", {
   },
 });
 
+// Render a segment: its attempts, most recent first and fastest first
 const renderSegmentDefinition = function renderSegmentDefinition(
   segmentDefinition
 ) {
-  this.$root.data_to_render_type = "segmentDefinition";
-  this.$root.data_to_render = segmentDefinition;
-  this.$root.track = segmentDefinition.latlng;
+  const { uid } = segmentDefinition;
+  Promise.all([
+    api("segments", { uid, order: "desc", limit: PAGE_SIZE }),
+    api(`leaderboard/${uid}`, { limit: PAGE_SIZE }),
+  ]).then(([byDate, byDuration]) => {
+    this.$root.context = [byDate.items, byDuration.items].map((segments) =>
+      segments.map(convertLoadedSegment).map(prepareSegmentRendering)
+    );
+    this.$root.data_to_render_type = "segmentDefinition";
+    this.$root.data_to_render = segmentDefinition;
+    this.$root.track = segmentDefinition.latlng;
+  });
 };
 
 Vue.component("segmentDefinitionItem", {
@@ -38,12 +157,23 @@ Vue.component("segmentDefinitionItem", {
 Vue.component("segmentInActivityContextItem", {
   props: ["segment"],
   template: `
-  <div>
+  <div :class="{ nested: segment.parents.length }">
     <h5>
       <a title="Go to segment" @click="renderSegmentDefinition(segment.definition)">
         {{ segment.segment_name }} {{segment.definition.strava_id}}
       </a>
     </h5>
+    <p v-if="segment.parents.length">
+      Part of:
+      <a
+        v-for="parent in segment.parents"
+        :key="parent.uid"
+        title="Go to segment"
+        @click="renderSegmentDefinition(parent)"
+      >
+        {{ parent.name }}
+      </a>
+    </p>
     <table>
     <tr>
       <td>Duration (HH:MM:SS)</td>
@@ -59,11 +189,11 @@ Vue.component("segmentInActivityContextItem", {
     </tr>
     <tr>
       <td>Rank (All Time)</td>
-      <td>{{segment.rankAllTime}}/{{segment.nbAttemptAllTime}}</td>
+      <td>{{segment.rank}}/{{segment.attempts}}</td>
     </tr>
     <tr>
       <td>Rank (This Year)</td>
-      <td>{{segment.rankThisYear}}/{{segment.nbAttemptThisYear}}</td>
+      <td>{{segment.year_rank}}/{{segment.year_attempts}}</td>
     </tr>
     </table>
   </div>
@@ -78,7 +208,7 @@ Vue.component("segmentInDefinitionContextItem", {
   template: `
     <tr>
       <td>
-        <a title="Go to activity" @click="renderActivity(segment.activity)">{{ segment.start_date_str }}</a>
+        <a title="Go to activity" @click="renderActivityByName(segment.activity_name)">{{ segment.start_date_str }}</a>
       </td>
       <td>
         {{ segment.duration_str }}
@@ -92,79 +222,10 @@ Vue.component("segmentInDefinitionContextItem", {
     </tr>
     `,
   methods: {
-    renderActivity,
+    renderActivityByName,
   },
 });
 
-// Convert segments loaded from JSON into proper structure (e.g. time, duration)
-const convertLoadedSegment = function convertLoadedSegment(segment) {
-  const newStartTime = new Date(null);
-  const toReturn = segment;
-  newStartTime.setUTCMilliseconds(Date.parse(segment.start_time) + 7200000);
-  toReturn.start_time = newStartTime;
-  const newDuration = new Date(null);
-  newDuration.setSeconds(segment.duration);
-  toReturn.duration = newDuration;
-  [toReturn.definition] = segment_definitions.filter(
-    (sg) => sg.uid === toReturn.segment_uid
-  );
-  [toReturn.activity] = activities.filter(
-    (a) => a.name === toReturn.activity_name
-  );
-
-  return toReturn;
-};
-
-// Create adequate string representations for rendering a segment
-const prepareSegmentRendering = function prepareSegmentRendering(segment) {
-  const toReturn = segment;
-  toReturn.start_time_str = segment.start_time.toISOString();
-  toReturn.start_date_str = toReturn.start_time_str.substr(0, 10);
-  toReturn.duration_str = segment.duration.toISOString().substr(11, 8);
-  toReturn.year = toReturn.start_time_str.substring(0, 4);
-
-  [
-    toReturn.speed_str,
-    toReturn.temperature_str,
-  ] = [
-    toReturn.speed,
-    toReturn.temperature,
-  ].map((metric) => {
-    if (metric != null) {
-      const [avg, stdev, lower, upper] = [
-        metric.avg,
-        metric.stdev,
-        metric.lower,
-        metric.upper,
-      ].map((v) => (Number.isInteger(v) ? v : v.toFixed(1)));
-      return `${avg} ± ${stdev} ∈ [${lower}:${upper}]`;
-    }
-    return "";
-  });
-
-  return toReturn;
-};
-
-// Convert activities loaded from JSON into proper structure (e.g. time, duration)
-const convertLoadedActivity = function convertLoadedActivity(activity) {
-  const newStartTime = new Date(null);
-  const toReturn = activity;
-  newStartTime.setUTCMilliseconds(Date.parse(activity.start_time) + 7200000);
-  toReturn.start_time = newStartTime;
-  const newDuration = new Date(null);
-  newDuration.setSeconds(activity.duration);
-  toReturn.duration = newDuration;
-  return toReturn;
-};
-
-// Create adequate string representations for rendering a activity
-const prepareActivityRendering = function prepareActivityRendering(activity) {
-  const toReturn = activity;
-  toReturn.start_time_str = activity.start_time.toString();
-  toReturn.duration_str = activity.duration.toISOString().substr(11, 8);
-  return toReturn;
-};
-
 const updated = function updated() {
   // On DOM update, update polyline and map, if necessary
   if (this.$root.polyline) {
@@ -181,24 +242,24 @@ const updated = function updated() {
 const app = new Vue({
   el: "#app",
   data: {
-    activities: activities
-      .filter((a) => a.gps_available)
-      .sort((a, b) => Date.parse(b.start_time) - Date.parse(a.start_time))
-      .map(convertLoadedActivity)
-      .map(prepareActivityRendering),
-    segments: segments
-      .sort((a, b) => Date.parse(a.duration) - Date.parse(b.duration))
-      // .sort((a, b) => Date.parse(b.start_time) - Date.parse(a.start_time))
-      .map(convertLoadedSegment)
-      .map(prepareSegmentRendering),
-    segmentDefinitions: segment_definitions,
+    // Activities with GPS, fetched page by page, most recent first
+    activities: [],
+    activitiesTotal: 0,
+    segmentDefinitions: [],
     mymap: null,
     polyline: null,
     track: null,
+    context: [],
     data_to_render: "",
     data_to_render_type: "",
     content: "",
   },
+  created: function created() {
+    api("segment_definitions").then((segmentDefinitions) => {
+      this.segmentDefinitions = segmentDefinitions;
+      this.loadActivities();
+    });
+  },
   mounted: function mounted() {
     // FIXME does not work but in data
     this.$root.mymap = L.map("mapid").setView([-34.0425275, 151.1227849], 12);
@@ -214,51 +275,32 @@ const app = new Vue({
         accessToken: accessToken,
       }
     ).addTo(this.$root.mymap);
-    // renderActivity(activities[activities.length - 1]);
-  },
-  computed: {
-    context() {
-      if (this.data_to_render_type === "activity") {
-        return this.segments
-          .filter(
-            (segment) => segment.activity_name === this.data_to_render.name
-          )
-          .sort((a, b) => Date.parse(a.start_time) - Date.parse(b.start_time))
-          .map((targetsegment) => {
-            const allTime = this.segments
-              .filter(
-                (segment) => segment.segment_uid === targetsegment.segment_uid
-              )
-              .sort((a, b) => Date.parse(a.duration) - Date.parse(b.duration));
-
-            const thisYear = allTime.filter(
-              (segment) => segment.year === targetsegment.year
-            );
-
-            const toReturn = targetsegment;
-            toReturn.rankAllTime = allTime.indexOf(targetsegment) + 1;
-            toReturn.nbAttemptAllTime = allTime.length;
-            [toReturn.bestAllTime] = allTime;
-            toReturn.rankThisYear = thisYear.indexOf(targetsegment) + 1;
-            toReturn.nbAttemptThisYear = thisYear.length;
-            [toReturn.bestThisYear] = thisYear;
-            return toReturn;
-          });
-      }
-      if (this.data_to_render_type === "segmentDefinition") {
-        const { uid } = this.data_to_render;
-        const segments = [];
-        segments[0] = this.segments
-          .filter((segment) => segment.segment_uid === uid)
-          .concat()
-          .sort((a, b) => Date.parse(b.start_time) - Date.parse(a.start_time));
-          segments[1] = this.segments
-          .filter((segment) => segment.segment_uid === uid)
-          .concat()
-          .sort((a, b) => Date.parse(a.duration) - Date.parse(b.duration));
-        return segments;
+    // Heatmap of all activities, if generated by heatmap.py
+    if (typeof heatmap !== "undefined") {
+      L.tileLayer("userdata/heatmap/{z}/{x}/{y}.png", {
+        minNativeZoom: heatmap.min_zoom,
+        maxNativeZoom: heatmap.max_zoom,
+        maxZoom: 18,
+        opacity: 0.8,
+      }).addTo(this.$root.mymap);
+      if (heatmap.bounds) {
+        this.$root.mymap.fitBounds(heatmap.bounds);
       }
-      return ["unknown"];
+    }
+  },
+  methods: {
+    // Fetch the next page of activities
+    loadActivities() {
+      api("activities", {
+        gps: 1,
+        offset: this.activities.length,
+        limit: PAGE_SIZE,
+      }).then((page) => {
+        this.activitiesTotal = page.total;
+        this.activities = this.activities.concat(
+          page.items.map(convertLoadedActivity).map(prepareActivityRendering)
+        );
+      });
     },
   },
   updated: updated,
@@ -2,4 +2,5 @@
 set -euo pipefail
 IFS=$'\n\t'
 
-python -m http.server --bind 127.0.0.1
+cd "$(dirname "$0")/.."
+python serve_ui.py "$@"
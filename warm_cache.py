@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Parse FIT (or GPX) files in parallel, to pre-warm the track cache:
+
+- `~/.cache/fit2segments/*.pbz2`: cached tracks
+- `~/.cache/fit2segments/*.curves.json`: best efforts curves of each track, so
+  that `fit2segments.py` does not load tracks without segments to match
+- `ui/userdata/*.json`: JSON file containing the trace of each activity
+
+Only files without a valid cache entry (missing, or older than the file) are parsed,
+as well as the files queued by `fit2segments.py` for their curves (e.g. home trainer
+rides summarized from their sessions, cf. `curvelib.queue_curves()`), even without
+file arguments: run `warm_cache.py` after `fit2segments.py`, and the next run of
+`fit2segments.py` adds their best efforts. No segment is matched, and
+`activities.json` and `segments.json` are left untouched, so that this can run right
+after a device sync, before `fit2segments.py`.
+"""
+
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from curvelib import load_curves, pop_curves_queue
+from fitlib import (
+    DEFAULT_CACHE_PATH,
+    discover_activity_files,
+    get_cached_filename,
+    get_logger,
+    get_ui_trace_filename,
+    is_cache_valid,
+    parse_file,
+    write_cached_track,
+    write_ui_trace,
+)
+
+
+def parse_args() -> argparse.Namespace:
+    """ Call me with args = parse_args() """
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    # Positional arguments
+    parser.add_argument(
+        "fitfiles", nargs="*", help="FIT or GPX files, or directories to search"
+    )
+
+    # Options
+    parser.add_argument(
+        "--cache", default=DEFAULT_CACHE_PATH, help="Cache directory to fill"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of CPUs)",
+    )
+
+    # Boolean
+    parser.add_argument("--verbose", "-v", help="Verbose mode", action="store_true")
+
+    args: argparse.Namespace = parser.parse_args()
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    return args
+
+
+def warm_file(
+    filename: str, cache_path_name: Optional[str] = None
+) -> Tuple[str, int, Optional[str]]:
+    """Parse a file and write its cache entry, trace and curves
+
+    Return the file name, its number of track points and the error, if any. Errors
+    are returned rather than raised, so that one bad file does not stop the pool.
+    """
+
+    try:
+        track = parse_file(filename)
+    except Exception as e:
+        return (filename, 0, f"{type(e).__name__}: {e}")
+
+    write_cached_track(track, get_cached_filename(filename, cache_path_name))
+    write_ui_trace(track, get_ui_trace_filename(filename))
+    load_curves(track, cache_path_name, filename)
+
+    return (filename, len(track.track_points), None)
+
+
+def warm_cache(
+    filenames: List[str],
+    cache_path_name: Optional[str] = None,
+    workers: Optional[int] = None,
+    queued: Optional[List[str]] = None,
+) -> int:
+    """Parse the files without a valid cache entry, and return how many were cached
+
+    `queued` files (cf. `pop_curves_queue()`) are parsed whatever their cache entry,
+    for their curves.
+    """
+    stale = [f for f in filenames if not is_cache_valid(f, cache_path_name)]
+    logger.warning(
+        "%s files, %s already cached", len(filenames), len(filenames) - len(stale)
+    )
+    stale_paths = {Path(f).resolve() for f in stale}
+    stale += [
+        f
+
+        for f in queued or []
+
+        if Path(f).exists() and Path(f).resolve() not in stale_paths
+    ]
+    cached = 0
+
+    if not stale:
+        return cached
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(warm_file, f, cache_path_name) for f in stale]
+
+        for future in as_completed(futures):
+            filename, nb_points, error = future.result()
+
+            if error:
+                logger.critical("%s: %s", filename, error)
+
+                continue
+
+            cached += 1
+            logger.info("Cached %s (%s track points)", filename, nb_points)
+
+    return cached
+
+
+def main(args: argparse.Namespace) -> None:
+    cached = warm_cache(
+        list(discover_activity_files(args.fitfiles)),
+        args.cache,
+        args.workers,
+        pop_curves_queue(args.cache),
+    )
+    logger.warning("%s files cached", cached)
+
+
+if __name__ == "__main__":
+    logger = get_logger(__name__)
+    args = parse_args()
+    main(args)
+    logging.debug("Done")
@@ -0,0 +1,184 @@
+"""
+Athlete workspaces, so that one installation serves several athletes.
+
+A workspace is a directory (`athletes/<athlete>/`) holding the activity files of an
+athlete (`activities/`) and the outputs of `fit2segments.py` for them: store
+(`activities.json`, `segments.json`, `aggregates.json`...) and web UI
+(`ui/userdata`, next to links to the shared UI files). Tracks are cached in
+`~/.cache/fit2segments/athletes/<athlete>`, since activity names may clash between
+athletes. Segment definitions are shared by all athletes.
+
+Cross-athlete leaderboards (`athletes/leaderboards.json`) rank, for each segment,
+the best time of each athlete, read from the aggregates of their workspace.
+"""
+
+import json
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from dacite import from_dict
+
+from aggregatelib import (
+    DEFAULT_AGGREGATES_FILENAME,
+    get_best_duration,
+    get_median_duration,
+    load_aggregates,
+)
+from fitlib import DEFAULT_CACHE_PATH, DEFAULT_UI_BASEDIR, atomic_write
+
+DEFAULT_WORKSPACES_PATH = "athletes"
+ACTIVITIES_DIRNAME = "activities"
+LEADERBOARDS_FILENAME = "leaderboards.json"
+# UI files shared by all workspaces, linked from their UI directory
+SHARED_UI_FILES = [
+    "favicon.ico",
+    "index.css",
+    "index.html",
+    "index.js",
+    "userdata/accessToken.js",
+]
+
+
+@dataclass(frozen=True)
+class Workspace:
+    athlete: str
+    # Absolute paths
+    path: str
+    cache_path: str
+
+    @property
+    def activities_path(self) -> str:
+        return str(Path(self.path) / ACTIVITIES_DIRNAME)
+
+
+@dataclass
+class Leaderboard_entry:
+    athlete: str
+    # Best and median durations of the attempts, in seconds
+    best: float
+    count: int
+    median: float
+
+
+def get_workspace(
+    athlete: str,
+    workspaces_path_name: Optional[str] = None,
+    cache_path_name: Optional[str] = None,
+) -> Workspace:
+    if not workspaces_path_name:
+        workspaces_path_name = DEFAULT_WORKSPACES_PATH
+
+    if not cache_path_name:
+        cache_path_name = DEFAULT_CACHE_PATH
+
+    return Workspace(
+        athlete=athlete,
+        path=str((Path(workspaces_path_name) / athlete).resolve()),
+        cache_path=str(Path(cache_path_name).resolve() / "athletes" / athlete),
+    )
+
+
+def list_workspaces(
+    workspaces_path_name: Optional[str] = None, cache_path_name: Optional[str] = None
+) -> List[Workspace]:
+    """Workspaces of all athletes: subdirectories with an activity directory"""
+
+    if not workspaces_path_name:
+        workspaces_path_name = DEFAULT_WORKSPACES_PATH
+    workspaces_path = Path(workspaces_path_name)
+
+    if not workspaces_path.is_dir():
+        return []
+
+    return [
+        get_workspace(path.name, workspaces_path_name, cache_path_name)
+
+        for path in sorted(workspaces_path.iterdir())
+
+        if (path / ACTIVITIES_DIRNAME).is_dir()
+    ]
+
+
+def init_workspace(workspace: Workspace, ui_basedir: Optional[str] = None) -> None:
+    """Create the directories of a workspace, and link the shared UI files"""
+
+    if not ui_basedir:
+        ui_basedir = DEFAULT_UI_BASEDIR
+    Path(workspace.activities_path).mkdir(parents=True, exist_ok=True)
+    Path(workspace.cache_path).mkdir(parents=True, exist_ok=True)
+    ui_path = Path(workspace.path) / DEFAULT_UI_BASEDIR
+    (ui_path / "userdata").mkdir(parents=True, exist_ok=True)
+
+    for filename in SHARED_UI_FILES:
+        source_file = Path(ui_basedir).resolve() / filename
+        link_file = ui_path / filename
+
+        if source_file.exists() and not link_file.exists():
+            link_file.symlink_to(os.path.relpath(source_file, link_file.parent))
+
+
+def build_leaderboards(
+    workspaces: Iterable[Workspace],
+) -> Dict[str, List[Leaderboard_entry]]:
+    """Segment uid -> best time of each athlete, fastest first"""
+    to_return: Dict[str, List[Leaderboard_entry]] = {}
+
+    for workspace in workspaces:
+        aggregates = load_aggregates(
+            str(Path(workspace.path) / DEFAULT_AGGREGATES_FILENAME)
+        )
+
+        for segment_uid, stats in aggregates.segments.items():
+            to_return.setdefault(segment_uid, []).append(
+                Leaderboard_entry(
+                    athlete=workspace.athlete,
+                    best=get_best_duration(stats),
+                    count=len(stats.durations),
+                    median=get_median_duration(stats),
+                )
+            )
+
+    for entries in to_return.values():
+        entries.sort(key=lambda e: (e.best, e.athlete))
+
+    return to_return
+
+
+def load_leaderboards(
+    workspaces_path_name: Optional[str] = None,
+) -> Dict[str, List[Leaderboard_entry]]:
+    if not workspaces_path_name:
+        workspaces_path_name = DEFAULT_WORKSPACES_PATH
+    leaderboards_file = Path(workspaces_path_name) / LEADERBOARDS_FILENAME
+
+    if not leaderboards_file.exists():
+        return {}
+
+    with leaderboards_file.open() as f_handler:
+        return {
+            segment_uid: [
+                from_dict(data_class=Leaderboard_entry, data=entry) for entry in entries
+            ]
+
+            for segment_uid, entries in json.load(f_handler).items()
+        }
+
+
+def write_leaderboards(
+    leaderboards: Dict[str, List[Leaderboard_entry]],
+    workspaces_path_name: Optional[str] = None,
+) -> None:
+    if not workspaces_path_name:
+        workspaces_path_name = DEFAULT_WORKSPACES_PATH
+
+    with atomic_write(Path(workspaces_path_name) / LEADERBOARDS_FILENAME) as f_handler:
+        json.dump(
+            {
+                segment_uid: [asdict(entry) for entry in entries]
+
+                for segment_uid, entries in leaderboards.items()
+            },
+            f_handler,
+        )